@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+compare the two ways of resolving the shift ambiguity in align():
+"partial" (ten additional half-window phase correlations) and
+"overlap" (normalized correlation of the overlapping regions)
+
+usage:
+    python benchmarks/bench_align_methods.py --sizes 256 512 1024 --pairs 10
+
+@author: kernke
+"""
+import argparse
+import time
+import io
+from contextlib import redirect_stdout
+
+import numpy as np
+import cv2
+
+import microscopy_data_analysis as mda
+
+
+#%% synthetic data
+def make_pair(size, max_shift, rng):
+    """
+    two crops of a smooth random texture with a known offset
+    """
+    base = rng.random((size + 2 * max_shift, size + 2 * max_shift))
+    base = cv2.GaussianBlur(base, (0, 0), 1)
+    base = (base - np.mean(base)) / np.std(base)
+    shift = rng.integers(-max_shift, max_shift + 1, 2)
+    o1 = np.array([max_shift, max_shift])
+    o2 = o1 + shift
+    im1 = base[o1[0] : o1[0] + size, o1[1] : o1[1] + size]
+    im2 = base[o2[0] : o2[0] + size, o2[1] : o2[1] + size]
+    im1 = im1 + 0.1 * rng.standard_normal(im1.shape)
+    im2 = im2 + 0.1 * rng.standard_normal(im2.shape)
+    return im1, im2, shift
+
+
+#%% run
+def run(sizes, pairs, max_shift_ratio=0.4, seed=0):
+    rng = np.random.default_rng(seed)
+    print("size   method    time/pair [ms]   correct")
+    for size in sizes:
+        data = [
+            make_pair(size, int(size * max_shift_ratio), rng) for i in range(pairs)
+        ]
+        for method in ["partial", "overlap"]:
+            correct = 0
+            start = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                for im1, im2, shift in data:
+                    pc = mda.align(im1, im2, method=method)
+                    correct += np.array_equal(pc, shift)
+            duration = (time.perf_counter() - start) / pairs * 1000
+            print(
+                str(size).ljust(7)
+                + method.ljust(10)
+                + str(np.round(duration, 2)).ljust(17)
+                + str(correct)
+                + "/"
+                + str(pairs)
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256, 512, 1024])
+    parser.add_argument("--pairs", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.sizes, args.pairs, seed=args.seed)
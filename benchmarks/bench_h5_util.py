@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+timings of the line detection over HDF5 stacks (h5_go_over_data) with the
+serial engine, background prefetching and the frame-parallel process engine,
+so that the scaling with the number of worker processes can be checked;
+the check maps of every engine are compared to the serial result
+
+usage:
+    python benchmarks/bench_h5_util.py --size 512 --frames 16 --processes 1 2 4
+
+@author: kernke
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+import numpy as np
+import cv2
+import h5py
+
+import microscopy_data_analysis as mda
+
+
+#%% synthetic data
+def make_h5(path, size, frames, groups, rng):
+    """
+    noisy 8-bit frames with dark lines, stored like raw data (imgs and time per group)
+    """
+    stack = np.empty([frames, size, size], np.uint8)
+    for k in range(frames):
+        img = np.full((size, size), 120, np.uint8)
+        for l in range(max(1, size // 32)):
+            y = int(rng.integers(0, size))
+            cv2.line(img, (0, y), (size - 1, (y + size // 6) % size), 60, 2)
+        stack[k] = np.clip(img + rng.normal(0, 10, img.shape), 0, 255)
+    with h5py.File(path, "w") as h5:
+        for j in range(groups):
+            mda.h5_images_dataset(h5, "t" + str(j) + "/imgs", stack.shape)
+            h5["t" + str(j) + "/imgs"][:] = stack
+            h5["t" + str(j) + "/time"] = np.arange(frames, dtype=float)
+    return ["t" + str(j) for j in range(groups)]
+
+
+def read_checks(path, tempnames, number):
+    with h5py.File(path, "r") as h5:
+        return [
+            h5[t + "/check" + str(c)][()] for t in tempnames for c in range(number)
+        ]
+
+
+def timed(function, repeats):
+    durations = []
+    with redirect_stdout(io.StringIO()):
+        # one untimed call, so that imports and caches are warm
+        function()
+        for i in range(repeats):
+            start = time.perf_counter()
+            function()
+            durations.append(time.perf_counter() - start)
+    return np.min(durations)
+
+
+#%% run
+def run(size, frames, groups, processes, prefetch, repeats=1, seed=0):
+    rng = np.random.default_rng(seed)
+    params = (2, 15, 15, "dark", None, np.ones((5, 5), np.uint8), 2, None)
+    rotangles = [0, 30]
+    with tempfile.TemporaryDirectory() as directory:
+        raw = os.path.join(directory, "raw.h5")
+        out = os.path.join(directory, "checks.h5")
+        tempnames = make_h5(raw, size, frames, groups, rng)
+
+        engines = [("serial", dict()), ("prefetch", dict(prefetch=prefetch))]
+        for n in sorted(set(processes)):
+            engines.append(
+                ("processes=" + str(n), dict(processes=n, prefetch=prefetch))
+            )
+
+        print("cpus: " + str(os.cpu_count()))
+        print("engine          time [s]   speedup   identical")
+        reference, t_serial = None, None
+        for name, options in engines:
+            duration = timed(
+                lambda: mda.h5_go_over_data(
+                    out, raw, rotangles, tempnames, params, **options
+                ),
+                repeats,
+            )
+            checks = read_checks(out, tempnames, len(rotangles))
+            if reference is None:
+                reference, t_serial = checks, duration
+            identical = all(np.array_equal(a, b) for a, b in zip(reference, checks))
+            print(
+                name.ljust(16)
+                + str(np.round(duration, 2)).ljust(11)
+                + str(np.round(t_serial / duration, 2)).ljust(10)
+                + str(identical)
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--frames", type=int, default=16)
+    parser.add_argument("--groups", type=int, default=1)
+    parser.add_argument(
+        "--processes", type=int, nargs="+", default=[1, 2, os.cpu_count() or 1]
+    )
+    parser.add_argument("--prefetch", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(
+        args.size,
+        args.frames,
+        args.groups,
+        args.processes,
+        args.prefetch,
+        args.repeats,
+        args.seed,
+    )
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+timings of the hot paths of image_aligning on synthetic frames,
+stored as JSON, so that two versions can be compared
+
+usage:
+    python benchmarks/bench_image_aligning.py --sizes 512 1024 2048 --output results.json
+    python benchmarks/bench_image_aligning.py --sizes 512 1024 --compare old.json
+
+The size is the frame size of the pair and stack benchmarks; the grid
+benchmarks use a 2x2 grid of tiles of half that size, cut with
+create_grid_tiles() from examples/2D_examples/create_data_for_grid_stitching.py.
+
+@author: kernke
+"""
+import argparse
+import importlib.util
+import io
+import json
+import os
+import platform
+import sys
+import time
+from contextlib import redirect_stdout
+
+import numpy as np
+import cv2
+
+import microscopy_data_analysis as mda
+
+
+#%% synthetic data
+def _load_grid_example():
+    path = os.path.join(
+        os.path.dirname(__file__),
+        "..",
+        "examples",
+        "2D_examples",
+        "create_data_for_grid_stitching.py",
+    )
+    spec = importlib.util.spec_from_file_location("create_data_for_grid_stitching", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+grid_example = _load_grid_example()
+
+
+def make_stack(size, frames, max_shift, rng):
+    """
+    crops of a smooth random texture with random offsets
+    """
+    base = rng.random((size + 2 * max_shift, size + 2 * max_shift)).astype(np.float32)
+    base = cv2.GaussianBlur(base, (0, 0), 1)
+    base = (base - np.mean(base)) / np.std(base)
+    stack = []
+    for i in range(frames):
+        o = rng.integers(0, 2 * max_shift + 1, 2)
+        frame = base[o[0] : o[0] + size, o[1] : o[1] + size]
+        stack.append(frame + 0.1 * rng.standard_normal(frame.shape, dtype=np.float32))
+    return np.array(stack)
+
+
+def to_uint8(img):
+    img = img - np.min(img)
+    return (img / np.max(img) * 255).astype(np.uint8)
+
+
+#%% benchmarks
+def benchmarks(size, rng):
+    """
+    dictionary of benchmark name and function without arguments for one size
+    """
+    pair = make_stack(size, 2, size // 8, rng)
+    stack = make_stack(size, 5, size // 64 + 2, rng)
+    sift_stack = [
+        to_uint8(cv2.GaussianBlur(frame, (0, 0), 4))
+        for frame in make_stack(size, 3, size // 64 + 2, rng)
+    ]
+
+    tile = size // 2
+    tiles, positions = grid_example.create_grid_tiles(
+        rows=2, cols=2, tile=tile, noise=0.05, seed=int(rng.integers(2**31))
+    )
+    absolute_positions = positions.reshape(2, 2, 2)
+    mask = np.outer(np.hanning(tile), np.hanning(tile)) + 0.01
+
+    return {
+        "phase_correlation": lambda: mda.phase_correlation(pair[0], pair[1]),
+        "align": lambda: mda.align(pair[0], pair[1]),
+        "align_overlap": lambda: mda.align(pair[0], pair[1], method="overlap"),
+        "align_com_precise": lambda: mda.align_com_precise(pair[0], pair[1], delta=5),
+        "stack_shifting": lambda: mda.stack_shifting(stack),
+        "relative_stitching_positions": lambda: mda.relative_stitching_positions(
+            tiles, [2, 2], sparse=True
+        ),
+        "stitch_grid": lambda: mda.stitch_grid(tiles, absolute_positions, [2, 2], mask),
+        "stack_sift_align_to_first": lambda: mda.stack_sift_align_to_first(sift_stack),
+    }
+
+
+def measure(function, repeats):
+    # one untimed call, so that e.g. FFT plans and caches are warm
+    function()
+    durations = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+#%% run
+def run(sizes, repeats, names=None, seed=0):
+    rng = np.random.default_rng(seed)
+    results = []
+    print("size   benchmark                       median [ms]   min [ms]")
+    for size in sizes:
+        for name, function in benchmarks(size, rng).items():
+            if names is not None and name not in names:
+                continue
+            with redirect_stdout(io.StringIO()):
+                durations = measure(function, repeats)
+            result = {
+                "benchmark": name,
+                "size": size,
+                "repeats": repeats,
+                "median": float(np.median(durations)),
+                "min": float(np.min(durations)),
+                "mean": float(np.mean(durations)),
+            }
+            results.append(result)
+            print(
+                str(size).ljust(7)
+                + name.ljust(32)
+                + str(np.round(result["median"] * 1000, 2)).ljust(14)
+                + str(np.round(result["min"] * 1000, 2))
+            )
+    return results
+
+
+def environment():
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def compare(results, reference, threshold=1.2):
+    """
+    print the ratio of the median timings new/reference,
+    ratios above threshold are marked as regressions
+    """
+    old = {(r["benchmark"], r["size"]): r for r in reference["results"]}
+    print("\nsize   benchmark                       new/reference")
+    regressions = 0
+    for r in results:
+        key = (r["benchmark"], r["size"])
+        if key not in old:
+            continue
+        ratio = r["median"] / old[key]["median"]
+        flag = ""
+        if ratio > threshold:
+            flag = "  regression"
+            regressions += 1
+        print(str(r["size"]).ljust(7) + r["benchmark"].ljust(32) + str(np.round(ratio, 2)) + flag)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--benchmarks", nargs="+", default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    parser.add_argument("--compare", default=None, help="JSON file of a reference run")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.repeats, args.benchmarks, args.seed)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            reference = json.load(f)
+        if compare(results, reference, args.threshold) > 0:
+            sys.exit(1)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+accuracy vs. speed of the registration in double (float64/complex128) and
+single (float32/complex64) precision, on 16-bit frames like detector data:
+the integer shifts of stack_shifting() must be the same for both precisions,
+the subpixel shifts of stack_shift_precise() may differ slightly
+
+usage:
+    python benchmarks/bench_precision.py --sizes 512 1024 2048 --frames 8
+
+@author: kernke
+"""
+import argparse
+import time
+import io
+from contextlib import redirect_stdout
+
+import numpy as np
+import cv2
+
+import microscopy_data_analysis as mda
+
+
+#%% synthetic data
+def make_stack(size, frames, max_shift, rng):
+    """
+    16-bit crops of a smooth random texture with known offsets and shot noise
+    """
+    base = rng.random((size + 2 * max_shift, size + 2 * max_shift))
+    base = cv2.GaussianBlur(base, (0, 0), 1.5)
+    base = (base - np.min(base)) / (np.max(base) - np.min(base)) * 2000 + 100
+    offsets = rng.integers(0, 2 * max_shift + 1, [frames, 2])
+    stack = []
+    for o in offsets:
+        frame = base[o[0] : o[0] + size, o[1] : o[1] + size]
+        stack.append(rng.poisson(frame).astype(np.uint16))
+    # cumulative shift of each frame relative to the first one
+    truth = offsets - offsets[0]
+    return np.array(stack), truth
+
+
+def timed(function, repeats):
+    durations = []
+    with redirect_stdout(io.StringIO()):
+        # one untimed call, so that the FFT plans are warm
+        function()
+        for i in range(repeats):
+            start = time.perf_counter()
+            result = function()
+            durations.append(time.perf_counter() - start)
+    return result, np.min(durations)
+
+
+#%% run
+def run(sizes, frames, repeats=3, seed=0):
+    rng = np.random.default_rng(seed)
+    print("size   precision   integer [ms]   precise [ms]   correct   same integer   max subpixel diff")
+    for size in sizes:
+        stack, truth = make_stack(size, frames, size // 16, rng)
+        results = dict()
+        for precision in ["double", "single"]:
+            shifts, t_int = timed(
+                lambda: mda.stack_shifting(stack, precision=precision), repeats
+            )
+            precise, t_precise = timed(
+                lambda: mda.stack_shift_precise(stack, delta=5, precision=precision),
+                repeats,
+            )
+            results[precision] = shifts, precise
+            correct = np.sum(np.all(shifts == truth, axis=1))
+            same = np.array_equal(shifts, results["double"][0])
+            diff = np.max(np.abs(precise - results["double"][1]))
+            print(
+                str(size).ljust(7)
+                + precision.ljust(12)
+                + str(np.round(t_int * 1000, 1)).ljust(15)
+                + str(np.round(t_precise * 1000, 1)).ljust(15)
+                + (str(correct) + "/" + str(frames)).ljust(10)
+                + str(same).ljust(15)
+                + "{:.2e}".format(diff)
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048])
+    parser.add_argument("--frames", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.sizes, args.frames, args.repeats, args.seed)
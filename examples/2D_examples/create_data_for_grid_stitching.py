@@ -5,49 +5,128 @@
 
 import numpy as np
 import cv2
-import scipy.misc
+
+
 #%%
-def run_script():
-    
-    #%% take example image and transform to gray-levels and desired size   
-
-
-    test = scipy.misc.face()
-    test=np.mean(test,axis=-1)
-    test=cv2.resize(test[:,200:968], dsize=[2500,2500])
-       
-    #%% cut the big image into small pictures, that form with minor deviations a grid
-    # produce also an inhomogeneous illumination for each picture and add noise
-    
-    b=np.linspace(-1,0.2,500)
-    b=1/(b**2+0.6)
-    inhom_illumination=np.outer(b,b)
-
-    
-    tests=[]
-    rstart=0
-    cstart=0
-    #oldi=0
-    for i in range(5):
-        for j in range(5):
-           
-            noise=np.random.normal(0,np.max(test)/4,[500,500])
-            tests.append((test[rstart:rstart+500,cstart:cstart+500]+noise)*(inhom_illumination))
-    
-            if j==4:
-                cstart += -4*375 +8 +np.random.randint(-2,2)
-                rstart += 375 +4 +np.random.randint(-2,2)
+def example_image():
+    """
+    gray-level version of the raccoon face example image of scipy
+    (scipy.datasets needs the package pooch to download it,
+    older versions of scipy provide it as scipy.misc.face)
+    """
+    try:
+        from scipy.datasets import face
+        test = face()
+    except ImportError:
+        from scipy.misc import face
+        test = face()
+    test = np.mean(test, axis=-1)
+    return test[:, 200:968]
+
+
+def synthetic_image(size, seed=None):
+    """
+    smooth random texture as source image, which needs no download
+    """
+    rng = np.random.default_rng(seed)
+    test = rng.random([size, size])
+    test = cv2.GaussianBlur(test, (0, 0), 2) + cv2.GaussianBlur(test, (0, 0), 8)
+    return test * 255
+
+
+def create_grid_tiles(
+    rows=5, cols=5, tile=500, overlap=0.25, drift=(4, 8), source=None, noise=0.25, seed=None
+):
+    """
+    cut a big image into small pictures, that form with minor deviations a grid,
+    with an inhomogeneous illumination for each picture and noise
+
+    Args:
+        rows (int, optional):
+            number of rows of the grid. Defaults to 5.
+
+        cols (int, optional):
+            number of columns of the grid. Defaults to 5.
+
+        tile (int, optional):
+            size of the square pictures. Defaults to 500.
+
+        overlap (float, optional):
+            relative overlap of neighbouring pictures. Defaults to 0.25.
+
+        drift (tuple, optional):
+            systematic offset in pixels perpendicular to the moving direction,
+            for a move to the right (rows) and a move down (columns).
+            Defaults to (4, 8).
+
+        source (array_like, optional):
+            gray-level image, which is resized to cover the whole grid.
+            Defaults to None, then synthetic_image() is used.
+
+        noise (float, optional):
+            standard deviation of the gaussian noise relative to the
+            maximum of the source. Defaults to 0.25.
+
+        seed (int, optional):
+            seed of the random numbers. Defaults to None.
+
+    Returns:
+        tests (list of array_like):
+            pictures, row by row.
+
+        positions (Kx2 array_like):
+            position (row, column) of each picture in the resized source.
+
+    """
+    rng = np.random.default_rng(seed)
+    step = int(tile * (1 - overlap))
+
+    positions = []
+    rstart = 0
+    cstart = 0
+    for i in range(rows):
+        for j in range(cols):
+            positions.append([rstart, cstart])
+            if j == cols - 1:
+                cstart += -(cols - 1) * step + drift[1] + rng.integers(-2, 2)
+                rstart += step + drift[0] + rng.integers(-2, 2)
             else:
-                cstart += 375 +8 +np.random.randint(-2,2)
-                rstart +=4 +np.random.randint(-2,2)
-            
+                cstart += step + drift[1] + rng.integers(-2, 2)
+                rstart += drift[0] + rng.integers(-2, 2)
+    positions = np.array(positions)
+    positions -= np.min(positions, axis=0)
+
+    size = int(np.max(positions) + tile + 1)
+    if source is None:
+        source = synthetic_image(size, seed)
+    test = cv2.resize(np.asarray(source, dtype=np.float64), dsize=[size, size])
+
+    b = np.linspace(-1, 0.2, tile)
+    b = 1 / (b**2 + 0.6)
+    inhom_illumination = np.outer(b, b)
+
+    tests = []
+    for rstart, cstart in positions:
+        tile_noise = rng.normal(0, np.max(test) * noise, [tile, tile])
+        tests.append(
+            (test[rstart : rstart + tile, cstart : cstart + tile] + tile_noise)
+            * inhom_illumination
+        )
+    return tests, positions
+
+
+def run_script():
+
+    #%% take example image and cut it into pictures on a 5x5 grid
+    tests, positions = create_grid_tiles(source=example_image())
+
     #%% save the series of images forming a grid
     for i in range(len(tests)-1):
         tests[i]=tests[i]-np.min(tests[i])
-        tests[i]=tests[i]/(np.max(tests[i]))+np.random.uniform(0.2,4) 
+        tests[i]=tests[i]/(np.max(tests[i]))+np.random.uniform(0.2,4)
         tests[i]=tests[i]/(np.max(tests[i]))*255
         cv2.imwrite('image_'+str(i).zfill(2)+'.tif', tests[i].astype(np.uint8))
-        
-#%%   
+
+#%%
 if __name__ == '__main__':
-    run_script()
\ No newline at end of file
+    run_script()
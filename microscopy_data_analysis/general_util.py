@@ -8,6 +8,7 @@ import cv2
 #import copy
 from numba import njit
 import scipy.special
+import scipy.fft
 
 from skimage.draw import circle_perimeter
 from skimage.draw import line_aa
@@ -631,7 +632,7 @@ def intersect(A, B, C, D):
 
 
 #%% get_angular_dist
-def get_angular_dist(image, borderdist=100, centerdist=20, plotcheck=False):
+def get_angular_dist(image, borderdist=100, centerdist=20, plotcheck=False, precision="double"):
     """
     angles measured in degrees starting from horizontal line counterclockwise (real space)
     (like phi in polar coordinate)  
@@ -651,6 +652,10 @@ def get_angular_dist(image, borderdist=100, centerdist=20, plotcheck=False):
         plotcheck (TYPE, optional): 
             DESCRIPTION. 
             Defaults to False.
+        
+        precision (str, optional): 
+            "double" (float64) or "single" (float32) Fourier transform. 
+            Defaults to "double".
 
     Returns:
         angledeg (TYPE): 
@@ -666,7 +671,12 @@ def get_angular_dist(image, borderdist=100, centerdist=20, plotcheck=False):
     else:
         img=image
 
-    fftimage = np.fft.rfft2(img)
+    if precision == "single":
+        fftimage = scipy.fft.rfft2(np.asarray(img, dtype=np.float32))
+    elif precision == "double":
+        fftimage = scipy.fft.rfft2(np.asarray(img, dtype=np.float64))
+    else:
+        raise ValueError("precision must be 'double' or 'single'")
     halfheight = int(img.shape[0] / 2)
     rffti = np.roll(fftimage, halfheight, axis=0)
     fim = np.log(np.abs(rffti))
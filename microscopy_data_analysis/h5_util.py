@@ -11,6 +11,10 @@ from .line_detection import line_process_partial,line_check_angle_s,line_process
 import numpy as np
 import cv2
 import time
+import zlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 #%% h5_sortout_0frames_in_raw
 def h5_sortout_0frames_in_raw(rawh5):
@@ -146,182 +150,404 @@ def h5_images_dataset(h5,name,shape,
         compression_opts=compression_opts,
     )
 
-#%% go_over_data vis
-
-
-def h5_go_over_data_vis(
-    newh5, oldh5, rotangles, tempnames, params, roi=None, no_output=False, timed=False
-):
-    rotangles, tempnames = assure_multiple(rotangles, tempnames)
-    
-    (
-        anms_threshold,
-        ksize_anms,
-        ksize_erodil,
-        line,
-        kernel,
-        iterations,
-    ) = params
+#%% prefetching frame reader and asynchronous writer
+def _gzip_frame_chunks(dataset):
+    # every frame is one gzip compressed chunk (like in h5_images_dataset),
+    # so it can be read and written as raw chunk and (de)compressed with zlib,
+    # which releases the GIL, in contrast to the filter pipeline of h5py
+    return (
+        dataset.ndim == 3
+        and dataset.chunks == (1, *dataset.shape[1:])
+        and dataset.compression == "gzip"
+        and not dataset.shuffle
+        and not dataset.fletcher32
+        and dataset.scaleoffset is None
+    )
 
 
-    with h5py.File(newh5, "w") as res, h5py.File(oldh5, "r") as hf:
+class h5_frame_reader:
+    """
+    iterable over frames of a 3D dataset, which reads and decompresses the
+    next frames in a background thread, while the current frame is processed
+    """
 
-        imshape = hf[tempnames[0] + "/imgs"][0].shape
+    def __init__(self, dataset, indices=None, prefetch=2):
+        """
+        Args:
+            dataset (h5py.Dataset): 
+                KxMxN dataset of frames.
+            
+            indices (list of int, optional): 
+                indices of the frames in the order they are read. 
+                Defaults to None (all frames).
+            
+            prefetch (int, optional): 
+                number of frames read in advance, 0 reads every frame 
+                only when it is requested. Defaults to 2.
+
+        """
+        self.dataset = dataset
+        if indices is None:
+            indices = range(len(dataset))
+        self.indices = indices
+        self.prefetch = prefetch
+        self._direct = _gzip_frame_chunks(dataset)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def read(self, i):
+        """
+        frame i of the dataset
+        """
+        if self._direct:
+            try:
+                filter_mask, chunk = self.dataset.id.read_direct_chunk((int(i), 0, 0))
+            except RuntimeError:
+                # chunk not allocated, h5py returns the fill value
+                return self.dataset[i]
+            if filter_mask == 0:
+                chunk = zlib.decompress(chunk)
+            frame = np.frombuffer(chunk, dtype=self.dataset.dtype)
+            return frame.reshape(self.dataset.shape[1:]).copy()
+        return self.dataset[i]
+
+    def __iter__(self):
+        if self.prefetch <= 0:
+            for i in self.indices:
+                yield self.read(i)
+            return
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = deque()
+            for i in self.indices:
+                pending.append(pool.submit(self.read, i))
+                if len(pending) > self.prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+class h5_frame_writer:
+    """
+    writes frames to 3D datasets in a background thread, which also
+    compresses them (see h5_frame_reader), so that the next frame can be
+    processed meanwhile. Frames are written in the order of write() calls.
+    Use as context manager, all frames are stored when the context is left.
+    If the context is left with an exception, waiting frames are discarded
+    and errors of the pending writes do not replace that exception.
+    """
+
+    def __init__(self, queue_size=2):
+        """
+        Args:
+            queue_size (int, optional): 
+                maximum number of frames waiting to be written, 
+                0 writes every frame immediately in the calling thread. 
+                Defaults to 2.
+
+        """
+        self.queue_size = queue_size
+        self._pending = deque()
+        self._pool = None
+        if queue_size > 0:
+            self._pool = ThreadPoolExecutor(max_workers=1)
+
+    def _write(self, dataset, i, frame):
+        if _gzip_frame_chunks(dataset):
+            level = dataset.compression_opts
+            dataset.id.write_direct_chunk((int(i), 0, 0), zlib.compress(frame, level))
+        else:
+            dataset[i] = frame
 
-        dummy = np.ones(imshape)
-        masks = []
-        for i in range(len(rotangles)):
-            drot, log = img_rotate_bound(dummy, rotangles[i], bm=0)
-            newmask = make_mask(drot, 2)
-            masks.append(newmask)
+    def write(self, dataset, i, frame):
+        """
+        store frame as frame i of dataset
 
-        for j in range(len(tempnames)):
+        Args:
+            dataset (h5py.Dataset): 
+                KxMxN dataset.
+            
+            i (int): 
+                index of the frame.
+            
+            frame (MxN array_like): 
+                frame, converted to the dtype of the dataset.
+
+        """
+        frame = np.ascontiguousarray(frame, dtype=dataset.dtype)
+        if self._pool is None:
+            self._write(dataset, i, frame)
+            return
+        self._pending.append(self._pool.submit(self._write, dataset, i, frame))
+        while len(self._pending) > self.queue_size:
+            self._pending.popleft().result()
+
+    def close(self):
+        """
+        wait until all frames are written
+        """
+        while self._pending:
+            self._pending.popleft().result()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _discard(self):
+        # cancel the waiting writes and let a running one finish, ignoring errors
+        for future in self._pending:
+            future.cancel()
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.cancelled():
+                future.exception()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._discard()
 
-            print(tempnames[j])
-            print("________________________________")
-            if timed:
-                time_now = time.time()
 
-            times = hf[tempnames[j] + "/time"][()]
+#%% go_over_data
+def _rotation_masks(imshape, rotangles):
+    dummy = np.ones(imshape)
+    masks = []
+    for i in range(len(rotangles)):
+        drot, log = img_rotate_bound(dummy, rotangles[i], bm=0)
+        newmask = make_mask(drot, 2)
+        masks.append(newmask)
+    return masks
+
+
+def _line_checkmaps(img, rotangles, masks, params, no_output, vis):
+    # line detection of one frame for all rotangles
+    if no_output:
+        return np.ones([len(rotangles), img.shape[0], img.shape[1]])
+
+    if vis:
+        (
+            anms_threshold,
+            ksize_anms,
+            ksize_erodil,
+            line,
+            kernel,
+            iterations,
+        ) = params
+    else:
+        (
+            anms_threshold,
+            ksize_anms,
+            ksize_erodil,
+            line,
+            db_dist,
+            kernel,
+            iterations,
+            ksize_smooth,
+        ) = params
+
+    lapl = img_morphLaplace(img, kernel)
+
+    summed = np.zeros(lapl.shape, dtype=np.double)
+    summed += 255 - lapl
+    summed += img
+    copt = img_to_uint8(summed)
+
+    if vis:
+        return line_process_vis(
+            copt,
+            rotangles,
+            masks,
+            line=line,
+            anms_threshold=anms_threshold,
+            ksize_anms=ksize_anms,
+            ksize_erodil=ksize_erodil,
+            iterations=iterations
+        )
+    return line_process_partial(
+        copt,
+        rotangles,
+        masks,
+        line=line,
+        anms_threshold=anms_threshold,
+        ksize_anms=ksize_anms,
+        ksize_erodil=ksize_erodil,
+        db_dist=db_dist,
+        iterations=iterations,
+        ksize_smooth=ksize_smooth,
+    )
 
-            if roi is None:
-                iroi = np.arange(len(times))
-            else:
-                iroi = roi
-                times=times[iroi]
 
-            time0 = times[0]
+def _checkmaps_to_uint8(checkmaps):
+    return [(cm / np.max(cm) * 255).astype(np.uint8) for cm in checkmaps]
 
-            for ccounter in range(len(rotangles)):
-                name = "/check" + str(ccounter)
-                h5_images_dataset(res, tempnames[j] + name, [len(iroi), *imshape])
 
-            res.create_dataset(tempnames[j] + "/time", shape=(len(iroi)), dtype="f")
+# state of a worker process of the frame-parallel engine
+_frame_worker = dict()
 
-            for i in iroi:
-                print(i)
-                if timed:
-                    print(time.time() - time_now)
-                img = hf[tempnames[j] + "/imgs"][i]
 
-                if no_output:
-                    checkmaps = np.ones([len(rotangles), imshape[0], imshape[1]])
-                else:
+def _frame_worker_init(oldh5, rotangles, masks, params, no_output, vis):
+    # every worker has its own read handle on oldh5
+    _frame_worker["hf"] = h5py.File(oldh5, "r")
+    _frame_worker["args"] = (rotangles, masks, params, no_output, vis)
 
-                    lapl = img_morphLaplace(img, kernel)
 
-                    summed = np.zeros(lapl.shape, dtype=np.double)
-                    summed += 255 - lapl
-                    summed += img
-                    copt = img_to_uint8(summed)
+def _frame_worker_task(task):
+    tempname, i, last = task
+    img = h5_frame_reader(_frame_worker["hf"][tempname + "/imgs"]).read(i)
+    checkmaps = _line_checkmaps(img, *_frame_worker["args"])
+    # the line maps of the last frame are the return value of _go_over_data
+    if last:
+        return _checkmaps_to_uint8(checkmaps), checkmaps
+    return _checkmaps_to_uint8(checkmaps), None
 
-                    checkmaps = line_process_vis(
-                        copt,
-                        rotangles,
-                        masks,
-                        line=line,
-                        anms_threshold=anms_threshold,
-                        ksize_anms=ksize_anms,
-                        ksize_erodil=ksize_erodil,
-                        iterations=iterations
-                    )
 
-                res[tempnames[j] + "/time"][i] = times[i] - time0
-                for ccounter in range(len(rotangles)):
-                    name = "/check" + str(ccounter)
-                    cm = checkmaps[ccounter] / np.max(checkmaps[ccounter]) * 255
-                    res[tempnames[j] + name][i] = cm.astype(np.uint8)
-    return checkmaps
+def _bounded_imap(pool, function, tasks, in_flight):
+    # results of function for the tasks in their order, like pool.imap,
+    # but a task is only submitted, when one of the in_flight earlier results was taken
+    pending = deque()
+    tasks = iter(tasks)
+    for task in tasks:
+        pending.append(pool.apply_async(function, (task,)))
+        if len(pending) >= in_flight:
+            break
+    while pending:
+        result = pending.popleft().get()
+        for task in tasks:
+            pending.append(pool.apply_async(function, (task,)))
+            break
+        yield result
 
-#%% go_over_data
 
-def h5_go_over_data(
-    newh5, oldh5, rotangles, tempnames, params, roi=None, no_output=False, timed=False
+def _go_over_data(
+    newh5, oldh5, rotangles, tempnames, params, roi, no_output, timed, prefetch,
+    processes, vis
 ):
     rotangles, tempnames = assure_multiple(rotangles, tempnames)
-    
-    (
-        anms_threshold,
-        ksize_anms,
-        ksize_erodil,
-        line,
-        db_dist,
-        kernel,
-        iterations,
-        ksize_smooth,
-    ) = params
-
-
-    with h5py.File(newh5, "w") as res, h5py.File(oldh5, "r") as hf:
 
+    with h5py.File(oldh5, "r") as hf:
         imshape = hf[tempnames[0] + "/imgs"][0].shape
-        dummy = np.ones(imshape)
-        masks = []
-        for i in range(len(rotangles)):
-            drot, log = img_rotate_bound(dummy, rotangles[i], bm=0)
-            newmask = make_mask(drot, 2)
-            masks.append(newmask)
-
-        for j in range(len(tempnames)):
+        alltimes = [hf[tempname + "/time"][()] for tempname in tempnames]
+    masks = _rotation_masks(imshape, rotangles)
 
-            print(tempnames[j])
-            print("________________________________")
-            if timed:
-                time_now = time.time()
+    irois = []
+    for times in alltimes:
+        if roi is None:
+            irois.append(np.arange(len(times)))
+        else:
+            irois.append(roi)
+
+    pool = None
+    # with prefetch>0 reading (and decompressing) the next frames and
+    # writing the check maps overlap with the line processing
+    try:
+        if processes is not None:
+            # frames are distributed over the workers, this process is the single
+            # writer of newh5 and receives the results in the order of the frames
+            pool = multiprocessing.Pool(
+                processes,
+                initializer=_frame_worker_init,
+                initargs=(oldh5, rotangles, masks, params, no_output, vis),
+            )
+            tasks = [
+                (tempnames[j], i, j == len(tempnames) - 1 and k == len(irois[j]) - 1)
+                for j in range(len(tempnames))
+                for k, i in enumerate(irois[j])
+            ]
+            # at most 2*processes+prefetch frames are in flight, so that finished
+            # check maps do not pile up, if writing is slower than processing
+            results = _bounded_imap(pool, _frame_worker_task, tasks, 2 * processes + prefetch)
+
+        with h5py.File(newh5, "w") as res, h5py.File(oldh5, "r") as hf, h5_frame_writer(
+            prefetch
+        ) as writer:
+
+            for j in range(len(tempnames)):
+
+                print(tempnames[j])
+                print("________________________________")
+                if timed:
+                    time_now = time.time()
 
-            times = hf[tempnames[j] + "/time"][()]
+                times = alltimes[j]
+                iroi = irois[j]
+                if roi is not None:
+                    times = times[iroi]
 
-            if roi is None:
-                iroi = np.arange(len(times))
-            else:
-                iroi = roi
-                times=times[iroi]
+                time0 = times[0]
 
-            time0 = times[0]
+                for ccounter in range(len(rotangles)):
+                    name = "/check" + str(ccounter)
+                    h5_images_dataset(res, tempnames[j] + name, [len(iroi), *imshape])
 
-            for ccounter in range(len(rotangles)):
-                name = "/check" + str(ccounter)
-                h5_images_dataset(res, tempnames[j] + name, [len(iroi), *imshape])
-                
-            res.create_dataset(tempnames[j] + "/time", shape=(len(iroi)), dtype="f")
+                res.create_dataset(tempnames[j] + "/time", shape=(len(iroi)), dtype="f")
 
-            for i in iroi:
-                print(i)
-                if timed:
-                    print(time.time() - time_now)
-                img = hf[tempnames[j] + "/imgs"][i]
+                if pool is None:
+                    frames = iter(h5_frame_reader(hf[tempnames[j] + "/imgs"], iroi, prefetch))
+                for i in iroi:
+                    print(i)
+                    if timed:
+                        print(time.time() - time_now)
 
-                if no_output:
-                    checkmaps = np.ones([len(rotangles), imshape[0], imshape[1]])
-                else:
+                    if pool is None:
+                        checkmaps = _line_checkmaps(
+                            next(frames), rotangles, masks, params, no_output, vis
+                        )
+                        cms = _checkmaps_to_uint8(checkmaps)
+                    else:
+                        cms, last_checkmaps = next(results)
+                        if last_checkmaps is not None:
+                            checkmaps = last_checkmaps
 
-                    lapl = img_morphLaplace(img, kernel)
+                    res[tempnames[j] + "/time"][i] = times[i] - time0
+                    for ccounter in range(len(rotangles)):
+                        name = "/check" + str(ccounter)
+                        writer.write(res[tempnames[j] + name], i, cms[ccounter])
+    except BaseException:
+        # stop the workers immediately, but reap them
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return checkmaps
 
-                    summed = np.zeros(lapl.shape, dtype=np.double)
-                    summed += 255 - lapl
-                    summed += img
-                    copt = img_to_uint8(summed)
 
+def h5_go_over_data_vis(
+    newh5, oldh5, rotangles, tempnames, params, roi=None, no_output=False, timed=False,
+    prefetch=0, processes=None
+):
+    # like h5_go_over_data, but with line_process_vis and the parameters
+    # (anms_threshold, ksize_anms, ksize_erodil, line, kernel, iterations)
+    return _go_over_data(
+        newh5, oldh5, rotangles, tempnames, params, roi, no_output, timed, prefetch,
+        processes, vis=True
+    )
 
-                    checkmaps = line_process_partial(
-                        copt,
-                        rotangles,
-                        masks,
-                        line=line,
-                        anms_threshold=anms_threshold,
-                        ksize_anms=ksize_anms,
-                        ksize_erodil=ksize_erodil,
-                        db_dist=db_dist,
-                        iterations=iterations,
-                        ksize_smooth=ksize_smooth,
-                    )
 
-                res[tempnames[j] + "/time"][i] = times[i] - time0
-                for ccounter in range(len(rotangles)):
-                    name = "/check" + str(ccounter)
-                    cm = checkmaps[ccounter] / np.max(checkmaps[ccounter]) * 255
-                    res[tempnames[j] + name][i] = cm.astype(np.uint8)
-    return checkmaps
+def h5_go_over_data(
+    newh5, oldh5, rotangles, tempnames, params, roi=None, no_output=False, timed=False,
+    prefetch=0, processes=None
+):
+    # line detection (line_process_partial) for every frame of the groups tempnames
+    # of oldh5 and all rotangles, the results are stored as check0, check1, ... in newh5
+    # params: (anms_threshold, ksize_anms, ksize_erodil, line, db_dist, kernel,
+    #          iterations, ksize_smooth)
+    # prefetch: number of frames read ahead and queued for writing in background threads
+    # processes: number of worker processes for the frame-parallel engine
+    #            (None: serial), every worker opens oldh5 for reading and returns
+    #            the check maps in frame order to this process, the only writer of newh5
+    return _go_over_data(
+        newh5, oldh5, rotangles, tempnames, params, roi, no_output, timed, prefetch,
+        processes, vis=False
+    )
 
 
 #%% align_data
@@ -6,12 +6,261 @@ import numpy as np
 import cv2
 import matplotlib.pyplot as plt
 from copy import deepcopy
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import os
+import threading
+import weakref
+import hashlib
+import tempfile
+import zipfile
+import h5py
+import scipy.fft
+import scipy.sparse
+import scipy.sparse.linalg
+from scipy.sparse.csgraph import connected_components
 from .general_util import peak_com2d
 from .image_processing import img_periodic_tiling,img_to_uint16,img_to_half_int16
 
 
 #%% phase_correlation
-def phase_correlation(a, b):
+_precision_dtypes = {
+    "double": (np.float64, np.complex128),
+    "single": (np.float32, np.complex64),
+}
+
+
+def _precision(G):
+    # precision of the plan, which created the spectrum G
+    if G.dtype == np.complex64:
+        return "single"
+    return "double"
+
+
+def _apodization_window(shape, window):
+    if window is None:
+        return None
+    if window == "hann":
+        return np.outer(np.hanning(shape[0]), np.hanning(shape[1]))
+    raise ValueError("window must be None or 'hann'")
+
+
+def _bandpass_filter(shape, bandpass):
+    # gaussian roll-off below the low and above the high cut-off frequency,
+    # on the frequency grid of rfft2
+    if bandpass is None:
+        return None
+    low, high = bandpass
+    fy = np.fft.fftfreq(shape[0])[:, None]
+    fx = np.fft.rfftfreq(shape[1])[None, :]
+    f2 = fy**2 + fx**2
+    bandpass = np.ones(f2.shape)
+    if low:
+        bandpass *= 1 - np.exp(-f2 / low**2)
+    if high:
+        bandpass *= np.exp(-f2 / high**2)
+    return bandpass
+
+
+class correlation_plan:
+    """
+    precomputed data for the phase correlation of images with one shape:
+    the apodization window, the band-pass filter and, per thread, 
+    the workspace of the cross power spectrum, which is freed, when the
+    thread ends (or the plan is released).
+    The Fourier transforms are real-input transforms (scipy.fft.rfft2),
+    so a spectrum has the shape Mx(N//2+1).
+    With precision "single" the transforms run in float32/complex64,
+    which halves the memory traffic; the integer position of the maximum
+    of the phase correlation is (up to ties) the same as in double precision.
+    Plans are reused via _plan(), which keeps the recently used ones
+    (see clear_correlation_plans()).
+    """
+
+    def __init__(self, shape, window=None, bandpass=None, workers=None, precision="double"):
+        """
+        Args:
+            shape (tuple): 
+                shape MxN of the images.
+            
+            window (str, optional): 
+                apodization window applied before the Fourier transform,
+                None or "hann". Defaults to None.
+            
+            bandpass (tuple, optional): 
+                (low, high) cut-off frequencies in cycles per pixel (at most 0.5),
+                the cross power spectrum is attenuated below low and above high
+                with a gaussian roll-off, 0 disables a side. 
+                Defaults to None (no filter).
+            
+            workers (int, optional): 
+                number of threads of scipy.fft. Defaults to None (one thread).
+            
+            precision (str, optional): 
+                "double" (float64/complex128) or "single" (float32/complex64). 
+                Defaults to "double".
+
+        """
+        if precision not in _precision_dtypes:
+            raise ValueError("precision must be 'double' or 'single'")
+        self.shape = tuple(int(n) for n in shape)
+        self.workers = workers
+        self.precision = precision
+        self.real_dtype, self.complex_dtype = _precision_dtypes[precision]
+        self.window = _apodization_window(self.shape, window)
+        self.bandpass = _bandpass_filter(self.shape, bandpass)
+        if self.window is not None:
+            self.window = self.window.astype(self.real_dtype)
+        if self.bandpass is not None:
+            self.bandpass = self.bandpass.astype(self.real_dtype)
+        # workspaces keyed by the thread, removed with the thread object
+        self._workspaces = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _workspace(self):
+        thread = threading.current_thread()
+        with self._lock:
+            workspace = self._workspaces.get(thread)
+        if workspace is None:
+            half = (self.shape[0], self.shape[1] // 2 + 1)
+            workspace = (
+                np.empty(half, dtype=self.complex_dtype),
+                np.empty(half, dtype=self.real_dtype),
+            )
+            with self._lock:
+                self._workspaces[thread] = workspace
+            # the workspace counts towards the limit of the cached plans
+            _trim_plans()
+        return workspace
+
+    @property
+    def nbytes(self):
+        """
+        memory held by the plan (window, filter and the workspaces of the 
+        running threads)
+        """
+        with self._lock:
+            size = sum(a.nbytes + b.nbytes for a, b in self._workspaces.values())
+        for array in [self.window, self.bandpass]:
+            if array is not None:
+                size += array.nbytes
+        return size
+
+    def spectrum(self, img):
+        """
+        real-input Fourier transform of an (apodized) image
+        """
+        img = np.asarray(img, dtype=self.real_dtype)
+        if self.window is not None:
+            img = img * self.window
+        return scipy.fft.rfft2(img, workers=self.workers)
+
+    def cross_power(self, G_a, G_b, out=None):
+        """
+        normalized (and band-pass filtered) cross power spectrum of two spectra,
+        zero where it is undefined, computed in place in out if given
+        """
+        if out is None:
+            out = np.empty(G_a.shape, dtype=self.complex_dtype)
+            magnitude = np.empty(G_a.shape, dtype=self.real_dtype)
+        else:
+            magnitude = self._workspace()[1]
+        np.conjugate(G_b, out=out)
+        out *= G_a
+        np.absolute(out, out=magnitude)
+        np.divide(out, magnitude, out=out, where=magnitude != 0)
+        if self.bandpass is not None:
+            out *= self.bandpass
+        return out
+
+    def full_cross_power(self, G_a, G_b):
+        """
+        cross power spectrum on the full MxN frequency grid (as from fft2),
+        completed via the hermitian symmetry of real-input transforms
+        """
+        half = self.cross_power(G_a, G_b)
+        M, N = self.shape
+        R = np.empty(self.shape, dtype=self.complex_dtype)
+        R[:, : half.shape[1]] = half
+        rows = -np.arange(M) % M
+        cols = N - np.arange(half.shape[1], N)
+        R[:, half.shape[1] :] = np.conjugate(half[rows][:, cols])
+        return R
+
+    def pcm(self, G_a, G_b):
+        """
+        phase correlation matrix of two spectra of this plan
+        """
+        R = self.cross_power(G_a, G_b, out=self._workspace()[0])
+        return scipy.fft.irfft2(R, s=self.shape, workers=self.workers)
+
+    def phase_correlation(self, a, b):
+        """
+        phase correlation matrix of two images with the shape of this plan
+        """
+        return self.pcm(self.spectrum(a), self.spectrum(b))
+
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+# limits of the plans kept by _plan(); a plan, which alone exceeds the bytes,
+# is not kept and only lives as long as it is used
+_plans_max_size = 16
+_plans_max_bytes = 2**27
+
+
+def _trim_plans():
+    # remove the least recently used plans, until the limits are met
+    with _plans_lock:
+        sizes = OrderedDict((key, plan.nbytes) for key, plan in _plans.items())
+        for key, size in sizes.items():
+            if size > _plans_max_bytes:
+                del _plans[key]
+        while len(_plans) > _plans_max_size or (
+            sum(sizes[key] for key in _plans) > _plans_max_bytes
+        ):
+            _plans.popitem(last=False)
+
+
+def _plan(shape, window=None, bandpass=None, workers=None, precision="double"):
+    # recently used correlation plans, keyed by shape and options
+    if bandpass is not None:
+        bandpass = tuple(bandpass)
+    key = (tuple(int(n) for n in shape), window, bandpass, workers, precision)
+    with _plans_lock:
+        if key in _plans:
+            _plans.move_to_end(key)
+            return _plans[key]
+        plan = correlation_plan(*key)
+        _plans[key] = plan
+    _trim_plans()
+    return plan
+
+
+def clear_correlation_plans():
+    """
+    remove all cached correlation plans (windows, filters and workspaces
+    of the phase correlations), e.g. to release their memory after 
+    processing images of many different shapes
+    """
+    with _plans_lock:
+        _plans.clear()
+
+
+def _spectrum(img, precision="double"):
+    return _plan(np.shape(img), precision=precision).spectrum(img)
+
+
+def _cross_power(G_a, G_b, shape):
+    return _plan(shape, precision=_precision(G_a)).full_cross_power(G_a, G_b)
+
+
+def _pcm_from_spectra(G_a, G_b, shape):
+    return _plan(shape, precision=_precision(G_a)).pcm(G_a, G_b)
+
+
+def phase_correlation(a, b, window=None, bandpass=None, workers=None, precision="double"):
     """
     calculate the pase correlation between two images a,b
     with same shape MxN
@@ -22,19 +271,28 @@ def phase_correlation(a, b):
         
         b (MxN array_like): 
             second image.
+        
+        window (str, optional): 
+            apodization window, None or "hann". Defaults to None.
+        
+        bandpass (tuple, optional): 
+            (low, high) cut-off frequencies in cycles per pixel,
+            see correlation_plan. Defaults to None.
+        
+        workers (int, optional): 
+            number of threads of the Fourier transforms. Defaults to None.
+        
+        precision (str, optional): 
+            "double" or "single" (float32/complex64 transforms). 
+            Defaults to "double".
 
     Returns:
         r (MxN array_like): 
             phase correlation matrix.
 
     """
-    G_a = np.fft.fft2(a)
-    G_b = np.fft.fft2(b)
-    conj_b = np.ma.conjugate(G_b)
-    R = G_a * conj_b
-    R /= np.absolute(R)
-    r = np.fft.ifft2(R).real
-    return r
+    plan = _plan(np.shape(a), window, bandpass, workers, precision)
+    return plan.phase_correlation(a, b)
 
 #%% max_from_2d
 def max_from_2d(A):
@@ -66,7 +324,7 @@ def max_from_2d(A):
 
 #%% stitching
 
-def stitch(im1, im2):
+def stitch(im1, im2, method="partial"):
     """
     stitch two images together to one, by correcting a translational offset
     The images must have the the same shape (MxN) and some overlap 
@@ -77,6 +335,10 @@ def stitch(im1, im2):
         
         im2 (MxN array_like): 
             second image.
+        
+        method (str, optional): 
+            "partial" or "overlap", see align(). 
+            Defaults to "partial".
 
     Returns:
         stitched (KxL array_like): 
@@ -84,7 +346,7 @@ def stitch(im1, im2):
 
     """
 
-    pc = align(im1, im2)
+    pc = align(im1, im2, method=method)
     
     pcs=im1.shape
     
@@ -167,108 +429,344 @@ def stitch_given_shift(im1, im2,pc):
     return stitched
 
 
-#%% align
+#%% spectrum_cache
+
+# order of the partial correlations used by align() to resolve the
+# ambiguity of the shift: (central,central),(left,left),(right,right),
+# (left,right),(right,left) for each axis
+_partial_pairs = (
+    ("center", "center"),
+    ("first", "first"),
+    ("last", "last"),
+    ("first", "last"),
+    ("last", "first"),
+)
+
+
+def _align_windows(shape):
+    hs = int(np.ceil(shape[0] / 2))
+    ws = int(np.ceil(shape[1] / 2))
+    hs2 = int(hs / 2)
+    ws2 = int(ws / 2)
+    full = slice(None)
+    windows = {
+        "full": (full, full),
+        "rows_center": (slice(hs2, hs2 + hs), full),
+        "rows_first": (slice(None, hs), full),
+        "rows_last": (slice(-hs, None), full),
+        "cols_center": (full, slice(ws2, ws2 + ws)),
+        "cols_first": (full, slice(None, ws)),
+        "cols_last": (full, slice(-ws, None)),
+    }
+    return windows
+
+
+class spectrum_cache:
+    """
+    per-stack store of the Fourier transforms needed by align(),
+    every frame and every sub-window of a frame is transformed only once
+    and kept for later correlations, until the frame drops out of the
+    bounded cache (least recently used frames are removed first)
+    """
 
-def align(im1, im2,printing=False,_verbose=False):
+    def __init__(self, imgs, maxsize=2, precision="double"):
+        """
+        Args:
+            imgs (list of MxN array_like or KxMxN array_like): 
+                stack of images with the same shape.
+            
+            maxsize (int, optional): 
+                maximum number of frames, whose spectra are kept in memory.
+                For consecutive pairs (i,i+1) a size of 2 is sufficient.
+                Defaults to 2.
+            
+            precision (str, optional): 
+                "double" or "single", see correlation_plan. 
+                Defaults to "double".
+
+        """
+        self.imgs = imgs
+        self.maxsize = max(int(maxsize), 2)
+        self.precision = precision
+        self.transforms = 0
+        self._frames = OrderedDict()
+
+    def _frame(self, i):
+        if i in self._frames:
+            self._frames.move_to_end(i)
+        else:
+            img = np.asarray(self.imgs[i])
+            self._frames[i] = {"img": img, "windows": _align_windows(img.shape)}
+            while len(self._frames) > self.maxsize:
+                self._frames.popitem(last=False)
+        return self._frames[i]
+
+    def spectrum(self, i, window="full"):
+        """
+        Fourier transform of frame i (or one of the sub-windows used by align)
+
+        Args:
+            i (int): 
+                index of the frame.
+            
+            window (str, optional): 
+                "full" or one of "rows_center", "rows_first", "rows_last",
+                "cols_center", "cols_first", "cols_last".
+                Defaults to "full".
+
+        Returns:
+            spectrum (array_like): 
+                complex real-input Fourier transform (see correlation_plan).
+
+        """
+        frame = self._frame(i)
+        if window not in frame:
+            frame[window] = _spectrum(frame["img"][frame["windows"][window]], self.precision)
+            self.transforms += 1
+        return frame[window]
+
+    def phase_correlation(self, i, j, window_i="full", window_j="full"):
+        """
+        phase correlation matrix between frame i and frame j,
+        equivalent to phase_correlation(imgs[i],imgs[j]) for full windows
+        """
+        G_a = self.spectrum(i, window_i)
+        G_b = self.spectrum(j, window_j)
+        frame = self._frame(i)
+        shape = frame["img"][frame["windows"][window_i]].shape
+        return _pcm_from_spectra(G_a, G_b, shape)
+
+    def cross_power(self, i, j):
+        """
+        normalized cross power spectrum of frame i and frame j,
+        whose inverse Fourier transform is the phase correlation matrix
+        """
+        G_a = self.spectrum(i)
+        G_b = self.spectrum(j)
+        return _cross_power(G_a, G_b, self._frame(i)["img"].shape)
+
+    def align(self, i, j, printing=False, _verbose=False, method="partial"):
+        """
+        translational offset of frame j relative to frame i,
+        see align() for details
+        """
+        pcm = self.phase_correlation(i, j)
+        if method == "overlap":
+            im1 = self._frame(i)["img"]
+            im2 = self._frame(j)["img"]
+            return _align_overlap(pcm, im1, im2, printing, _verbose)
+        elif method != "partial":
+            raise ValueError("method must be 'partial' or 'overlap'")
+        pcms0 = []
+        pcms1 = []
+        for wi, wj in _partial_pairs:
+            pcms0.append(self.phase_correlation(i, j, "rows_" + wi, "rows_" + wj))
+        for wi, wj in _partial_pairs:
+            pcms1.append(self.phase_correlation(i, j, "cols_" + wi, "cols_" + wj))
+        return _align_from_pcms(pcm, pcms0, pcms1, printing, _verbose)
+
+
+#%% registration_cache
+class registration_cache:
+    """
+    persistent on-disk cache of registration results (shifts, homographies,
+    stitching positions), addressed by a hash of the frame content and of
+    the parameters of the registration, so that a repeated run on the same
+    data returns the stored result. Every entry is a .npz file in one directory,
+    the least recently used entries are removed, if the directory exceeds max_bytes.
     """
-    calculate the translational offset of image im2 relative to image im1
-    using phase correlation between the two image
-    The images must have the the same shape (MxN) and some overlap 
 
-    Args:
-        im1 (MxN array_like): 
-            first image.
-        
-        im2 (MxN array_like): 
-            second image.
-        
-        printing (bool, optional): 
-            set to "True" for printing more information about the function execution. 
-            Defaults to False.
-        
-        verbose (bool,optional): 
-            set to "True" for additionally returning indices about the relative
-            positioning. Defaults to False.
+    def __init__(self, path, max_bytes=2**30):
+        """
+        Args:
+            path (str): 
+                directory of the cache, created if it does not exist.
+            
+            max_bytes (int, optional): 
+                maximum total size of the cached files. 
+                Defaults to 2**30.
+
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, name, frames, **params):
+        """
+        content address of a registration
+
+        Args:
+            name (str): 
+                name of the registration, e.g. the function.
+            
+            frames (list of array_like): 
+                input images, their content, shape and dtype are hashed.
+            
+            **params: 
+                parameters, which change the result.
+
+        Returns:
+            key (str): 
+                hexadecimal hash.
+
+        """
+        h = hashlib.blake2b(digest_size=20)
+        h.update(name.encode())
+        h.update(repr(sorted((k, np.asarray(v).tolist()) for k, v in params.items())).encode())
+        for frame in frames:
+            frame = np.ascontiguousarray(frame)
+            h.update(repr((frame.shape, frame.dtype.str)).encode())
+            h.update(frame)
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".npz")
+
+    def load(self, key):
+        """
+        Args:
+            key (str): 
+                see key().
+
+        Returns:
+            result (dict or None): 
+                stored arrays, None if the key is not cached.
+                Unreadable (e.g. truncated) entries are removed and 
+                treated as not cached.
+
+        """
+        file = self._file(key)
+        try:
+            with np.load(file) as data:
+                result = {k: data[k] for k in data.files}
+        except FileNotFoundError:
+            return None
+        except (zipfile.BadZipFile, EOFError, OSError, ValueError, KeyError):
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            return None
+        # the modification time marks the last use
+        try:
+            os.utime(file)
+        except FileNotFoundError:
+            pass
+        return result
 
-    Returns:
-        offset (tuple): 
-            containing two integers.
+    def save(self, key, **arrays):
+        """
+        store arrays under key and remove least recently used entries,
+        if the cache is too large
 
-    """
-    pcm = phase_correlation(im1, im2)
-    pc,pcval = max_from_2d(pcm)
-    pcs = np.array(np.shape(pcm))
-    
-    optimal_solution=True
-
-    hs = int(np.ceil(pcs[0] / 2))
-    ws = int(np.ceil(pcs[1] / 2))
-    hs2= int(hs/2)
-    ws2= int(ws/2)
-    delta_d0=pcs[0]-hs
-    delta_d1=pcs[1]-ws
-
-    pcm_a = phase_correlation(im1[hs2:hs2+hs, :], im2[hs2:hs2+hs, :])
-    pcm_b = phase_correlation(im1[:hs, :], im2[:hs, :])
-    pcm_c = phase_correlation(im1[-hs:, :], im2[-hs:, :])
-    pcm_d = phase_correlation(im1[:hs, :], im2[-hs:, :])
-    pcm_e = phase_correlation(im1[-hs:, :], im2[:hs, :])
- 
-    pc0vals=np.zeros(5)   
-    pc0s=np.zeros([5,2],dtype=int)
-    pc0s[0],pc0vals[0] = max_from_2d(pcm_a)
-    pc0s[1],pc0vals[1] = max_from_2d(pcm_b)
-    pc0s[2],pc0vals[2] = max_from_2d(pcm_c)
-    pc0s[3],pc0vals[3] = max_from_2d(pcm_d)
-    pc0s[4],pc0vals[4] = max_from_2d(pcm_e)
-
-    pc0s[4,0]+=delta_d0
-    optimal_solution *= pc[0] in pc0s[:,0]
-    cond0= pc[0] == pc0s[:,0]   
+        Args:
+            key (str): 
+                see key().
+            
+            **arrays: 
+                arrays to store.
+
+        """
+        # written to a unique temporary file first, so that concurrent
+        # writers and readers never see a partially written entry
+        with tempfile.NamedTemporaryFile(
+            dir=self.path, prefix=key, suffix=".tmp", delete=False
+        ) as temporary:
+            try:
+                np.savez(temporary, **arrays)
+            except BaseException:
+                temporary.close()
+                os.remove(temporary.name)
+                raise
+        os.replace(temporary.name, self._file(key))
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
 
+
+#%% align
+def _unwrap_shift(pc, pcs, index0, index1):
+    if index0 < 3:
+        if pc[0] > pcs[0] / 2:
+            pc[0] = pc[0] - pcs[0]
+    elif index0 == 3:
+        pc[0] = pc[0] - pcs[0]
+
+    if index1 < 3:
+        if pc[1] > pcs[1] / 2:
+            pc[1] = pc[1] - pcs[1]
+    elif index1 == 3:
+        pc[1] = pc[1] - pcs[1]
+    return pc
+
+
+def _partial_index(pcval, pcis, optimal_solution):
+    cond = pcval == pcis[:, 0]
     if optimal_solution:
-        if np.sum(cond0)>1:
-            if cond0[0]:
-                index0=0
-            else:
-                index0=np.argmax(pc0vals*cond0)
-        else:
-            index0=np.argwhere(cond0)[0][0]
-    else:
-        index0=np.argmax(pc0vals)
-    
-    pcm_a = phase_correlation(im1[:,ws2:ws2+ws], im2[:,ws2:ws2+ws])
-    pcm_b = phase_correlation(im1[:,:ws], im2[:,:ws])
-    pcm_c = phase_correlation(im1[:,-ws:], im2[:,-ws:])
-    pcm_d = phase_correlation(im1[:,:ws], im2[:,-ws:])
-    pcm_e = phase_correlation(im1[:,-ws:], im2[:,:ws])
-    
-    pc1vals=np.zeros(5)
-    pc1s=np.zeros([5,2],dtype=int)
-    pc1s[0],pc1vals[0] = max_from_2d(pcm_a)
-    pc1s[1],pc1vals[1] = max_from_2d(pcm_b)
-    pc1s[2],pc1vals[2] = max_from_2d(pcm_c)
-    pc1s[3],pc1vals[3] = max_from_2d(pcm_d)
-    pc1s[4],pc1vals[4] = max_from_2d(pcm_e)
-
-    pc1s[4,1]+=delta_d1
-    optimal_solution *= pc[1] in pc1s[:,1]
-    cond1= pc[1] == pc1s[:,1]
-    
-    if optimal_solution:
-        if np.sum(cond1)>1:
-            if cond1[0]:
-                index1=0
+        if np.sum(cond) > 1:
+            if cond[0]:
+                index = 0
             else:
-                index1=np.argmax(pc1vals*cond1)
+                index = np.argmax(pcis[:, 1] * cond)
         else:
-            index1=np.argwhere(cond1)[0][0]
+            index = np.argwhere(cond)[0][0]
     else:
-        index1=np.argmax(pc1vals)
-    
+        index = np.argmax(pcis[:, 1])
+    return index
+
+
+def _align_from_pcms(pcm, pcms0, pcms1, printing=False, _verbose=False):
+    pc, pcval = max_from_2d(pcm)
+    pcs = np.array(np.shape(pcm))
+
+    optimal_solution = True
+
+    delta_d0 = pcs[0] - int(np.ceil(pcs[0] / 2))
+    delta_d1 = pcs[1] - int(np.ceil(pcs[1] / 2))
+
+    pc0vals = np.zeros(5)
+    pc0s = np.zeros([5, 2], dtype=int)
+    for k in range(5):
+        pc0s[k], pc0vals[k] = max_from_2d(pcms0[k])
+
+    pc0s[4, 0] += delta_d0
+    optimal_solution *= pc[0] in pc0s[:, 0]
+    index0 = _partial_index(
+        pc[0], np.stack([pc0s[:, 0], pc0vals], axis=1), optimal_solution
+    )
+
+    pc1vals = np.zeros(5)
+    pc1s = np.zeros([5, 2], dtype=int)
+    for k in range(5):
+        pc1s[k], pc1vals[k] = max_from_2d(pcms1[k])
+
+    pc1s[4, 1] += delta_d1
+    optimal_solution *= pc[1] in pc1s[:, 1]
+    index1 = _partial_index(
+        pc[1], np.stack([pc1s[:, 1], pc1vals], axis=1), optimal_solution
+    )
+
     if not optimal_solution:
         print("Warning: optimal solution not found")
-        
+
     if printing:
         print("Maximum position of whole phase correlation matrix:")
         print(pc)
@@ -291,27 +789,132 @@ def align(im1, im2,printing=False,_verbose=False):
         print("maximum values:")
         print(pc1vals)
         print("resulting index")
-        print(index1) 
+        print(index1)
 
-    if index0<3:
-        if pc[0] > pcs[0] / 2:
-            pc[0] = pc[0] - pcs[0]
-    elif index0==3:
-        pc[0] = pc[0]-pcs[0]
-        
-    if index1<3:
-        if pc[1] > pcs[1] / 2:
-            pc[1] = pc[1] - pcs[1]
-    elif index1==3:
-        pc[1] = pc[1]-pcs[1]
+    pc = _unwrap_shift(pc, pcs, index0, index1)
 
     if _verbose:
-        return pcm,(index0,index1)
+        return pcm, (index0, index1)
     else:
         return pc
 
 
-def align_com_precise(im1, im2,delta=None,show=False,artifacts=None):
+def _overlap_ncc(im1, im2, shift):
+    # normalized cross correlation of the overlapping regions,
+    # when im2 is placed at shift relative to im1
+    s0, s1 = shift
+    a = im1[max(s0, 0) : im1.shape[0] + min(s0, 0), max(s1, 0) : im1.shape[1] + min(s1, 0)]
+    b = im2[max(-s0, 0) : im2.shape[0] - max(s0, 0), max(-s1, 0) : im2.shape[1] - max(s1, 0)]
+    a = a - np.mean(a)
+    b = b - np.mean(b)
+    norm = np.sqrt(np.sum(a * a) * np.sum(b * b))
+    if norm == 0:
+        return -np.inf
+    return np.sum(a * b) / norm
+
+
+def _align_overlap(pcm, im1, im2, printing=False, _verbose=False, min_overlap=0.05):
+    pc, pcval = max_from_2d(pcm)
+    pcs = np.array(np.shape(pcm))
+
+    # every peak position p is either a positive shift p or
+    # the wrapped negative shift p-N, leading to at most four candidates
+    candidates0 = [pc[0]] if pc[0] == 0 else [pc[0], pc[0] - pcs[0]]
+    candidates1 = [pc[1]] if pc[1] == 0 else [pc[1], pc[1] - pcs[1]]
+
+    candidates = []
+    scores = []
+    for c0 in candidates0:
+        for c1 in candidates1:
+            if pcs[0] - abs(c0) < min_overlap * pcs[0]:
+                continue
+            if pcs[1] - abs(c1) < min_overlap * pcs[1]:
+                continue
+            candidates.append([c0, c1])
+            scores.append(_overlap_ncc(im1, im2, (c0, c1)))
+
+    # shift as it results from the half-size rule
+    default = _unwrap_shift(np.copy(pc), pcs, 0, 0)
+    if len(candidates) == 0:
+        print("Warning: optimal solution not found")
+        shift = default
+    else:
+        shift = np.array(candidates[int(np.argmax(scores))])
+
+    # express the choice with the indices used by align()
+    indices = []
+    for k in range(2):
+        if shift[k] == default[k]:
+            indices.append(0)
+        elif shift[k] < 0:
+            indices.append(3)
+        else:
+            indices.append(4)
+    index0, index1 = indices
+
+    if printing:
+        print("Maximum position of whole phase correlation matrix:")
+        print(pc)
+        print("candidate shifts:")
+        print(np.array(candidates))
+        print("normalized overlap correlations:")
+        print(np.array(scores))
+        print("resulting indices")
+        print(index0, index1)
+
+    if _verbose:
+        return pcm, (index0, index1)
+    else:
+        return shift
+
+
+def align(im1, im2,printing=False,_verbose=False,method="partial",precision="double"):
+    """
+    calculate the translational offset of image im2 relative to image im1
+    using phase correlation between the two image
+    The images must have the the same shape (MxN) and some overlap 
+
+    The maximum of the phase correlation matrix only determines the offset
+    modulo the image size. With method "partial" this ambiguity is resolved
+    by ten additional phase correlations of half-sized windows, with method
+    "overlap" the (at most four) possible offsets are compared directly by
+    the normalized correlation of the overlapping image regions, which
+    requires only the single full phase correlation.
+
+    Args:
+        im1 (MxN array_like): 
+            first image.
+        
+        im2 (MxN array_like): 
+            second image.
+        
+        printing (bool, optional): 
+            set to "True" for printing more information about the function execution. 
+            Defaults to False.
+        
+        verbose (bool,optional): 
+            set to "True" for additionally returning indices about the relative
+            positioning. Defaults to False.
+        
+        method (str, optional): 
+            "partial" or "overlap". 
+            Defaults to "partial".
+        
+        precision (str, optional): 
+            "double" or "single" (float32/complex64 transforms), 
+            see correlation_plan. Defaults to "double".
+
+    Returns:
+        offset (tuple): 
+            containing two integers.
+
+    """
+    spectra = spectrum_cache([im1, im2], precision=precision)
+    return spectra.align(0, 1, printing=printing, _verbose=_verbose, method=method)
+
+
+def align_com_precise(im1, im2,delta=None,show=False,artifacts=None,method="partial",
+                      precision="double"):
     """
     
 
@@ -328,6 +931,12 @@ def align_com_precise(im1, im2,delta=None,show=False,artifacts=None):
             Defaults to False.
         artifacts (TYPE, optional): 
             DESCRIPTION. Defaults to None.
+        method (str, optional): 
+            "partial" or "overlap", see align(). 
+            Defaults to "partial".
+        precision (str, optional): 
+            "double" or "single", see align(). 
+            Defaults to "double".
 
     Returns:
         pc (TYPE): 
@@ -335,8 +944,11 @@ def align_com_precise(im1, im2,delta=None,show=False,artifacts=None):
 
     """
     
-    pcm,(index0,index1) = align(im1,im2,_verbose=True)
+    pcm,(index0,index1) = align(im1,im2,_verbose=True,method=method,precision=precision)
+    return _com_precise_from_pcm(pcm, index0, index1, delta, show, artifacts)
 
+
+def _com_precise_from_pcm(pcm, index0, index1, delta=None, show=False, artifacts=None):
     pcm -= np.min(pcm)
     pcb,orig=img_periodic_tiling(pcm)
     rows=int(orig[0][0]//2)
@@ -369,43 +981,462 @@ def align_com_precise(im1, im2,delta=None,show=False,artifacts=None):
     pc[1]=(compos[1]+cols)%orig[1][0]
     
     pcs = np.array(np.shape(pcm))
+    return _unwrap_shift(pc, pcs, index0, index1)
+
+#%% align_dft_precise
+def _upsampled_dft(R, position, upsample_factor, region):
+    # evaluate the inverse DFT of R only on a small grid with spacing
+    # 1/upsample_factor centered at position, by matrix multiplication
+    offsets = (np.arange(region) - region // 2) / upsample_factor
+    rows = position[0] + offsets
+    cols = position[1] + offsets
+    kernel0 = np.exp(2j * np.pi * np.outer(rows, np.fft.fftfreq(R.shape[0])))
+    kernel1 = np.exp(2j * np.pi * np.outer(np.fft.fftfreq(R.shape[1]), cols))
+    upsampled = kernel0 @ R @ kernel1
+    return upsampled.real / R.size, rows, cols
+
+
+def _dft_precise_from_pcm(
+    pcm, R, index0, index1, upsample_factor=100, artifacts=None
+):
+    if artifacts is None:
+        coarse = pcm
+    else:
+        coarse = pcm - np.min(pcm)
+        coarse[0, :] *= artifacts
+        coarse[:, 0] *= artifacts
+    pc, pcval = max_from_2d(coarse)
 
-    if index0<3:
-        if pc[0] > pcs[0] / 2:
-            pc[0] = pc[0] - pcs[0]
-    elif index0==3:
-        pc[0] = pc[0]-pcs[0]
+    # the true maximum lies within one pixel around the integer maximum
+    region = int(np.ceil(1.5 * upsample_factor))
+    upsampled, rows, cols = _upsampled_dft(R, pc, upsample_factor, region)
+    fine, fineval = max_from_2d(upsampled)
+
+    pc = np.array([rows[fine[0]], cols[fine[1]]])
+    pcs = np.array(np.shape(pcm))
+    return _unwrap_shift(pc, pcs, index0, index1)
+
+
+def align_dft_precise(im1, im2, upsample_factor=100, artifacts=None, method="partial",
+                      precision="double"):
+    """
+    calculate the translational offset of image im2 relative to image im1
+    with subpixel precision. The integer offset is determined like in align(),
+    then the phase correlation is upsampled around its maximum by a
+    matrix-multiply DFT, so only a small neighbourhood is evaluated
+    (Guizar-Sicairos et al., Opt. Lett. 33, 156 (2008)).
+
+    Args:
+        im1 (MxN array_like): 
+            first image.
         
-    if index1<3:
-        if pc[1] > pcs[1] / 2:
-            pc[1] = pc[1] - pcs[1]
-    elif index1==3:
-        pc[1] = pc[1]-pcs[1]
+        im2 (MxN array_like): 
+            second image.
         
-    return pc
+        upsample_factor (int, optional): 
+            the offset is determined with a precision of 1/upsample_factor pixel. 
+            Defaults to 100.
+        
+        artifacts (float, optional): 
+            factor multiplied to the phase correlation at zero offset
+            in row or column direction, to suppress fixed pattern artifacts. 
+            Defaults to None.
+        
+        method (str, optional): 
+            "partial" or "overlap", see align(). 
+            Defaults to "partial".
+        
+        precision (str, optional): 
+            "double" or "single", see align(). 
+            Defaults to "double".
+
+    Returns:
+        pc (array_like): 
+            containing two floats.
+
+    """
+    spectra = spectrum_cache([im1, im2], precision=precision)
+    pcm, (index0, index1) = spectra.align(0, 1, _verbose=True, method=method)
+    R = spectra.cross_power(0, 1)
+    return _dft_precise_from_pcm(pcm, R, index0, index1, upsample_factor, artifacts)
+
+#%% align_pyramid
+def _pyramid(img, levels):
+    small = np.asarray(img, dtype=np.float32)
+    for level in range(levels):
+        small = cv2.pyrDown(small)
+    return small
+
+
+def _pyramid_shape(shape, levels):
+    # shape of _pyramid(img, levels) for an image of the given shape
+    shape = np.array(shape[:2], dtype=int)
+    for level in range(levels):
+        shape = (shape + 1) // 2
+    return tuple(shape)
+
+
+class _pyramid_stack:
+    # downsampled view of a stack, frames are reduced when they are accessed
+    def __init__(self, imgs, levels):
+        self.imgs = imgs
+        self.levels = levels
+
+    def __len__(self):
+        return len(self.imgs)
+
+    def __getitem__(self, i):
+        return _pyramid(self.imgs[i], self.levels)
+
+
+def _refine_shift(im1, im2, shift, radius, refine_size=512, upsample_factor=None,
+                  precision="double"):
+    # refine a coarse offset of im2 relative to im1 at full resolution:
+    # the overlap at the coarse offset is cropped to at most refine_size
+    # and the remaining offset is searched within +-radius
+    shift = np.round(shift).astype(int)
+    starts = np.zeros(2, dtype=int)
+    sizes = np.zeros(2, dtype=int)
+    for k in range(2):
+        overlap_start = max(shift[k], 0)
+        overlap_end = min(im1.shape[k], im2.shape[k] + shift[k])
+        length = overlap_end - overlap_start
+        if length <= 2 * radius + 1:
+            # too small overlap to refine
+            return shift, 0.0
+        sizes[k] = min(refine_size, length)
+        starts[k] = overlap_start + (length - sizes[k]) // 2
+
+    a = np.asarray(im1[starts[0] : starts[0] + sizes[0], starts[1] : starts[1] + sizes[1]])
+    b = np.asarray(
+        im2[
+            starts[0] - shift[0] : starts[0] - shift[0] + sizes[0],
+            starts[1] - shift[1] : starts[1] - shift[1] + sizes[1],
+        ]
+    )
+    # the crops are not periodic, a hanning window suppresses the edge artifacts
+    plan = _plan(sizes, window="hann", precision=precision)
+    G_a = plan.spectrum(a)
+    G_b = plan.spectrum(b)
+    pcm = plan.pcm(G_a, G_b)
+
+    # only residual offsets within +-radius are allowed
+    rows = np.r_[0 : radius + 1, sizes[0] - radius : sizes[0]]
+    cols = np.r_[0 : radius + 1, sizes[1] - radius : sizes[1]]
+    pos, value = max_from_2d(pcm[np.ix_(rows, cols)])
+    residual = np.array([rows[pos[0]], cols[pos[1]]])
+
+    if upsample_factor is not None:
+        R = plan.full_cross_power(G_a, G_b)
+        region = int(np.ceil(1.5 * upsample_factor))
+        upsampled, urows, ucols = _upsampled_dft(R, residual, upsample_factor, region)
+        fine, value = max_from_2d(upsampled)
+        residual = np.array([urows[fine[0]], ucols[fine[1]]])
+
+    residual = _unwrap_shift(residual, sizes, 0, 0)
+    return shift + residual, value
+
+
+def align_pyramid(
+    im1, im2, levels=2, refine_size=512, method="partial", upsample_factor=None,
+    precision="double"
+):
+    """
+    calculate the translational offset of image im2 relative to image im1
+    coarse-to-fine: the offset is estimated with align() on images downsampled
+    by 2**levels and then refined at full resolution, by a phase correlation
+    of a crop of at most refine_size x refine_size of the overlap, where only
+    residual offsets within +-2**levels pixels are considered.
+    For large images this is much faster than align(),
+    especially when the offset is small.
+
+    Args:
+        im1 (MxN array_like): 
+            first image.
+        
+        im2 (MxN array_like): 
+            second image.
+        
+        levels (int, optional): 
+            number of pyramid levels, each halving the resolution (cv2.pyrDown). 
+            Defaults to 2.
+        
+        refine_size (int, optional): 
+            maximum size of the overlap crop used for the refinement. 
+            Defaults to 512.
+        
+        method (str, optional): 
+            "partial" or "overlap", see align(). 
+            Defaults to "partial".
+        
+        upsample_factor (int, optional): 
+            if given, the refinement is subpixel precise with 1/upsample_factor pixel,
+            see align_dft_precise(). 
+            Defaults to None.
+        
+        precision (str, optional): 
+            "double" or "single", see align(). 
+            Defaults to "double".
+
+    Returns:
+        offset (array_like): 
+            containing two integers (or two floats with upsample_factor).
+
+    """
+    coarse = align(
+        _pyramid(im1, levels), _pyramid(im2, levels), method=method, precision=precision
+    )
+    shift, value = _refine_shift(
+        im1, im2, coarse * 2**levels, 2**levels, refine_size, upsample_factor, precision
+    )
+    return shift
+
 
 #%% stacks
-def stack_crop_shifts(stack,shifts):
+def stack_crop_shifts(stack,shifts,out=None):
+    """
+    crop an aligned stack (see stack_align()) on all sides by the total 
+    range of the shifts, so that only the region covered by every frame remains.
+
+    Args:
+        stack (KxMxN array_like): 
+            aligned stack.
+        
+        shifts (Kx2 array_like): 
+            shifts used for the alignment.
+        
+        out (array_like, optional): 
+            array with the shape of the cropped stack, e.g. a numpy array,
+            a np.memmap or a h5py dataset, to which the cropped frames are 
+            written one by one. 
+            Defaults to None, then a view of the stack is returned.
+
+    Returns:
+        res (array_like): 
+            the cropped stack (or out).
+
+    """
     delta=np.max(shifts,axis=0)-np.min(shifts,axis=0)
     delta=delta.astype(int)
-    if delta[0]==0:
-        res=stack[:,:,delta[1]:-delta[1]]
-    elif delta[1]==0:
-        res=stack[:,delta[0]:-delta[0],:]
-    else:        
-        res=stack[:,delta[0]:-delta[0],delta[1]:-delta[1]]
-    return res    
-
-def stack_shift_precise(imgs,delta=None,show=False,artifacts=None):
-    #img=imgs[0]
-    shifts=np.zeros([len(imgs),2])
-    for i in range(len(imgs)-1):
-        shifts[i+1]=align_com_precise(imgs[i],imgs[i+1],delta=delta,show=show,artifacts=artifacts)
+    size=stack.shape[1:]
+    rows=slice(delta[0],size[0]-delta[0])
+    cols=slice(delta[1],size[1]-delta[1])
+    if out is None:
+        return stack[:,rows,cols]
+    for i in range(len(stack)):
+        out[i]=stack[i][rows,cols]
+    return out    
+
+def _cached_pair_shift(spectra,imgs,i,j,method="partial",precise=False,delta=None,show=False,
+                       artifacts=None,subpixel="com",upsample_factor=100,levels=0,refine_size=512,
+                       precision="double"):
+    # shift of frame j relative to frame i, spectra is a spectrum_cache of imgs
+    # (of the downsampled frames for levels>0)
+    if levels>0:
+        # coarse shift from the downsampled frames, refined at full resolution
+        coarse=spectra.align(i,j,method=method)
+        shift,value=_refine_shift(imgs[i],imgs[j],coarse*2**levels,2**levels,
+                                  refine_size,upsample_factor if precise else None,precision)
+        return shift
+    if not precise:
+        return spectra.align(i,j,method=method)
+    pcm,(index0,index1)=spectra.align(i,j,_verbose=True,method=method)
+    if subpixel=="com":
+        return _com_precise_from_pcm(pcm,index0,index1,delta=delta,show=show,artifacts=artifacts)
+    R=spectra.cross_power(i,j)
+    return _dft_precise_from_pcm(pcm,R,index0,index1,upsample_factor,artifacts)
+
+def _pair_shifts(imgs,start,stop,**options):
+    # shifts of the consecutive pairs (i,i+1) for i in range(start,stop)
+    # the spectra of every frame are reused for both neighbouring pairs
+    if options.get("precise",False):
+        shifts=np.zeros([stop-start,2])
+    else:
+        shifts=np.zeros([stop-start,2],dtype=int)
+
+    levels=options.get("levels",0)
+    precision=options.get("precision","double")
+    if levels>0:
+        spectra=spectrum_cache(_pyramid_stack(imgs,levels),precision=precision)
+    else:
+        spectra=spectrum_cache(imgs,precision=precision)
+    for k,i in enumerate(range(start,stop)):
+        shifts[k]=_cached_pair_shift(spectra,imgs,i,i+1,**options)
+    return shifts
+
+
+def _pair_shifts_shared(name,shape,dtype,start,stop,options):
+    # worker of the process pool, the frames are read from shared memory
+    shm=shared_memory.SharedMemory(name=name)
+    try:
+        imgs=np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+        shifts=_pair_shifts(imgs,start,stop,**options)
+        del imgs
+    finally:
+        shm.close()
+    return shifts
+
+
+def _pair_blocks(npairs,workers):
+    bounds=np.linspace(0,npairs,min(workers,npairs)+1).astype(int)
+    return [(bounds[k],bounds[k+1]) for k in range(len(bounds)-1)]
+
+
+def _stack_pair_shifts(imgs,parallel=None,workers=None,**options):
+    # relative shifts of all consecutive pairs, first row is zero
+    npairs=len(imgs)-1
+    if options.get("precise",False):
+        shifts=np.zeros([len(imgs),2])
+    else:
+        shifts=np.zeros([len(imgs),2],dtype=int)
+    if npairs<1:
+        return shifts
+
+    if parallel is None:
+        shifts[1:]=_pair_shifts(imgs,0,npairs,**options)
+        return shifts
+
+    if workers is None:
+        workers=os.cpu_count()
+    blocks=_pair_blocks(npairs,workers)
+
+    if parallel=="thread":
+        with ThreadPoolExecutor(max_workers=len(blocks)) as executor:
+            futures=[executor.submit(_pair_shifts,imgs,start,stop,**options)
+                     for start,stop in blocks]
+            for (start,stop),future in zip(blocks,futures):
+                shifts[start+1:stop+1]=future.result()
+
+    elif parallel=="process":
+        frames=np.asarray(imgs)
+        shm=shared_memory.SharedMemory(create=True,size=max(frames.nbytes,1))
+        try:
+            shared=np.ndarray(frames.shape,dtype=frames.dtype,buffer=shm.buf)
+            shared[:]=frames
+            del shared
+            with ProcessPoolExecutor(max_workers=len(blocks)) as executor:
+                futures=[executor.submit(_pair_shifts_shared,shm.name,frames.shape,
+                                         frames.dtype,start,stop,options)
+                         for start,stop in blocks]
+                for (start,stop),future in zip(blocks,futures):
+                    shifts[start+1:stop+1]=future.result()
+        finally:
+            shm.close()
+            shm.unlink()
+    else:
+        raise ValueError("parallel must be None, 'thread' or 'process'")
+    return shifts
+
+
+def stack_shift_precise(imgs,delta=None,show=False,artifacts=None,method="partial",
+                        subpixel="com",upsample_factor=100,parallel=None,workers=None,
+                        levels=0,refine_size=512,precision="double"):
+    """
+    subpixel precise cumulative shifts of a stack of images,
+    determined between consecutive frames
+
+    Args:
+        imgs (KxMxN array_like or list of MxN array_likes): 
+            stack of images.
+        
+        delta (int, optional): 
+            half size of the center of mass region (subpixel "com"). 
+            Defaults to None.
+        
+        show (bool, optional): 
+            plot the center of mass region (subpixel "com"). 
+            Defaults to False.
+        
+        artifacts (float, optional): 
+            factor to suppress fixed pattern artifacts at zero offset. 
+            Defaults to None.
+        
+        method (str, optional): 
+            "partial" or "overlap", see align(). 
+            Defaults to "partial".
         
+        subpixel (str, optional): 
+            "com" for the center of mass of the periodically tiled phase
+            correlation (align_com_precise) or "dft" for upsampling the
+            phase correlation around its maximum (align_dft_precise).
+            Defaults to "com".
+        
+        upsample_factor (int, optional): 
+            precision of 1/upsample_factor pixel (subpixel "dft"). 
+            Defaults to 100.
+        
+        parallel (str, optional): 
+            None for serial execution, "thread" or "process" for distributing
+            the pair registrations over a pool of workers, see stack_shifting(). 
+            Defaults to None.
+        
+        workers (int, optional): 
+            number of workers. Defaults to None (number of cores).
+        
+        levels (int, optional): 
+            number of pyramid levels for a coarse-to-fine registration, see
+            align_pyramid(). The subpixel refinement then always uses the
+            upsampled DFT of the overlap crop. 
+            Defaults to 0 (registration at full resolution).
+        
+        refine_size (int, optional): 
+            maximum size of the overlap crop for the refinement (levels>0). 
+            Defaults to 512.
+        
+        precision (str, optional): 
+            "double" or "single" (float32/complex64 transforms), see align(). 
+            Defaults to "double".
+
+    Returns:
+        shifts (Kx2 array_like): 
+            cumulative shifts.
+
+    """
+    if subpixel not in ["com","dft"]:
+        raise ValueError("subpixel must be 'com' or 'dft'")
+    shifts=_stack_pair_shifts(imgs,parallel,workers,method=method,precise=True,
+                              delta=delta,show=show,artifacts=artifacts,
+                              subpixel=subpixel,upsample_factor=upsample_factor,
+                              levels=levels,refine_size=refine_size,precision=precision)
     return np.cumsum(shifts,axis=0)#shifts
 
-def stack_align_com_precise(imgs,shifts):
+def _translate_frame(img,out,shift):
+    # subpixel translation by shift (bicubic), outside of the frame is zero;
+    # cv2 would silently write into a copy of any other kind of out
+    if not (isinstance(out,np.ndarray) and out.dtype==np.uint16 and out.flags.c_contiguous):
+        raise ValueError("out must be a C-contiguous np.uint16 array")
+    matrix=np.array([[1,0,shift[1]],[0,1,shift[0]]],dtype=np.float64)
+    cv2.warpAffine(img_to_uint16(img),matrix,(out.shape[1],out.shape[0]),dst=out,
+                   flags=cv2.INTER_CUBIC,borderMode=cv2.BORDER_CONSTANT,borderValue=0)
 
+def stack_align_com_precise(imgs,shifts,out=None,workers=None):
+    """
+    place the frames of a stack according to their subpixel shifts 
+    (e.g. from stack_shift_precise()) in a common frame of reference.
+    The frames are converted with img_to_uint16() and translated with 
+    bicubic interpolation (cv2.warpAffine with a translation matrix).
+
+    Args:
+        imgs (list or array_like): 
+            frames of the stack.
+        
+        shifts (Kx2 array_like): 
+            subpixel shifts of the frames.
+        
+        out (KxM'xN' array, optional): 
+            C-contiguous np.uint16 array to which the translated frames are written,
+            M' and N' are the frame size increased by the rounded range of the shifts. 
+            Defaults to None.
+        
+        workers (int, optional): 
+            number of threads. Defaults to None (number of cores).
+
+    Returns:
+        res (list of M'xN' array_like): 
+            aligned frames (uint16), views of one KxM'xN' array,
+            or out itself if it is given.
+
+    """
     ma_sh=np.max(shifts,axis=0)
     mi_sh=np.min(shifts,axis=0)
     to_sh=ma_sh-mi_sh
@@ -413,71 +1444,381 @@ def stack_align_com_precise(imgs,shifts):
     
     size=np.array(imgs[0].shape,dtype=int)
     newsize=size+to_sh_int
- 
-    x, y = np.meshgrid(np.arange(newsize[1]), np.arange(newsize[0]))
-    
-    res=[]
+
+    if out is None:
+        res=np.zeros([len(imgs),newsize[0],newsize[1]],dtype=np.uint16)
+    else:
+        res=out
+        if not (isinstance(out,np.ndarray) and out.dtype==np.uint16 and out.flags.c_contiguous):
+            raise ValueError("out must be a C-contiguous np.uint16 array")
+        if out.shape!=(len(imgs),newsize[0],newsize[1]):
+            raise ValueError("out must have the shape "+str((len(imgs),*newsize)))
 
     nshifts = shifts- mi_sh
-    for i in range(len(imgs)):
-        newx=x-nshifts[i,1]
-        newy=y-nshifts[i,0]
+    # warpAffine releases the GIL, each frame is written to its own slice
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda i: _translate_frame(imgs[i],res[i],nshifts[i]),range(len(imgs))))
+    
+    if out is None:
+        return list(res)
+    return res
+
+def stack_shifting(imgs,method="partial",parallel=None,workers=None,levels=0,refine_size=512,
+                   cache=None,precision="double"):
+    """
+    integer cumulative shifts of a stack of images,
+    determined between consecutive frames with align()
+
+    The registrations of the consecutive pairs are independent, so they can
+    be distributed over several workers: the stack is split into contiguous
+    blocks of pairs, each processed with its own spectrum_cache, so the
+    result is identical to the serial execution.
+
+    Args:
+        imgs (KxMxN array_like or list of MxN array_likes): 
+            stack of images.
+        
+        method (str, optional): 
+            "partial" or "overlap", see align(). 
+            Defaults to "partial".
+        
+        parallel (str, optional): 
+            None for serial execution,
+            "thread" for a thread pool (FFTs and OpenCV release the GIL),
+            "process" for a process pool, which reads the frames from
+            shared memory. 
+            Defaults to None.
+        
+        workers (int, optional): 
+            number of workers. Defaults to None (number of cores).
+        
+        levels (int, optional): 
+            number of pyramid levels for a coarse-to-fine registration,
+            see align_pyramid(). 
+            Defaults to 0 (registration at full resolution).
+        
+        refine_size (int, optional): 
+            maximum size of the overlap crop for the refinement (levels>0). 
+            Defaults to 512.
+        
+        cache (registration_cache, optional): 
+            if given, the shifts are stored and taken from it for the same
+            frames and parameters. 
+            Defaults to None.
+        
+        precision (str, optional): 
+            "double" or "single" (float32/complex64 transforms), see align(). 
+            Defaults to "double".
+
+    Returns:
+        shifts (Kx2 array_like): 
+            cumulative shifts.
+
+    """
+    if cache is not None:
+        key=cache.key("stack_shifting",imgs,method=method,levels=levels,refine_size=refine_size,
+                      precision=precision)
+        cached=cache.load(key)
+        if cached is not None:
+            return cached["shifts"]
+    shifts=_stack_pair_shifts(imgs,parallel,workers,method=method,
+                              levels=levels,refine_size=refine_size,precision=precision)
+    shifts=np.cumsum(shifts,axis=0)
+    if cache is not None:
+        cache.save(key,shifts=shifts)
+    return shifts#shifts
+
+def stack_align_shape(imgs,shifts):
+    """
+    shape of the stack returned by stack_align(), e.g. to create 
+    an output array for it in advance.
+
+    Args:
+        imgs (list or array_like): 
+            frames of the stack.
         
+        shifts (Kx2 array_like): 
+            shifts of the frames.
+
+    Returns:
+        shape (tuple): 
+            (number of frames, rows, columns).
+
+    """
+    shifts=shifts.astype(int)
+    to_sh=np.max(shifts,axis=0)-np.min(shifts,axis=0)
+    size=imgs[0].shape
+    return (len(imgs),size[0]+to_sh[0],size[1]+to_sh[1])
 
-        tres=cv2.remap(img_to_uint16(imgs[i]), newx.astype(np.float32), 
-                       newy.astype(np.float32), 
-                          interpolation=cv2.INTER_CUBIC,
-                          borderValue= 0, borderMode=cv2.BORDER_CONSTANT)
+def stack_align(imgs,shifts,out=None,keep_dtype=False,crop=False):
+    """
+    place the frames of a stack according to their shifts 
+    in a common frame of reference, the uncovered areas are zero.
+
+    Args:
+        imgs (list or array_like): 
+            frames of the stack.
         
-        res.append(tres)
-    
-    return res
+        shifts (Kx2 array_like): 
+            shifts of the frames, e.g. from stack_shifting().
+        
+        out (array_like, optional): 
+            array with the shape stack_align_shape(imgs,shifts) to which 
+            the aligned frames are written one by one, e.g. a numpy array,
+            a np.memmap or a h5py dataset, so that the aligned stack 
+            does not need to fit into memory. Its dtype is used. 
+            Defaults to None.
+        
+        keep_dtype (bool, optional): 
+            if True, the returned stack has the dtype of the frames,
+            instead of float64. 
+            Defaults to False.
+        
+        crop (bool, optional): 
+            if True, nothing is copied and a list of views of the frames is
+            returned, restricted to the region covered by every frame. 
+            Defaults to False.
 
-def stack_shifting(imgs):
-    #img=imgs[0]
-    shifts=np.zeros([len(imgs),2],dtype=int)
-    for i in range(len(imgs)-1):
-        shifts[i+1]=align(imgs[i],imgs[i+1])
-    return np.cumsum(shifts,axis=0)#shifts
+    Returns:
+        new (array_like): 
+            aligned stack (out, if given) or list of views (crop=True).
 
-def stack_align(imgs,shifts):
+    """
     shifts=shifts.astype(int)
     ma_sh=np.max(shifts,axis=0)
     mi_sh=np.min(shifts,axis=0)
     to_sh=ma_sh-mi_sh
     
     size=imgs[0].shape
-    new=np.zeros([len(imgs),size[0]+to_sh[0],size[1]+to_sh[1]])
     nshifts = shifts-mi_sh
-    for i in range(len(imgs)):        
-        new[i,nshifts[i,0]:nshifts[i,0]+size[0],nshifts[i,1]:nshifts[i,1]+size[1]]=imgs[i]
+
+    if crop:
+        # the common region starts at to_sh in the aligned stack
+        starts=to_sh-nshifts
+        return [imgs[i][starts[i,0]:starts[i,0]+size[0]-to_sh[0],
+                        starts[i,1]:starts[i,1]+size[1]-to_sh[1]] for i in range(len(imgs))]
+
+    shape=stack_align_shape(imgs,shifts)
+    if out is None:
+        if keep_dtype:
+            new=np.zeros(shape,dtype=imgs[0].dtype)
+        else:
+            new=np.zeros(shape)
+    else:
+        new=out
+
+    if isinstance(new,np.ndarray):
+        for i in range(len(imgs)):
+            new[i]=0
+            new[i,nshifts[i,0]:nshifts[i,0]+size[0],nshifts[i,1]:nshifts[i,1]+size[1]]=imgs[i]
+    else:
+        # e.g. h5py datasets are written with a single call per frame
+        frame=np.zeros(shape[1:],dtype=new.dtype)
+        for i in range(len(imgs)):
+            frame[:]=0
+            frame[nshifts[i,0]:nshifts[i,0]+size[0],nshifts[i,1]:nshifts[i,1]+size[1]]=imgs[i]
+            new[i]=frame
     
     return new
 
+#%% drift_tracker
+class drift_tracker:
+    """
+    online registration of frames arriving one by one (e.g. during an
+    in-situ acquisition): every new frame is aligned to the previous one like
+    in stack_shifting() (or stack_shift_precise()), and the cumulative shift
+    relative to the first frame is returned immediately.
+    Only the previous frame and the current keyframe are kept, so memory and
+    time per frame are constant. Every keyframe_interval frames the new frame is
+    aligned to the keyframe instead and becomes the next keyframe, which limits
+    the accumulation of the errors of the consecutive registrations.
+    """
+
+    def __init__(self, keyframe_interval=None, method="partial", precise=False,
+                 delta=None, subpixel="com", upsample_factor=100, levels=0, refine_size=512,
+                 precision="double"):
+        """
+        Args:
+            keyframe_interval (int, optional): 
+                number of frames between two keyframes. 
+                Defaults to None (only consecutive frames are aligned).
+            
+            method (str, optional): 
+                "partial" or "overlap", see align(). 
+                Defaults to "partial".
+            
+            precise (bool, optional): 
+                subpixel precise shifts, see stack_shift_precise(). 
+                Defaults to False.
+            
+            delta (int, optional): 
+                see align_com_precise(). Defaults to None.
+            
+            subpixel (str, optional): 
+                "com" or "dft", see stack_shift_precise(). 
+                Defaults to "com".
+            
+            upsample_factor (int, optional): 
+                see align_dft_precise(). Defaults to 100.
+            
+            levels (int, optional): 
+                pyramid levels, see align_pyramid(). Defaults to 0.
+            
+            refine_size (int, optional): 
+                see align_pyramid(). Defaults to 512.
+            
+            precision (str, optional): 
+                "double" or "single", see align(). Defaults to "double".
+
+        """
+        if subpixel not in ["com","dft"]:
+            raise ValueError("subpixel must be 'com' or 'dft'")
+        self.keyframe_interval = keyframe_interval
+        self.options = dict(method=method, precise=precise, delta=delta,
+                            subpixel=subpixel, upsample_factor=upsample_factor,
+                            levels=levels, refine_size=refine_size, precision=precision)
+        self.count = 0
+        self.shifts = []
+        # frames by their index, only the previous frame and the keyframe are kept
+        self._frames = dict()
+        if levels > 0:
+            self._spectra = spectrum_cache(
+                _pyramid_stack(self._frames, levels), maxsize=3, precision=precision
+            )
+        else:
+            self._spectra = spectrum_cache(self._frames, maxsize=3, precision=precision)
+        self._keyframe = None
+
+    def _shift(self, i, j):
+        return _cached_pair_shift(self._spectra, self._frames, i, j, **self.options)
+
+    def update(self, frame):
+        """
+        register the next frame
+
+        Args:
+            frame (MxN array_like): 
+                new frame, with the shape of the first frame.
+
+        Returns:
+            shift (array_like): 
+                cumulative shift of the frame relative to the first frame.
+
+        """
+        i = self.count
+        self._frames[i] = frame
+        if i == 0:
+            if self.options["precise"]:
+                shift = np.zeros(2)
+            else:
+                shift = np.zeros(2, dtype=int)
+            self._keyframe = 0
+        elif self.keyframe_interval is not None and i % self.keyframe_interval == 0:
+            shift = self.shifts[self._keyframe] + self._shift(self._keyframe, i)
+            self._keyframe = i
+        else:
+            shift = self.shifts[i - 1] + self._shift(i - 1, i)
+        self.shifts.append(shift)
+        self.count += 1
+
+        for k in list(self._frames):
+            if k not in (i, self._keyframe):
+                del self._frames[k]
+        return shift
+
+    def track(self, frames):
+        """
+        generator of the cumulative shifts of the frames of an iterable,
+        e.g. an acquisition stream
+
+        Args:
+            frames (iterable of MxN array_like): 
+                new frames.
+
+        Yields:
+            shift (array_like): 
+                cumulative shift of each frame relative to the first frame.
+
+        """
+        for frame in frames:
+            yield self.update(frame)
+
+
 #%% fine_tuning_shifts (real space align)
-def fine_tuning_shifts(aligned_stack,delta=4):
-    stack=np.zeros([aligned_stack.shape[0],aligned_stack.shape[1]+1,aligned_stack.shape[2]+1],dtype=np.int16)
-    for i in range(len(stack)):
+def _fine_tuning_square(img):
+    # squared contrast of a frame in float to avoid the overflow of int16 products,
+    # converted from a copy, as img_to_half_int16 modifies its input
+    return img_to_half_int16(np.array(img)).astype(np.float64)**2
+
+
+def _fine_tuning_surface(a,b,delta,engine="fft"):
+    # correlation of the squared images a and b (see _fine_tuning_square)
+    # for all offsets within +-delta:
+    # surface[j,k]=sum(a[delta:-delta,delta:-delta] * b[j:j+h,k:k+w])
+    size=a.shape
+    h=size[0]-2*delta
+    w=size[1]-2*delta
+    a=a[delta:delta+h,delta:delta+w]
+    N=2*delta+1
+
+    if engine=="loop":
+        surface=np.zeros([N,N])
+        for j in range(N):
+            for k in range(N):
+                surface[j,k]=np.sum(a*b[j:j+h,k:k+w])
+        return surface
+
+    # circular cross-correlation at the full size, the offsets 0..2*delta
+    # do not wrap around, because the cropped image is padded with zeros
+    G_a=np.fft.rfft2(a,s=size)
+    G_b=np.fft.rfft2(b)
+    correlation=np.fft.irfft2(np.conj(G_a)*G_b,s=size)
+    return correlation[:N,:N]
+
+def fine_tuning_shifts(aligned_stack,delta=4,engine="fft",workers=None):
+    """
+    integer cumulative corrections of the shifts of an already aligned stack,
+    from the maximum of the real space correlation of the squared 
+    consecutive frames within +-delta pixels.
+
+    Args:
+        aligned_stack (KxMxN array_like): 
+            aligned stack, e.g. from stack_align().
+        
+        delta (int, optional): 
+            maximum correction between consecutive frames. 
+            Defaults to 4.
+        
+        engine (str, optional): 
+            "fft" computes the correlations for all offsets at once 
+            with a single cross-correlation, "loop" sums up every offset 
+            separately. 
+            Defaults to "fft".
+        
+        workers (int, optional): 
+            number of threads for the frame pairs. 
+            Defaults to None (number of cores).
 
-        stack[i,:-1,:-1]=img_to_half_int16(aligned_stack[i])
-        
-    changes=np.zeros([2*delta+1,2*delta+1])
-    shifts=np.zeros([len(stack),2],dtype=int)
-
-    deltarange=np.arange(-delta,delta+1,1)
-    Nd=len(deltarange)
-    for i in range(len(stack)-1):
-        img0=stack[i][delta:-delta-1,delta:-delta-1]
-        for j in range(Nd):
-            deltaj=deltarange[j]
-            for k in range(Nd):
-                deltak=deltarange[k]
-                #least squares
-                #changes[j,k]=np.sum((img0-stack[i+1][delta+deltaj:-(delta-deltaj)-1,delta+deltak:-(delta-deltak)-1])**2)
-                #correlation
-                changes[j,k]=-np.sum((img0*stack[i+1][delta+deltaj:-(delta-deltaj)-1,delta+deltak:-(delta-deltak)-1])**2)
-        idx0,idx1=np.where(changes==np.min(changes))
-        shifts[i]=idx0[0],idx1[0]
+    Returns:
+        shifts (Kx2 array_like): 
+            cumulative corrections.
+
+    """
+    if engine not in ["fft","loop"]:
+        raise ValueError("engine must be 'fft' or 'loop'")
+    shifts=np.zeros([len(aligned_stack),2],dtype=int)
+
+    def pair(i):
+        surface=_fine_tuning_surface(squares[i],squares[i+1],delta,engine)
+        idx0,idx1=np.where(surface==np.max(surface))
+        return idx0[0],idx1[0]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # every frame is converted once into a private copy, before the pairs,
+        # which share frames, are processed; aligned_stack is not modified
+        squares=list(pool.map(lambda i:_fine_tuning_square(aligned_stack[i]),range(len(aligned_stack))))
+        for i,idx in enumerate(pool.map(pair,range(len(aligned_stack)-1))):
+            shifts[i]=idx
     shifts+= -delta
     return -np.cumsum(shifts,axis=0)
 
@@ -486,7 +1827,8 @@ def fine_tuning_shifts(aligned_stack,delta=4):
 #%% pos_from_pcm
 
 
-def _pos_from_pcm(pcm, overlap_limits, mode, tolerance, imdim, rdrift, cdrift):
+def _pcm_window(overlap_limits, mode, imdim, rdrift, cdrift):
+    # rows and columns of the PCM, in which the relative position is searched
     rwidth = overlap_limits[0, 1] - overlap_limits[0, 0]
     cwidth = overlap_limits[1, 1] - overlap_limits[1, 0]
 
@@ -502,20 +1844,407 @@ def _pos_from_pcm(pcm, overlap_limits, mode, tolerance, imdim, rdrift, cdrift):
         rstart = -rwidth // 2 + rdrift
         rend = rwidth // 2 + rdrift
 
-    rows = np.arange(rstart, rend, dtype=int)
-    cols = np.arange(cstart, cend, dtype=int)
-    rowgrid, colgrid = np.meshgrid(rows, cols)
+    rows = np.arange(rstart, rend, dtype=int)
+    cols = np.arange(cstart, cend, dtype=int)
+    return rows, cols
+
+
+def _peak_in_window(pcm, rows, cols):
+    rowgrid, colgrid = np.meshgrid(rows, cols)
+
+    roipcm = pcm[rowgrid, colgrid]
+
+    dist = np.argmax(roipcm)
+    roidist1 = dist % roipcm.shape[1]
+    roidist0 = dist // roipcm.shape[1]
+
+    dist0 = rowgrid[roidist0, roidist1]
+    dist1 = colgrid[roidist0, roidist1]
+
+    return dist0, dist1, pcm[dist0, dist1]
+
+
+# maximum of a phase correlation matrix within a search window,
+# its value (score) and the 3x3 neighbourhood of the maximum
+pcm_peak_dtype = np.dtype(
+    [
+        ("dy", np.int64),
+        ("dx", np.int64),
+        ("score", np.float64),
+        ("neighbourhood", np.float64, (3, 3)),
+    ]
+)
+
+
+def _pcm_peak(pcm, rows, cols, blur=0):
+    if blur != 0:
+        pcm = cv2.blur(pcm, (blur, blur))
+    dist0, dist1, score = _peak_in_window(pcm, rows, cols)
+    peak = np.zeros((), dtype=pcm_peak_dtype)
+    peak["dy"] = dist0
+    peak["dx"] = dist1
+    peak["score"] = score
+    around = np.arange(-1, 2)
+    peak["neighbourhood"] = pcm[
+        np.ix_((dist0 + around) % pcm.shape[0], (dist1 + around) % pcm.shape[1])
+    ]
+    return peak
+
+
+#%% stitching edges
+
+# sparse representation of the relative tile positions:
+# tile j is placed at (dy,dx) relative to tile i, score is the value of
+# the phase correlation maximum
+stitching_edge_dtype = np.dtype(
+    [
+        ("i", np.int64),
+        ("j", np.int64),
+        ("dy", np.float64),
+        ("dx", np.float64),
+        ("score", np.float64),
+    ]
+)
+
+
+def _grid_pairs(number_of_images, tile_dimensions):
+    # right and bottom neighbours of each tile, in the order of the montage
+    pairs = []
+    for i in range(number_of_images - 1):
+        if (i + 1) % tile_dimensions[1] != 0:  # no right neighbour at the end of a row
+            j = i + 1  # j is the image right
+            if j < number_of_images:
+                pairs.append((i, j, "horizontal"))
+        if i < (tile_dimensions[0] - 1) * tile_dimensions[1]:  # no bottom neighbours in the last row
+            j = i + tile_dimensions[1]  # j is the image below
+            if j < number_of_images:
+                pairs.append((i, j, "vertical"))
+    return pairs
+
+
+def _grid_neighbours(number_of_images, tile_dimensions):
+    neighbours = [[] for i in range(number_of_images - 1)]
+    for i, j, direction in _grid_pairs(number_of_images, tile_dimensions):
+        neighbours[i].append(j)
+    return neighbours
+
+
+def _edges_to_dense(edges, number_of_tiles):
+    positions = np.zeros([number_of_tiles, number_of_tiles, 2])
+    pos_pcms = np.zeros([number_of_tiles, number_of_tiles])
+    positions[edges["i"], edges["j"], 0] = edges["dy"]
+    positions[edges["i"], edges["j"], 1] = edges["dx"]
+    positions[edges["j"], edges["i"], 0] = edges["dy"]
+    positions[edges["j"], edges["i"], 1] = edges["dx"]
+    pos_pcms[edges["i"], edges["j"]] = edges["score"]
+    pos_pcms[edges["j"], edges["i"]] = edges["score"]
+    return positions, pos_pcms
+
+
+def _dense_to_edges(positions, neighbours, pos_pcms):
+    pairs = [(i, j) for i in range(len(neighbours)) for j in neighbours[i]]
+    edges = np.zeros(len(pairs), dtype=stitching_edge_dtype)
+    for k, (i, j) in enumerate(pairs):
+        edges[k] = i, j, positions[i, j, 0], positions[i, j, 1], pos_pcms[i, j]
+    return edges
+
+
+#%% pairwise_pcm_store
+def _stitching_masks(imdim, overlap_rows_cols, ignore_montage_edges):
+    # mask areas far from the overlap, to ensure that even if the side opposite to the stitching edge
+    # looks similar, the stitching happens on the right side of the image
+    masks = dict()
+    masks["up"] = np.ones(imdim)
+    masks["down"] = np.ones(imdim)
+    masks["left"] = np.ones(imdim)
+    masks["right"] = np.ones(imdim)
+    masks["up"][: int(imdim[0] - 2 * overlap_rows_cols[0] * imdim[0]), :] = 0
+    masks["down"][int(2 * overlap_rows_cols[0] * imdim[0]) :, :] = 0
+    masks["left"][:, : int(imdim[1] - 2 * overlap_rows_cols[1] * imdim[1])] = 0
+    masks["right"][:, int(2 * overlap_rows_cols[1] * imdim[1]) :] = 0
+
+    masks["edgeright"] = np.ones(imdim)
+    masks["edgeup"] = np.ones(imdim)
+    if ignore_montage_edges != 0:
+        masks["edgeright"][:, -int(ignore_montage_edges * imdim[1]) :] = 0
+        masks["edgeup"][: int(ignore_montage_edges * imdim[0]), :] = 0
+    return masks
+
+
+def _stitching_mask_names(i, direction, tile_dimensions, ignore_montage_edges):
+    # names of the masks applied to the tiles i and j of a neighbouring pair
+    if direction == "vertical":
+        names_i, names_j = ["up"], ["down"]
+        if ignore_montage_edges != 0 and (i + 1) % tile_dimensions[1] == 0:  # last image of a row
+            names_i.append("edgeright")
+            names_j.append("edgeright")
+    else:
+        names_i, names_j = ["left"], ["right"]
+        if ignore_montage_edges != 0 and i < tile_dimensions[1]:  # first row
+            names_i.append("edgeup")
+            names_j.append("edgeup")
+    return tuple(names_i), tuple(names_j)
+
+
+class pairwise_pcm_store:
+    """
+    store of the phase correlations of neighbouring tiles, shared by repeated
+    passes over a grid (e.g. drift_correction() followed by
+    relative_stitching_positions() with the drifts), so that every tile is
+    Fourier transformed and every pair is correlated only once.
+    In a store the tiles are correlated without the stitching masks:
+    one spectrum per tile (and pyramid level) serves all of its pairs and
+    both passes, the masks are applied after the lookup by the search window,
+    which only admits positions with the expected overlap.
+    Per pair only a band of the phase correlation matrix (PCM) around the
+    first search window is kept, wide enough for every window shifted by
+    up to half its size (the range of the drifts of drift_correction()),
+    never the whole PCM. Searches outside of the band correlate the pair again.
+    drift_correction() records its drifts in the store, which
+    relative_stitching_positions() uses, if no drifts are given.
+    A store belongs to one list of images.
+    """
+
+    def __init__(self, path=None, max_spectra=16, max_bytes=2**28):
+        """
+        Args:
+            path (str, optional): 
+                h5 file, in which the bands are kept (persistent backend),
+                an existing file is reused. The file stays open until close()
+                is called (or the store is used as context manager). 
+                Defaults to None (bands are kept in memory).
+            
+            max_spectra (int, optional): 
+                maximum number of tile spectra kept in memory, least recently used
+                spectra are removed first. For a grid processed row by row,
+                twice the number of columns is sufficient to transform every 
+                tile only once per pass; pairs found in the bands need no spectra. 
+                Defaults to 16.
+            
+            max_bytes (int, optional): 
+                maximum total size of the bands kept in memory (in-memory backend),
+                least recently used bands are removed first. 
+                Defaults to 2**28.
+
+        """
+        self.path = path
+        self.max_spectra = max(int(max_spectra), 2)
+        self.max_bytes = max_bytes
+        self.transforms = 0
+        self.drifts = None
+        self._spectra = OrderedDict()
+        self._bands = OrderedDict()
+        self._bytes = 0
+        self._h5 = None
+        if path is not None:
+            self._h5 = h5py.File(path, "a")
+
+    def close(self):
+        """
+        close the h5 file of the store
+        """
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _name(key):
+        # stable name of a key in the h5 file
+        return "band_" + hashlib.blake2b(repr(key).encode(), digest_size=12).hexdigest()
+
+    def _load(self, key):
+        # (first row, first column, band) or None
+        if self._h5 is None:
+            if key in self._bands:
+                self._bands.move_to_end(key)
+            return self._bands.get(key)
+        name = self._name(key)
+        if name in self._h5:
+            dataset = self._h5[name]
+            return int(dataset.attrs["row"]), int(dataset.attrs["col"]), dataset[()]
+        return None
+
+    def _save(self, key, band):
+        if self._h5 is None:
+            if key in self._bands:
+                self._bytes -= self._bands.pop(key)[2].nbytes
+            self._bands[key] = band
+            self._bytes += band[2].nbytes
+            while len(self._bands) > 1 and self._bytes > self.max_bytes:
+                self._bytes -= self._bands.popitem(last=False)[1][2].nbytes
+            return
+        name = self._name(key)
+        if name in self._h5:
+            del self._h5[name]
+        dataset = self._h5.create_dataset(name, data=band[2])
+        dataset.attrs["row"] = band[0]
+        dataset.attrs["col"] = band[1]
+        dataset.attrs["key"] = repr(key)
+
+    def spectrum(self, i, levels, prepare):
+        """
+        Fourier transform of tile i
+
+        Args:
+            i (int): 
+                index of the tile.
+            
+            levels (int): 
+                pyramid level of the tile.
+            
+            prepare (function): 
+                returns the (downsampled) tile i, only called if the spectrum
+                is not stored.
+
+        Returns:
+            G (Mx(N//2+1) array_like): 
+                complex real-input spectrum (see correlation_plan).
 
-    roipcm = pcm[rowgrid, colgrid]
+        """
+        return self._spectrum(i, levels, prepare)[1]
 
-    dist = np.argmax(roipcm)
-    roidist1 = dist % roipcm.shape[1]
-    roidist0 = dist // roipcm.shape[1]
+    def _spectrum(self, i, levels, prepare):
+        # (shape of the tile, spectrum)
+        if (i, levels) in self._spectra:
+            self._spectra.move_to_end((i, levels))
+        else:
+            img = prepare()
+            self._spectra[(i, levels)] = (np.shape(img), _spectrum(img))
+            self.transforms += 1
+            while len(self._spectra) > self.max_spectra:
+                self._spectra.popitem(last=False)
+        return self._spectra[(i, levels)]
+
+    def peak(self, i, j, levels, prepare_i, prepare_j, rows, cols, blur=0):
+        """
+        maximum of the phase correlation matrix of the tiles i and j,
+        i.e. of phase_correlation(prepare_i(), prepare_j()),
+        within the search window rows x cols
+
+        Args:
+            i (int): 
+                index of the first tile.
+            
+            j (int): 
+                index of the second tile.
+            
+            levels (int): 
+                pyramid level of the tiles.
+            
+            prepare_i (function): 
+                returns the (downsampled) tile i.
+            
+            prepare_j (function): 
+                returns the (downsampled) tile j.
+            
+            rows (array_like): 
+                consecutive rows of the search window (negative rows wrap around).
+            
+            cols (array_like): 
+                consecutive columns of the search window.
+            
+            blur (int, optional): 
+                size of a box filter applied to the PCM before the search. 
+                Defaults to 0.
+
+        Returns:
+            peak (pcm_peak_dtype): 
+                position (dy,dx) and value (score) of the maximum and its 
+                3x3 neighbourhood.
+
+        """
+        key = (i, j, levels, blur)
+        band = self._load(key)
+        if band is None or not _band_covers(band, rows, cols):
+            shape, G_i = self._spectrum(i, levels, prepare_i)
+            G_j = self._spectrum(j, levels, prepare_j)[1]
+            pcm = _pcm_from_spectra(G_i, G_j, shape)
+            if blur != 0:
+                pcm = cv2.blur(pcm, (blur, blur))
+            band = _pcm_band(pcm, rows, cols)
+            self._save(key, band)
+        return _band_peak(band, rows, cols)
+
+
+def _pcm_band(pcm, rows, cols):
+    # rows and columns of the PCM around the search window, extended by half
+    # the window (and the neighbourhood of the maximum) on every side
+    row = int(rows[0]) - len(rows) // 2 - 2
+    col = int(cols[0]) - len(cols) // 2 - 2
+    band_rows = np.arange(row, int(rows[-1]) + len(rows) // 2 + 3)
+    band_cols = np.arange(col, int(cols[-1]) + len(cols) // 2 + 3)
+    band = pcm[np.ix_(band_rows % pcm.shape[0], band_cols % pcm.shape[1])]
+    return row, col, band
+
+
+def _band_covers(band, rows, cols):
+    row, col, values = band
+    return (
+        rows[0] - 1 >= row
+        and rows[-1] + 2 <= row + values.shape[0]
+        and cols[0] - 1 >= col
+        and cols[-1] + 2 <= col + values.shape[1]
+    )
 
-    dist0 = rowgrid[roidist0, roidist1]
-    dist1 = colgrid[roidist0, roidist1]
 
-    return dist0, dist1, pcm[dist0, dist1]
+def _band_peak(band, rows, cols):
+    # as _pcm_peak on the PCM, of which band holds the search window
+    row, col, values = band
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    dist0, dist1, score = _peak_in_window(values, rows - row, cols - col)
+    peak = np.zeros((), dtype=pcm_peak_dtype)
+    peak["dy"] = dist0 + row
+    peak["dx"] = dist1 + col
+    peak["score"] = score
+    peak["neighbourhood"] = values[dist0 - 1 : dist0 + 2, dist1 - 1 : dist1 + 2]
+    return peak
+
+
+def _masked_tile(img, names, masks):
+    # the product of the masks is created once per combination of names and
+    # added to masks, which belongs to a single call (see _stitching_masks)
+    if len(names) == 0:
+        return img
+    if names not in masks:
+        mask = masks[names[0]]
+        for name in names[1:]:
+            mask = mask * masks[name]
+        masks[names] = mask
+    return img * masks[names]
+
+
+def _stitching_peak(
+    images, i, j, names_i, names_j, masks, levels, store, rows, cols, blur=0
+):
+    # maximum of the phase correlation of the masked (and downsampled) tiles
+    # i and j within the search window; in a store the tiles are not masked
+    # (see pairwise_pcm_store)
+    def prepare(k, names):
+        img = _masked_tile(images[k], names, masks)
+        if levels > 0:
+            img = _pyramid(img, levels)
+        return img
+
+    if store is None:
+        pcm = phase_correlation(prepare(i, names_i), prepare(j, names_j))
+        return _pcm_peak(pcm, rows, cols, blur)
+    return store.peak(
+        i,
+        j,
+        levels,
+        lambda: prepare(i, ()),
+        lambda: prepare(j, ()),
+        rows,
+        cols,
+        blur,
+    )
 
 
 #%% relative_stitching_positions
@@ -525,15 +2254,59 @@ def relative_stitching_positions(
     overlap_rows_cols=[0.25, 0.25],
     tolerance=0.1,
     ignore_montage_edges=0,
-    drifts=[[0, 0], [0, 0]],
+    drifts=None,
     blur=0,
+    sparse=False,
+    levels=0,
+    refine_size=512,
+    store=None,
+    cache=None,
 ):
     # images: list of images as a series of rows from top to bottom and within the row from left to right
     # tile_dimensions: tuple consisting of first number of rows and second number of columns
     # overlap: tuple of values between 0.0 and 1.0 indicating the expected relative overlap of pictures
     # tolerance: relative allowed deviation from the expected overlap
+    # sparse: return the relative positions as edge list (array with dtype stitching_edge_dtype)
+    #         and the neighbours, instead of the dense positions, neighbours and pos_pcms
+    # levels: number of pyramid levels, the positions are searched on images downsampled by 2**levels
+    #         and refined at full resolution within +-2**levels pixels on a crop of the overlap
+    #         of at most refine_size x refine_size (see align_pyramid)
+    # drifts: systematic offsets [[row,col] of a move right, [row,col] of a move down],
+    #         e.g. from drift_correction. Defaults to None, then the drifts recorded by
+    #         drift_correction in store are used, if there are any, otherwise no drifts
+    # store: pairwise_pcm_store, to reuse the tile spectra and phase correlations of
+    #        drift_correction or an earlier call. In a store the tiles are correlated without
+    #        the masks (see pairwise_pcm_store), the search windows keep the overlap side
+    # cache: registration_cache, the relative positions are stored and taken from it
+    #        for the same images and parameters
     # note: all images should have the same resolution
 
+    if drifts is None:
+        if store is not None and store.drifts is not None:
+            drifts = store.drifts
+        else:
+            drifts = [[0, 0], [0, 0]]
+    drifts = np.asarray(drifts, dtype=float).tolist()
+
+    if cache is not None:
+        cache_key = cache.key(
+            "relative_stitching_positions",
+            images,
+            tile_dimensions=tile_dimensions,
+            overlap_rows_cols=overlap_rows_cols,
+            tolerance=tolerance,
+            ignore_montage_edges=ignore_montage_edges,
+            drifts=drifts,
+            blur=blur,
+            levels=levels,
+            refine_size=refine_size,
+        )
+        cached = cache.load(cache_key)
+        if cached is not None:
+            return _stitching_positions_result(
+                cached["edges"], len(images), tile_dimensions, sparse
+            )
+
     imdim = images[0].shape
     overlap_limits = np.zeros([2, 2])
     overlap_limits[0, 0] = imdim[0] * (overlap_rows_cols[0] - tolerance)
@@ -541,191 +2314,206 @@ def relative_stitching_positions(
     overlap_limits[1, 0] = imdim[1] * (overlap_rows_cols[1] - tolerance)
     overlap_limits[1, 1] = imdim[1] * (overlap_rows_cols[1] + tolerance)
 
-    mask_edgeright = np.ones(imdim)
-    mask_edgeup = np.ones(imdim)
-    if ignore_montage_edges != 0:
-        mask_edgeright[:, -int(ignore_montage_edges * imdim[1]) :] = 0
-        mask_edgeup[: int(ignore_montage_edges * imdim[0]), :] = 0
+    masks = _stitching_masks(imdim, overlap_rows_cols, ignore_montage_edges)
+
+    pairs = _grid_pairs(len(images), tile_dimensions)
+    edges = np.zeros(len(pairs), dtype=stitching_edge_dtype)
 
-    # mask areas far from the overlap, to ensure that even if the side opposite to the stitching edge
-    # looks similar, the stitching happens on the right side of the image
-    maskleft = np.ones(imdim)
-    maskright = np.ones(imdim)
-    maskup = np.ones(imdim)
-    maskdown = np.ones(imdim)
-    maskup[: int(imdim[0] - 2 * overlap_rows_cols[0] * imdim[0]), :] = 0
-    maskdown[int(2 * overlap_rows_cols[0] * imdim[0]) :, :] = 0
-    maskleft[:, : int(imdim[1] - 2 * overlap_rows_cols[1] * imdim[1])] = 0
-    maskright[:, int(2 * overlap_rows_cols[1] * imdim[1]) :] = 0
-
-    positions = np.zeros(
-        [
-            tile_dimensions[0] * tile_dimensions[1],
-            tile_dimensions[0] * tile_dimensions[1],
-            2,
-        ]
-    )
-    pos_pcms = np.zeros(
-        [
-            tile_dimensions[0] * tile_dimensions[1],
-            tile_dimensions[0] * tile_dimensions[1],
-        ]
-    )
-    neighbours = []
     # loop checks for each image the relative position of its right and bottom neighour
     # via the maximum of the phase-correlation-matrix (PCM)
-    for i in range(len(images) - 1):
-        neighbours.append([])
-        if (i + 1) % tile_dimensions[1] == 0:  # no right neighbour at the end of a row
-            # if i%tile_dimensions[1]==0:
-            if (
-                i < (tile_dimensions[0] - 1) * tile_dimensions[1]
-            ):  # no bottom neighbours in the last row
-                j = i + tile_dimensions[1]  # j is the image below
-                if j < len(images):
-                    neighbours[i].append(j)
-                    pcm = phase_correlation(
-                        images[i] * maskup * mask_edgeright,
-                        images[j] * maskdown * mask_edgeright,
-                    )
-                    if blur != 0:
-                        pcm = cv2.blur(pcm, (blur, blur))
-                    dist0, dist1, pcms = _pos_from_pcm(
-                        pcm,
-                        overlap_limits,
-                        "vertical",
-                        tolerance,
-                        imdim,
-                        drifts[1][0],
-                        drifts[1][1],
-                    )
-                    positions[i, j] = dist0, dist1
-                    positions[j, i] = dist0, dist1
-                    pos_pcms[i, j] = pcms
-                    pos_pcms[j, i] = pcms
-
+    for k, (i, j, direction) in enumerate(pairs):
+        if direction == "vertical":
+            drift = drifts[1]
         else:
-            j = i + 1  # j is the image right
-            if j < len(images):
-                neighbours[i].append(j)
-                if i < tile_dimensions[1]:
-                    pcm = phase_correlation(
-                        images[i] * maskleft * mask_edgeup,
-                        images[j] * maskright * mask_edgeup,
-                    )
-                    if blur != 0:
-                        pcm = cv2.blur(pcm, (blur, blur))
-                else:
-                    pcm = phase_correlation(images[i] * maskleft, images[j] * maskright)
-                    if blur != 0:
-                        pcm = cv2.blur(pcm, (blur, blur))
-                dist0, dist1, pcms = _pos_from_pcm(
-                    pcm,
-                    overlap_limits,
-                    "horizontal",
-                    tolerance,
-                    imdim,
-                    drifts[0][0],
-                    drifts[0][1],
-                )
-                positions[i, j] = dist0, dist1
-                positions[j, i] = dist0, dist1
-                pos_pcms[i, j] = pcms
-                pos_pcms[j, i] = pcms
-
-            if i < (tile_dimensions[0] - 1) * tile_dimensions[1]:
-                j = i + tile_dimensions[1]  # j is the image below
-                if j < len(images):
-                    neighbours[i].append(j)
-                    pcm = phase_correlation(images[i] * maskup, images[j] * maskdown)
-                    if blur != 0:
-                        pcm = cv2.blur(pcm, (blur, blur))
-
-                    dist0, dist1, pcms = _pos_from_pcm(
-                        pcm,
-                        overlap_limits,
-                        "vertical",
-                        tolerance,
-                        imdim,
-                        drifts[1][0],
-                        drifts[1][1],
-                    )
-                    positions[i, j] = dist0, dist1
-                    positions[j, i] = dist0, dist1
-                    pos_pcms[i, j] = pcms
-                    pos_pcms[j, i] = pcms
+            drift = drifts[0]
+        names_i, names_j = _stitching_mask_names(
+            i, direction, tile_dimensions, ignore_montage_edges
+        )
 
+        # coarse search on the downsampled images, if levels>0
+        factor = 2**levels
+        rows, cols = _pcm_window(
+            overlap_limits / factor,
+            direction,
+            _pyramid_shape(imdim, levels),
+            drift[0] / factor,
+            drift[1] / factor,
+        )
+        peak = _stitching_peak(
+            images, i, j, names_i, names_j, masks, levels, store, rows, cols, blur
+        )
+        dist0, dist1, pcms = peak["dy"], peak["dx"], peak["score"]
+        if levels > 0:
+            (dist0, dist1), value = _refine_shift(
+                _masked_tile(images[i], names_i, masks),
+                _masked_tile(images[j], names_j, masks),
+                np.array([dist0, dist1]) * factor,
+                factor,
+                refine_size,
+            )
+        edges[k] = i, j, dist0, dist1, pcms
+
+    if cache is not None:
+        cache.save(cache_key, edges=edges)
+    return _stitching_positions_result(edges, len(images), tile_dimensions, sparse)
+
+
+def _stitching_positions_result(edges, number_of_images, tile_dimensions, sparse):
+    neighbours = _grid_neighbours(number_of_images, tile_dimensions)
+    if sparse:
+        return edges, neighbours
+
+    positions, pos_pcms = _edges_to_dense(
+        edges, tile_dimensions[0] * tile_dimensions[1]
+    )
     return positions, neighbours, pos_pcms
 
 
 #%% absolute_stitching_positions
+def _global_positions(edges, number_of_tiles, outlier_threshold=None, iterations=20):
+    # weighted least squares fit of all tile positions p, so that
+    # p[j]-p[i] matches (dy,dx) of every edge, using the normal equations
+    # of the sparse incidence matrix of the neighbour graph
+    number_of_edges = len(edges)
+    rows = np.repeat(np.arange(number_of_edges), 2)
+    cols = np.stack([edges["i"], edges["j"]], axis=1).ravel()
+    data = np.tile([-1.0, 1.0], number_of_edges)
+    incidence = scipy.sparse.csr_matrix(
+        (data, (rows, cols)), shape=(number_of_edges, number_of_tiles)
+    )
+    relative = np.stack([edges["dy"], edges["dx"]], axis=1)
+
+    # the positions are only defined up to a constant per connected part of
+    # the graph, so the first tile of each part is fixed at zero
+    ncomponents, labels = connected_components(
+        incidence.T @ incidence, directed=False
+    )
+    anchors = np.unique(labels, return_index=True)[1]
+    gauge = np.zeros(number_of_tiles)
+    gauge[anchors] = 1
+
+    weights = edges["score"]
+    robust_weights = np.ones(number_of_edges)
+    for iteration in range(iterations):
+        w = scipy.sparse.diags(weights * robust_weights)
+        normal = incidence.T @ w @ incidence + scipy.sparse.diags(gauge)
+        solve = scipy.sparse.linalg.factorized(normal.tocsc())
+        rhs = incidence.T @ (w @ relative)
+        absolute = np.stack([solve(rhs[:, 0]), solve(rhs[:, 1])], axis=1)
+
+        if outlier_threshold is None:
+            break
+        # iteratively reweighted least squares: edges deviating more than
+        # outlier_threshold pixels get the weight (outlier_threshold/residual)**2,
+        # which practically removes gross outliers, but keeps the graph connected
+        residuals = np.linalg.norm(incidence @ absolute - relative, axis=1)
+        new_weights = np.ones(number_of_edges)
+        outliers = residuals > outlier_threshold
+        new_weights[outliers] = (outlier_threshold / residuals[outliers]) ** 2
+        if np.allclose(new_weights, robust_weights):
+            break
+        robust_weights = new_weights
+
+    return absolute
+
+
 def absolute_stitching_positions(
-    positions, neighbours, tile_dimensions, pos_pcms, conflict_sol="weighted"
+    positions,
+    neighbours,
+    tile_dimensions,
+    pos_pcms=None,
+    conflict_sol="weighted",
+    outlier_threshold=None,
 ):
     # in case of non-matching relative image-positions resulting from different neighbours
     # the average of the conflicting values is taken
+    # positions can also be given as edge list (see relative_stitching_positions with sparse=True),
+    # then pos_pcms is not needed
+    # conflict_sol: "weighted" (running average weighted by the PCM maxima), "last" or
+    #               "lsq" for a global weighted least squares fit over the whole neighbour graph
+    # outlier_threshold: only for "lsq", relative positions deviating more than this number of pixels
+    #                    from the fit are iteratively down-weighted (robust fit)
+
+    if positions.dtype == stitching_edge_dtype:
+        edges = np.copy(positions)
+        edges["score"] -= min(np.min(edges["score"], initial=0), 0)
+        edges["score"] += 0.000001
+    else:
+        pos_pcms -= np.min(pos_pcms)
+        pos_pcms += 0.000001
+        edges = _dense_to_edges(positions, neighbours, pos_pcms)
 
-    pos_pcms -= np.min(pos_pcms)
-    pos_pcms += 0.000001
+    if conflict_sol == "lsq":
+        absolute = _global_positions(
+            edges, tile_dimensions[0] * tile_dimensions[1], outlier_threshold
+        )
+        absolute -= np.min(absolute, axis=0)
+        # truncated like the positions of the other modes, the rounding to
+        # 1e-6 px only removes the numerical noise of the solver (e.g. 119.9999999)
+        absolute = np.round(absolute, 6).astype(int)
+        return absolute.reshape(tile_dimensions[0], tile_dimensions[1], 2)
 
     absolute_positions = np.zeros([tile_dimensions[0], tile_dimensions[1], 2])
     weights = np.zeros([tile_dimensions[0], tile_dimensions[1], 2])
-    for i in range(len(neighbours)):
+    last_i = -1
+    for i, j, dy, dx, score in edges:
+        if conflict_sol == "last":
+            # only the first neighbour of each image is used
+            if i == last_i:
+                continue
+            last_i = i
+
         row0 = i // tile_dimensions[1]
         column0 = i % tile_dimensions[1]
-
-        for j in neighbours[i]:
-            row1 = j // tile_dimensions[1]
-            column1 = j % tile_dimensions[1]
-
-            if conflict_sol == "last":
+        row1 = j // tile_dimensions[1]
+        column1 = j % tile_dimensions[1]
+
+        if conflict_sol == "last":
+            absolute_positions[row1, column1, 0] += (
+                absolute_positions[row0, column0, 0] + dy
+            )
+            absolute_positions[row1, column1, 1] += (
+                absolute_positions[row0, column0, 1] + dx
+            )
+            continue
+
+        if conflict_sol == "weighted":
+            if np.sum(absolute_positions[row0, column0]) == 0:
                 absolute_positions[row1, column1, 0] += (
-                    absolute_positions[row0, column0, 0] + positions[i, j, 0]
+                    absolute_positions[row0, column0, 0] + dy
                 )
                 absolute_positions[row1, column1, 1] += (
-                    absolute_positions[row0, column0, 1] + positions[i, j, 1]
+                    absolute_positions[row0, column0, 1] + dx
                 )
-                break
-
-            if conflict_sol == "weighted":
-                if np.sum(absolute_positions[row0, column0]) == 0:
-                    absolute_positions[row1, column1, 0] += (
-                        absolute_positions[row0, column0, 0] + positions[i, j, 0]
-                    )
-                    absolute_positions[row1, column1, 1] += (
-                        absolute_positions[row0, column0, 1] + positions[i, j, 1]
-                    )
-                    weights[row1, column1, 0] += pos_pcms[i, j]
-                    weights[row1, column1, 1] += pos_pcms[i, j]
-                else:
-                    absolute_positions[row1, column1, 0] = (
-                        absolute_positions[row1, column1, 0] * weights[row1, column1, 0]
-                        + (absolute_positions[row0, column0, 0] + positions[i, j, 0])
-                        * pos_pcms[i, j]
-                    )
-                    absolute_positions[row1, column1, 1] = (
-                        absolute_positions[row1, column1, 1] * weights[row1, column1, 1]
-                        + (absolute_positions[row0, column0, 1] + positions[i, j, 1])
-                        * pos_pcms[i, j]
-                    )
-                    weights[row1, column1, 0] += pos_pcms[i, j]
-                    weights[row1, column1, 1] += pos_pcms[i, j]
-                    absolute_positions[row1, column1] /= weights[row1, column1]
-
+                weights[row1, column1, 0] += score
+                weights[row1, column1, 1] += score
             else:
-                if sum(absolute_positions[row1, column1]) == 0:
-                    average_division = 1
-                else:
-                    average_division = 2
-
-                absolute_positions[row1, column1, 0] += (
-                    absolute_positions[row0, column0, 0] + positions[i, j, 0]
+                absolute_positions[row1, column1, 0] = (
+                    absolute_positions[row1, column1, 0] * weights[row1, column1, 0]
+                    + (absolute_positions[row0, column0, 0] + dy) * score
                 )
-                absolute_positions[row1, column1, 1] += (
-                    absolute_positions[row0, column0, 1] + positions[i, j, 1]
+                absolute_positions[row1, column1, 1] = (
+                    absolute_positions[row1, column1, 1] * weights[row1, column1, 1]
+                    + (absolute_positions[row0, column0, 1] + dx) * score
                 )
+                weights[row1, column1, 0] += score
+                weights[row1, column1, 1] += score
+                absolute_positions[row1, column1] /= weights[row1, column1]
+
+        else:
+            if sum(absolute_positions[row1, column1]) == 0:
+                average_division = 1
+            else:
+                average_division = 2
 
-                absolute_positions[row1, column1] /= average_division
+            absolute_positions[row1, column1, 0] += (
+                absolute_positions[row0, column0, 0] + dy
+            )
+            absolute_positions[row1, column1, 1] += (
+                absolute_positions[row0, column0, 1] + dx
+            )
+
+            absolute_positions[row1, column1] /= average_division
 
     # shift to have only positive positions
     absolute_positions[:, :, 0] -= np.min(absolute_positions[:, :, 0])
@@ -735,32 +2523,165 @@ def absolute_stitching_positions(
 
 
 #%% contrast_correction
-def contrast_correction(images):
+def _histogram_mode_brightness(batch, bins=100, skip=5):
+    # center of the most populated bin of np.histogram(image, bins) for every
+    # image of the batch (ignoring the first skip bins)
+    number = len(batch)
+    flat = batch.reshape(number, -1)
+    rows = np.arange(number)
+
+    if not (flat.dtype.kind == "u" and flat.dtype.itemsize <= 2):
+        # np.histogram is already optimal for a single float image
+        brightness = []
+        for image in flat:
+            vals, edges = np.histogram(image, bins)
+            maxpos = np.argmax(vals[skip:]) + skip
+            brightness.append((edges[maxpos] + edges[maxpos + 1]) / 2)
+        return np.array(brightness)
+
+    # 8 and 16 bit data: histogram of the values of all images with one bincount,
+    # the values are then assigned to the bins with the same edges and rounding
+    # as np.histogram
+    first = np.min(flat, axis=1).astype(np.float64)
+    last = np.max(flat, axis=1).astype(np.float64)
+    constant = first == last
+    first[constant] -= 0.5
+    last[constant] += 0.5
+    edges = np.linspace(first, last, bins + 1, axis=1)
+
+    nvalues = int(np.max(last)) + 1
+    offsets = rows[:, None]
+    value_counts = np.bincount(
+        (flat + offsets * nvalues).ravel(), minlength=number * nvalues
+    ).reshape(number, nvalues)
+
+    values = np.broadcast_to(np.arange(nvalues, dtype=np.float64), (number, nvalues))
+    indices = ((values - first[:, None]) / (last - first)[:, None] * bins).astype(np.intp)
+    indices[indices == bins] -= 1
+    np.clip(indices, 0, bins - 1, out=indices)
+    decrement = values < np.take_along_axis(edges, indices, axis=1)
+    indices[decrement] -= 1
+    increment = (values >= np.take_along_axis(edges, indices + 1, axis=1)) & (
+        indices != bins - 1
+    )
+    indices[increment] += 1
+    # values outside of the range of an image do not occur in it (zero weight)
+    np.clip(indices, 0, bins - 1, out=indices)
+
+    counts = np.bincount(
+        (indices + offsets * bins).ravel(),
+        weights=value_counts.ravel(),
+        minlength=number * bins,
+    ).reshape(number, bins)
+
+    maxpos = np.argmax(counts[:, skip:], axis=1) + skip
+    return (edges[rows, maxpos] + edges[rows, maxpos + 1]) / 2
+
+
+def _histogram_mode_bytes(pixels, dtype, bins=100):
+    # approximate memory of _histogram_mode_brightness per image: the pixels with
+    # a float and an integer index each, and for 8 and 16 bit data the
+    # temporaries over all possible values (counts, values, bin indices, edges
+    # taken at the indices, comparison masks)
+    dtype = np.dtype(dtype)
+    size = pixels * 24 + bins * 16
+    if dtype.kind == "u" and dtype.itemsize <= 2:
+        size += 2 ** (8 * dtype.itemsize) * 56
+    return size
+
+
+def contrast_brightness(images, subsample=1, memory_budget=2**28):
+    """
+    brightness of each image, given by the center of the maximum of its 
+    pixel-value-histogram with 100 bins (the 5 darkest bins are ignored),
+    computed for blocks of images at once
+
+    Args:
+        images (list of images or KxMxN array_like): 
+            input.
+        
+        subsample (int, optional): 
+            only every subsample-th pixel along both axes is used. 
+            Defaults to 1.
+        
+        memory_budget (int, optional): 
+            approximate number of bytes used for a block of images. 
+            Defaults to 2**28.
+
+    Returns:
+        brightness (K array_like): 
+            brightness of each image.
+
+    """
+    imdim = np.shape(images[0])
+    pixels = len(range(0, imdim[0], subsample)) * len(range(0, imdim[1], subsample))
+    dtype = np.asarray(images[0]).dtype
+    block = max(1, int(memory_budget // _histogram_mode_bytes(pixels, dtype)))
+    brightness = []
+    for start in range(0, len(images), block):
+        batch = np.asarray(
+            [np.asarray(images[i])[::subsample, ::subsample] for i in range(start, min(start + block, len(images)))]
+        )
+        brightness.append(_histogram_mode_brightness(batch))
+    return np.concatenate(brightness)
+
+
+class _scaled_images:
+    # images multiplied by a factor each, computed when an image is accessed
+    def __init__(self, images, ref, brightness):
+        self.images = images
+        self.ref = ref
+        self.brightness = brightness
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, i):
+        return self.images[i] * self.ref / self.brightness[i]
+
+
+def contrast_correction(images, inplace=False, lazy=False, subsample=1, memory_budget=2**28):
     """
     normalize the brightness of all pictures in the series, by multiplying each image
     with a factor, so that the maximum of the pixel-value-histogram of every image is
     at the same position
 
     Args:
-        images (list of images): 
+        images (list of images or KxMxN array_like): 
             input.
+        
+        inplace (bool, optional): 
+            multiply the images in place (they need a float dtype). 
+            Defaults to False.
+        
+        lazy (bool, optional): 
+            return a sequence, which corrects an image only when it is accessed. 
+            Defaults to False.
+        
+        subsample (int, optional): 
+            only every subsample-th pixel along both axes is used for the
+            histograms, see contrast_brightness(). 
+            Defaults to 1.
+        
+        memory_budget (int, optional): 
+            approximate number of bytes used for a block of images 
+            in contrast_brightness(). 
+            Defaults to 2**28.
 
     Returns:
         images_corrected (list of images): 
-            output.
+            output (images itself, if inplace is True).
 
     """
-    # 
-    imdim = images[0].shape
-    hists = []
-    for i in range(len(images)):
-        flatim = np.reshape(images[i], imdim[0] * imdim[1])
-        vals, bins = np.histogram(flatim, 100)
-        maxpos = np.argmax(vals[5:]) + 5
-        brightness = (bins[maxpos] + bins[maxpos + 1]) / 2
-        hists.append(brightness)
+    hists = contrast_brightness(images, subsample, memory_budget)
 
     ref = np.mean(hists)
+    if lazy:
+        return _scaled_images(images, ref, hists)
+    if inplace:
+        for i in range(len(images)):
+            images[i] *= ref / hists[i]
+        return images
     images_corrected = []
     for i in range(len(images)):
         images_corrected.append(images[i] * ref / hists[i])
@@ -768,11 +2689,20 @@ def contrast_correction(images):
 
 
 #%% drift_correction
-def drift_correction(images, tile_dimensions, overlap_rows_cols, tolerance=0.1):
+def drift_correction(
+    images,
+    tile_dimensions,
+    overlap_rows_cols,
+    tolerance=0.1,
+    store=None,
+):
     # images: list of images as a series of rows from top to bottom and within the row from left to right
     # tile_dimensions: tuple consisting of first number of rows and second number of columns
     # overlap: tuple of values between 0.0 and 1.0 indicating the expected relative overlap of pictures
     # tolerance: relative allowed deviation from the expected overlap
+    # store: pairwise_pcm_store, keeps the spectra of the tiles, which are used in up to four pairs,
+    #        and the phase correlations for relative_stitching_positions with the same store.
+    #        The drifts are recorded in the store and used there by default
     # note: all images should have the same resolution
 
     imdim = images[0].shape
@@ -783,89 +2713,46 @@ def drift_correction(images, tile_dimensions, overlap_rows_cols, tolerance=0.1):
     overlap_limits[1, 0] = imdim[1] * (overlap_rows_cols[1] - tolerance)
     overlap_limits[1, 1] = imdim[1] * (overlap_rows_cols[1] + tolerance)
 
-    positions = np.zeros(
-        [
-            tile_dimensions[0] * tile_dimensions[1],
-            tile_dimensions[0] * tile_dimensions[1],
-            2,
-        ]
-    )
-    pos_pcms = np.zeros(
-        [
-            tile_dimensions[0] * tile_dimensions[1],
-            tile_dimensions[0] * tile_dimensions[1],
-        ]
-    )
+    number_of_tiles = tile_dimensions[0] * tile_dimensions[1]
+
+    # relative positions and PCM maxima of the right (i,i+1)
+    # and bottom (i,i+tile_dimensions[1]) neighbours
+    rightmoves = np.zeros(number_of_tiles - 1)
+    downmoves = np.zeros(number_of_tiles - tile_dimensions[1])
+    rightpositions = np.zeros([number_of_tiles - 1, 2])
+    downpositions = np.zeros([number_of_tiles - tile_dimensions[1], 2])
 
     # loop checks for each image the relative position of its right and bottom neighour
     # via the maximum of the phase-correlation-matrix (PCM)
-    for i in range(len(images) - 1):
-
-        if (i + 1) % tile_dimensions[1] == 0:  # no right neighbour at the end of a row
-            # if i%tile_dimensions[1]==0:
-            if (
-                i < (tile_dimensions[0] - 1) * tile_dimensions[1]
-            ):  # no bottom neighbours in the last row
-                j = i + tile_dimensions[1]  # j is the image below
-                if j < len(images):
-                    pcm = phase_correlation(images[i], images[j])
-
-                    dist0, dist1, pcms = _pos_from_pcm(
-                        pcm, overlap_limits, "vertical", tolerance, imdim, 0, 0
-                    )
-                    positions[i, j] = dist0, dist1
-                    positions[j, i] = dist0, dist1
-                    pos_pcms[i, j] = pcms
-                    pos_pcms[j, i] = pcms
-
+    for i, j, direction in _grid_pairs(len(images), tile_dimensions):
+        rows, cols = _pcm_window(overlap_limits, direction, imdim, 0, 0)
+        peak = _stitching_peak(images, i, j, (), (), dict(), 0, store, rows, cols)
+        dist0, dist1, pcms = peak["dy"], peak["dx"], peak["score"]
+        if direction == "horizontal":
+            rightmoves[i] = pcms
+            rightpositions[i] = dist0, dist1
         else:
-            j = i + 1  # j is the image right
-            if j < len(images):
-                if i < tile_dimensions[1]:
-                    pcm = phase_correlation(images[i], images[j])
-                else:
-                    pcm = phase_correlation(images[i], images[j])
-                dist0, dist1, pcms = _pos_from_pcm(
-                    pcm, overlap_limits, "horizontal", tolerance, imdim, 0, 0
-                )
-                positions[i, j] = dist0, dist1
-                positions[j, i] = dist0, dist1
-                pos_pcms[i, j] = pcms
-                pos_pcms[j, i] = pcms
-
-            if i < (tile_dimensions[0] - 1) * tile_dimensions[1]:
-                j = i + tile_dimensions[1]  # j is the image below
-                if j < len(images):
-                    pcm = phase_correlation(images[i], images[j])
-
-                    dist0, dist1, pcms = _pos_from_pcm(
-                        pcm, overlap_limits, "vertical", tolerance, imdim, 0, 0
-                    )
-                    positions[i, j] = dist0, dist1
-                    positions[j, i] = dist0, dist1
-                    pos_pcms[i, j] = pcms
-                    pos_pcms[j, i] = pcms
-
-    rightmoves = np.diag(pos_pcms, 1)
-    downmoves = np.diag(pos_pcms, tile_dimensions[1])
+            downmoves[i] = pcms
+            downpositions[i] = dist0, dist1
+
     right0 = np.argmax(rightmoves)
     down0 = np.argmax(downmoves)
-    right1 = right0 + 1
-    down1 = down0 + tile_dimensions[1]
 
     drift_down, drift_right = np.zeros(2), np.zeros(2)
 
     expected_row_pos = imdim[0] - imdim[0] * overlap_rows_cols[0]
     expected_col_pos = imdim[1] - imdim[1] * overlap_rows_cols[1]
-    drift_down[0] = positions[down0, down1, 0] - expected_row_pos
-    drift_down[1] = positions[down0, down1, 1]
+    drift_down[0] = downpositions[down0, 0] - expected_row_pos
+    drift_down[1] = downpositions[down0, 1]
 
-    drift_right[0] = positions[right0, right1, 0]
-    drift_right[1] = positions[right0, right1, 1] - expected_col_pos
+    drift_right[0] = rightpositions[right0, 0]
+    drift_right[1] = rightpositions[right0, 1] - expected_col_pos
 
     drifts = []
     drifts.append(drift_right)
     drifts.append(drift_down)
+    if store is not None:
+        store.drifts = np.array(drifts).tolist()
 
     alldrifts_right = []
     alldrifts_down = []
@@ -873,21 +2760,83 @@ def drift_correction(images, tile_dimensions, overlap_rows_cols, tolerance=0.1):
         if rightmoves[i] == 0:
             pass
         else:
-            adr0 = positions[i, i + 1, 0]
-            adr1 = positions[i, i + 1, 1] - expected_row_pos
+            adr0 = rightpositions[i, 0]
+            adr1 = rightpositions[i, 1] - expected_row_pos
             alldrifts_right.append([adr0, adr1])
     for i in range(len(downmoves)):
-        add0 = positions[i, i + tile_dimensions[1], 0] - expected_col_pos
-        add1 = positions[i, i + tile_dimensions[1], 1]
+        add0 = downpositions[i, 0] - expected_col_pos
+        add1 = downpositions[i, 1]
         alldrifts_down.append([add0, add1])
 
     return drifts, alldrifts_right, alldrifts_down
 
 
 #%% stitch_grid
-def stitch_grid(images, absolute_positions, tile_dimensions, mask):
+def stitch_grid_shape(images, absolute_positions):
+    """
+    shape of the montage created by stitch_grid, e.g. to create a
+    np.memmap or a chunked HDF5 dataset as output target
+
+    Args:
+        images (list of MxN array_like): 
+            tiles.
+        
+        absolute_positions (array_like): 
+            as given by absolute_stitching_positions.
+
+    Returns:
+        shape (tuple): 
+            containing two integers.
+
+    """
+    imdim = images[0].shape
+    vmax = np.max(absolute_positions[:, :, 0]) + imdim[0]
+    hmax = np.max(absolute_positions[:, :, 1]) + imdim[1]
+    return int(vmax), int(hmax)
+
+
+def _stitch_block(images, absolute_positions, tile_dimensions, mask, start, end, width):
+    # blended rows start:end of the montage, only tiles intersecting the block are read
+    imdim = images[0].shape
+    division = np.zeros([end - start, width])
+    montage = np.zeros([end - start, width])
+
+    for i in range(len(images)):
+        row = i // tile_dimensions[1]
+        column = i % tile_dimensions[1]
+        v0 = absolute_positions[row, column, 0]
+        v1 = absolute_positions[row, column, 0] + imdim[0]
+        if v1 <= start or v0 >= end:
+            continue
+        h0, h1 = (
+            absolute_positions[row, column, 1],
+            absolute_positions[row, column, 1] + imdim[1],
+        )
+        r0 = max(start, v0)
+        r1 = min(end, v1)
+        tilemask = mask[r0 - v0 : r1 - v0]
+        montage[r0 - start : r1 - start, h0:h1] += images[i][r0 - v0 : r1 - v0] * tilemask
+        division[r0 - start : r1 - start, h0:h1] += tilemask
+
+    division[division == 0] = 1.0
+    montage /= division
+    return montage
+
+
+def stitch_grid(
+    images, absolute_positions, tile_dimensions, mask, out=None, memory_budget=2**28
+):
     # to ensure a smooth transition between two pictures, a weighted sum in the overlap-region is executed
     # the weights are given by mask
+    # out: optional output target with shape stitch_grid_shape(images, absolute_positions),
+    #      e.g. np.memmap or a chunked h5py dataset. The montage is then computed in blocks of rows
+    #      and written block by block, so only memory_budget bytes are used for the blending.
+    #      Integer targets are scaled to the full range of their dtype.
+
+    if out is not None:
+        return _stitch_grid_blockwise(
+            images, absolute_positions, tile_dimensions, mask, out, memory_budget
+        )
 
     imdim = images[0].shape
     vmax = np.max(absolute_positions[:, :, 0]) + imdim[0]
@@ -914,30 +2863,210 @@ def stitch_grid(images, absolute_positions, tile_dimensions, mask):
     return montage / np.max(montage)
 
 
+def _stitch_grid_blockwise(
+    images, absolute_positions, tile_dimensions, mask, out, memory_budget
+):
+    vmax, hmax = stitch_grid_shape(images, absolute_positions)
+    if tuple(out.shape) != (vmax, hmax):
+        raise ValueError("out must have the shape " + str((vmax, hmax)))
+
+    # montage and division of a block are float64,
+    # the intersecting tile rows add at most the same amount again
+    block_rows = int(max(1, memory_budget // (4 * 8 * hmax)))
+    blocks = [(b, min(b + block_rows, vmax)) for b in range(0, vmax, block_rows)]
+
+    # first pass: global minimum and maximum for the normalization
+    minimum = np.inf
+    maximum = -np.inf
+    for start, end in blocks:
+        block = _stitch_block(
+            images, absolute_positions, tile_dimensions, mask, start, end, hmax
+        )
+        minimum = min(minimum, np.min(block))
+        maximum = max(maximum, np.max(block))
+
+    if np.issubdtype(out.dtype, np.integer):
+        scale = np.iinfo(out.dtype).max
+    else:
+        scale = 1.0
+
+    # second pass: normalized blocks are written to the target
+    for start, end in blocks:
+        block = _stitch_block(
+            images, absolute_positions, tile_dimensions, mask, start, end, hmax
+        )
+        block -= minimum
+        block *= scale / (maximum - minimum)
+        if scale != 1.0:
+            block = np.round(block)
+        out[start:end] = block.astype(out.dtype)
+    return out
+
+
 #%% optimize_images
-def optimize_images(images, background_division="mask"):
-    # to achieve homogeneous brightness at non-optimal lightning,
-    # the images are normalized (divided by) mask, a blurred median-image of the series
-    # weighting areas differently so,
-    # when later overlapping image-regions are summed, mask ensures that
-    # the influence of a well illuminated area is bigger, than a poorly illuminated area
+def _stack_rows(images, start, end):
+    # rows start:end of every image as KxRxN array
+    if hasattr(images, "shape") and len(images.shape) == 3:
+        return np.asarray(images[:, start:end])
+    return np.array([images[k][start:end] for k in range(len(images))])
+
+
+def _histogram_rank_values(counts, ranks, width):
+    # value of the given rank (0-based) for every pixel from per-pixel histograms
+    cumulative = np.cumsum(counts, axis=1)
+    values = []
+    for rank in ranks:
+        index = np.argmax(cumulative > rank, axis=1)
+        if width == 1:
+            values.append(index.astype(np.float64))
+            continue
+        pixels = np.arange(len(counts))
+        before = cumulative[pixels, index] - counts[pixels, index]
+        fraction = (rank - before + 0.5) / counts[pixels, index]
+        values.append((index + fraction) * width)
+    return np.mean(values, axis=0)
+
+
+def _histogram_median_mad(images, start, end, bins, value_range):
+    # approximate median and MAD of rows start:end, from per-pixel histograms
+    # that are filled image by image
+    number = len(images)
+    width = int(np.ceil((value_range + 1) / bins))
+    ranks = [(number - 1) // 2, number // 2]
+
+    counts = None
+    for k in range(number):
+        rows = np.asarray(images[k][start:end])
+        pixels = rows.size
+        if counts is None:
+            counts = np.zeros(pixels * bins, dtype=np.int64)
+        index = np.arange(pixels) * bins + np.minimum(rows.ravel() // width, bins - 1)
+        counts += np.bincount(index, minlength=pixels * bins)
+    median = _histogram_rank_values(counts.reshape(-1, bins), ranks, width)
+
+    counts[:] = 0
+    for k in range(number):
+        rows = np.asarray(images[k][start:end], dtype=np.float64).ravel()
+        deviation = np.abs(rows - median)
+        index = np.arange(pixels) * bins + np.minimum(deviation // width, bins - 1).astype(int)
+        counts += np.bincount(index, minlength=pixels * bins)
+    mad = _histogram_rank_values(counts.reshape(-1, bins), ranks, width)
+    if width == 1:
+        # for an even number of images the median can be x.5, then every
+        # deviation is k+0.5 and binned as k, so the bin index is off by 0.5
+        mad += median - np.floor(median)
+
+    shape = (end - start,) + np.shape(images[0])[1:]
+    return median.reshape(shape), mad.reshape(shape)
+
+
+def flatfield_statistics(
+    images, memory_budget=2**28, median="exact", bins=256, value_range=None
+):
+    """
+    per-pixel median and normalized median absolute deviation (MAD) of a
+    series of images, and the blurred median used as illumination mask.
+    The statistics are computed in blocks of rows, so only memory_budget
+    bytes are needed regardless of the number of images.
+
+    Args:
+        images (list of MxN array_like or KxMxN array_like): 
+            series of images, e.g. tiles of a montage (also a h5py dataset).
+        
+        memory_budget (int, optional): 
+            approximate number of bytes used for the computation. 
+            Defaults to 2**28.
+        
+        median (str, optional): 
+            "exact" for np.median of each block, or "histogram" for an
+            approximate median from per-pixel histograms, which are filled
+            image by image (only for integer images). 
+            Defaults to "exact".
+        
+        bins (int, optional): 
+            number of histogram bins (median "histogram"), for 8bit images
+            256 bins give the exact median. 
+            Defaults to 256.
+        
+        value_range (int, optional): 
+            largest possible pixel value covered by the histogram (median "histogram"),
+            e.g. 4095 for 12bit data stored as np.uint16. 
+            Defaults to None (maximum of the dtype).
+
+    Returns:
+        immed (MxN array_like): 
+            median image.
+        
+        madnorm (MxN array_like): 
+            median absolute deviation normalized to its maximum.
+        
+        mask (MxN array_like): 
+            blurred median image.
 
-    immed = np.median(images, axis=0)
+    """
+    imshape = np.shape(images[0])
+    number = len(images)
+    immed = np.zeros(imshape)
+    mad = np.zeros(imshape)
+
+    if median == "exact":
+        # a block of rows of all images and the absolute deviations
+        bytes_per_row = 2 * number * int(np.prod(imshape[1:])) * 8
+    elif median == "histogram":
+        dtype = np.asarray(images[0]).dtype
+        if not np.issubdtype(dtype, np.integer):
+            raise ValueError("median 'histogram' requires integer images")
+        if value_range is None:
+            value_range = int(np.iinfo(dtype).max)
+        # histogram counts and the bincount temporary
+        bytes_per_row = 2 * bins * int(np.prod(imshape[1:])) * 8
+    else:
+        raise ValueError("median must be 'exact' or 'histogram'")
+    block_rows = int(max(1, memory_budget // bytes_per_row))
+
+    for start in range(0, imshape[0], block_rows):
+        end = min(start + block_rows, imshape[0])
+        if median == "exact":
+            block = _stack_rows(images, start, end)
+            immed[start:end] = np.median(block, axis=0)
+            mad[start:end] = np.median(np.abs(block - immed[start:end]), axis=0)
+        else:
+            immed[start:end], mad[start:end] = _histogram_median_mad(
+                images, start, end, bins, value_range
+            )
 
-    images_mad = np.abs(images - immed)
-    mad = np.median(images_mad, axis=0)
     madnorm = mad / np.max(mad)
 
     mask = cv2.blur(immed, (11, 11))
     mask = cv2.blur(mask, (31, 31))
     mask = cv2.blur(mask, (51, 51))
     mask = cv2.blur(mask, (71, 71))
+    return immed, madnorm, mask
+
+
+def optimize_images(
+    images, background_division="mask", memory_budget=2**28, median="exact"
+):
+    # to achieve homogeneous brightness at non-optimal lightning,
+    # the images are normalized (divided by) mask, a blurred median-image of the series
+    # weighting areas differently so,
+    # when later overlapping image-regions are summed, mask ensures that
+    # the influence of a well illuminated area is bigger, than a poorly illuminated area
+    # the statistics are computed blockwise within memory_budget, see flatfield_statistics
 
+    immed, madnorm, mask = flatfield_statistics(
+        images, memory_budget=memory_budget, median=median
+    )
+
+    # image by image, so no temporary of the size of the whole series is created
     if background_division == "mask":
-        images_c = images / mask
+        images_c = np.zeros((len(images),) + mask.shape)
+        for k in range(len(images)):
+            np.divide(images[k], mask, out=images_c[k])
     elif background_division == "median":
-        images_c = np.clip((images / immed / 2), 0, 1) * 255
-        images_c = images_c.astype(np.uint8)
+        images_c = np.zeros((len(images),) + immed.shape, dtype=np.uint8)
+        for k in range(len(images)):
+            images_c[k] = np.clip((images[k] / immed / 2), 0, 1) * 255
 
     return images_c, immed, madnorm, mask
 
@@ -1216,50 +3345,40 @@ def align_images(im1s, im2, p1s, p2, verbose=False):
     # align p1 to p2
     # p2 higher resolution recommended
     #im1s,p1s=assure_multiple(im1s,p1s)
+    # p2 can also be a list with separate points for each image of im1s
     single_image=False
     if not len(im1s) == len(p1s):
         single_image=True        
         im1s=[im1s]
         p1s=[p1s]
+    if np.ndim(p2[0])==2:
+        p2s=p2
+    else:
+        p2s=[p2]*len(p1s)
 
-    allwidths = []
-    allheights = []
+    # one homography per image, its bounds follow from the image corners
+    # (the extremes of a linear map over the image border are at the corners)
+    homographies = np.zeros([len(im1s), 3, 3])
+    corners = np.zeros([len(im1s), 3, 4])
     for i in range(len(im1s)):
-
-        im1 = im1s[i]
-        p1 = p1s[i]
-
-        matrix1, mask1 = cv2.findHomography(p1, p2, cv2.RANSAC, 5.0)
-
-        xf = np.arange(im1.shape[1] - 1).tolist()
-        xf += (np.zeros(im1.shape[0] - 1) + im1.shape[1] - 1).tolist()
-        xf += np.arange(1, im1.shape[1]).tolist()
-        xf += np.zeros(im1.shape[0] - 1).tolist()
-
-        yf = np.zeros(im1.shape[1] - 1).tolist()
-        yf += np.arange(im1.shape[0] - 1).tolist()
-        yf += (np.zeros(im1.shape[1] - 1) + im1.shape[0] - 1).tolist()
-        yf += np.arange(1, im1.shape[0]).tolist()
-        
-        img_matrix = np.stack([xf, yf, np.ones(len(xf))])
-        
-        res = np.tensordot(matrix1, img_matrix, axes=1)
-
-        allwidths.append(np.round(min(np.min(res[0]), 0)).astype(int))
-        allheights.append(np.round(min(np.min(res[1]), 0)).astype(int))
-
-        allwidths.append(
-            np.round(max(np.max(res[0]), im2.shape[1])).astype(int) - allwidths[-1]
-        )
-        allheights.append(
-            np.round(max(np.max(res[1]), im2.shape[0])).astype(int) - allheights[-1]
-        )
+        homographies[i], mask1 = cv2.findHomography(p1s[i], p2s[i], cv2.RANSAC, 5.0)
+        rows, cols = im1s[i].shape[:2]
+        corners[i] = [[0, cols - 1, cols - 1, 0], [0, 0, rows - 1, rows - 1], [1, 1, 1, 1]]
+    res = np.matmul(homographies, corners)
+
+    lefts = np.round(np.minimum(np.min(res[:, 0], axis=1), 0)).astype(int)
+    tops = np.round(np.minimum(np.min(res[:, 1], axis=1), 0)).astype(int)
+    allwidths = np.concatenate(
+        [lefts, np.round(np.maximum(np.max(res[:, 0], axis=1), im2.shape[1])).astype(int) - lefts]
+    )
+    allheights = np.concatenate(
+        [tops, np.round(np.maximum(np.max(res[:, 1], axis=1), im2.shape[0])).astype(int) - tops]
+    )
 
     reswidth = np.max(allwidths)
     resheight = np.max(allheights)
     width_shift = np.abs(np.min(allwidths))
     height_shift = np.abs(np.min(allheights))
-    shift = np.array([width_shift, height_shift])
 
     img2Reg = np.zeros([resheight, reswidth])
     img2Reg[
@@ -1269,16 +3388,12 @@ def align_images(im1s, im2, p1s, p2, verbose=False):
 
     im1res = []
 
-    p2a = np.zeros(p2.shape)
-    for i in range(len(p2)):
-        p2a[i] = p2[i] + shift
-
+    # the shift of p2 is folded into the homographies as a translation
+    translation = np.array([[1, 0, width_shift], [0, 1, height_shift], [0, 0, 1]])
     matrices = []
     for i in range(len(im1s)):
-        p1 = p1s[i]
         im1 = im1s[i]
-
-        matrix1, mask1 = cv2.findHomography(p1, p2a, cv2.RANSAC, 5.0)
+        matrix1 = translation @ homographies[i]
         matrices.append(matrix1)
         img1Reg = cv2.warpPerspective(
             im1, matrix1, (reswidth, resheight), flags=cv2.INTER_CUBIC
@@ -1296,119 +3411,415 @@ def align_images(im1s, im2, p1s, p2, verbose=False):
         else:
             return im1res, img2Reg
         
-#%% sift align matches
-def sift_align_matches(img1,img2,ratio_threshold=0.5):
-    sift = cv2.SIFT_create()
+#%% sift_registration
+class sift_registration:
+    """
+    SIFT keypoint matching of frames to a fixed reference image:
+    keypoints and descriptors of the reference are detected only once.
+    With query="reference" the reference descriptors are matched to the
+    descriptors of every frame (as in sift_align_matches), with query="frame" 
+    the matcher of every worker thread is trained once on the reference 
+    (for "flann" the KD-tree index of the reference is built once) and 
+    the descriptors of the frames are the queries, so that a reference keypoint
+    is matched to the best of the frame keypoints, which pass the ratio test.
+    The visualization of the matches is only rendered if requested
+    """
 
-    kp1, des1 = sift.detectAndCompute(img1,None)
-    kp2, des2 = sift.detectAndCompute(img2,None)
+    def __init__(self, reference, ratio_threshold=0.5, matcher="bf", workers=None,
+                 query=None):
+        """
+        Args:
+            reference (MxN array_like): 
+                reference image (8bit, as required by cv2.SIFT).
+            
+            ratio_threshold (float, optional): 
+                ratio test as per Lowe's paper, a match is kept, if its distance
+                is smaller than ratio_threshold times the distance of the second best. 
+                Defaults to 0.5.
+            
+            matcher (str, optional): 
+                "bf" for exact brute force matching (cv2.BFMatcher),
+                "flann" for approximate matching with randomized KD-trees
+                (cv2.FlannBasedMatcher), which is much faster for many keypoints. 
+                Defaults to "bf".
+            
+            workers (int, optional): 
+                number of threads for match_stack(). 
+                Defaults to None (number of cores).
+            
+            query (str, optional): 
+                "reference" or "frame", the descriptors which are matched to the
+                other ones; the matches of both directions differ. 
+                Defaults to None ("reference" for "bf", "frame" for "flann").
+
+        """
+        if matcher not in ["bf", "flann"]:
+            raise ValueError("matcher must be 'bf' or 'flann'")
+        if query is None:
+            query = "reference" if matcher == "bf" else "frame"
+        if query not in ["reference", "frame"]:
+            raise ValueError("query must be 'reference' or 'frame'")
+        self.reference = reference
+        self.ratio_threshold = ratio_threshold
+        self.matcher = matcher
+        self.workers = workers
+        self.query = query
+        self.keypoints, self.descriptors = cv2.SIFT_create().detectAndCompute(
+            reference, None
+        )
+        self.points = np.array([kp.pt for kp in self.keypoints], dtype="float").reshape(-1, 2)
+        # matchers trained on the reference, one per worker thread
+        self._local = threading.local()
+
+    def _knn_matcher(self):
+        if self.matcher == "flann":
+            # FLANN_INDEX_KDTREE=1
+            return cv2.FlannBasedMatcher(dict(algorithm=1, trees=5), dict(checks=50))
+        return cv2.BFMatcher()
+
+    def _trained_matcher(self):
+        # matcher of the calling thread, trained once on the reference descriptors
+        knn = getattr(self._local, "knn", None)
+        if knn is None:
+            knn = self._knn_matcher()
+            knn.add([self.descriptors])
+            knn.train()
+            self._local.knn = knn
+        return knn
+
+    def _match(self, img, draw=False):
+        # a separate detector (and matcher) per call or thread, 
+        # so that frames can be processed concurrently
+        kp2, des2 = cv2.SIFT_create().detectAndCompute(img, None)
+        if self.query == "reference":
+            return self._match_reference(img, kp2, des2, draw)
+
+        if self.descriptors is None or len(self.descriptors) < 2 or des2 is None:
+            Matches = []
+        else:
+            Matches = self._trained_matcher().knnMatch(des2, k=2)
+
+        good = []
+
+        # ratio test as per Lowe's paper, for every keypoint of img
+        for pair in Matches:
+            if len(pair) < 2:
+                continue
+            m, n = pair
+            if m.distance < self.ratio_threshold * n.distance:
+                good.append(m)
+
+        # a reference keypoint is matched to at most one keypoint of img,
+        # the one with the smallest distance
+        good.sort(key=lambda m: m.distance)
+        matched = set()
+        unique = []
+        for m in good:
+            if m.trainIdx not in matched:
+                matched.add(m.trainIdx)
+                unique.append(m)
+        good = sorted(unique, key=lambda m: m.trainIdx)
+
+        indices = np.array([m.trainIdx for m in good], dtype=int)
+        ptsB = np.zeros((len(good), 2), dtype="float")
+
+        # loop over the top matches
+        for i, m in enumerate(good):
+            ptsB[i] = kp2[m.queryIdx].pt
+
+        Matched = None
+        if draw:
+            # Draw the matches using drawMatchesKnn(), from the reference to img
+            Matches = [[cv2.DMatch(m.trainIdx, m.queryIdx, m.distance)] for m in good]
+            Matched = cv2.drawMatchesKnn(
+                self.reference,
+                self.keypoints,
+                img,
+                kp2,
+                Matches,
+                outImg=None,
+                matchColor=(0, 0, 255),
+                singlePointColor=(0, 255, 255),
+                flags=0,
+            )
+        return Matched, indices, ptsB
+
+    def _match_reference(self, img, kp2, des2, draw):
+        # the reference descriptors are the queries
+        if self.descriptors is None or des2 is None or len(des2) < 2:
+            Matches = []
+        else:
+            Matches = self._knn_matcher().knnMatch(self.descriptors, des2, k=2)
+
+        # Need to draw only good matches, so create a mask
+        good_matches = [[0, 0] for i in range(len(Matches))]
+
+        good = []
+
+        # ratio test as per Lowe's paper
+        for i, pair in enumerate(Matches):
+            if len(pair) < 2:
+                continue
+            m, n = pair
+            if m.distance < self.ratio_threshold * n.distance:
+                good_matches[i] = [1, 0]
+                good.append(m)
+
+        indices = np.array([m.queryIdx for m in good], dtype=int)
+        ptsB = np.zeros((len(good), 2), dtype="float")
+
+        # loop over the top matches
+        for i, m in enumerate(good):
+            ptsB[i] = kp2[m.trainIdx].pt
+
+        Matched = None
+        if draw:
+            # Draw the matches using drawMatchesKnn()
+            Matched = cv2.drawMatchesKnn(
+                self.reference,
+                self.keypoints,
+                img,
+                kp2,
+                Matches,
+                outImg=None,
+                matchColor=(0, 0, 255),
+                singlePointColor=(0, 255, 255),
+                matchesMask=good_matches,
+                flags=0,
+            )
+        return Matched, indices, ptsB
+
+    def match(self, img, draw=False):
+        """
+        match the keypoints of the reference to the keypoints of img
+
+        Args:
+            img (MxN array_like): 
+                image (8bit).
+            
+            draw (bool, optional): 
+                render the matches with cv2.drawMatchesKnn. 
+                Defaults to False.
 
-    #img=cv2.drawKeypoints(img1,kp,img1)
-    
-    #Initialize the BFMatcher for matching 
-    BFMatch = cv2.BFMatcher() 
-    Matches = BFMatch.knnMatch(des1,des2,k=2) 
-      
-    # Need to draw only good matches, so create a mask 
-    good_matches = [[0,0] for i in range(len(Matches))] 
-    
-    good=[]
-    
-    # ratio test as per Lowe's paper 
-    for i,(m,n) in enumerate(Matches): 
-        if m.distance < ratio_threshold*n.distance: 
-            good_matches[i]=[1,0] 
-            good.append(m)
-
-    ptsA = np.zeros((len(good), 2), dtype="float")
-    ptsB = np.zeros((len(good), 2), dtype="float")
-    
-    # loop over the top matches
-    for i,m in enumerate(good):
-        ptsA[i]= (kp1[m.queryIdx].pt[0],kp1[m.queryIdx].pt[1])
-        ptsB[i]= (kp2[m.trainIdx].pt[0],kp2[m.trainIdx].pt[1])
-
-              
-    # Draw the matches using drawMatchesKnn() 
-    Matched = cv2.drawMatchesKnn(img1,       
-                                 kp1,    
-                                 img2, 
-                                 kp2, 
-                                 Matches, 
-                                 outImg = None, 
-                                 matchColor = (0,0,255),   
-                                 singlePointColor = (0,255,255), 
-                                 matchesMask = good_matches, 
-                                 flags = 0
-                                ) 
-    return Matched,ptsA,ptsB
+        Returns:
+            Matched (array_like): 
+                visualization of the matches (None, if draw is False).
+            
+            ptsA (Kx2 array_like): 
+                matched points of the reference (x,y).
+            
+            ptsB (Kx2 array_like): 
+                matched points of img (x,y).
 
-#%% stack_sift_align
-def stack_sift_align_to_first(stack,ratio=0.5,verbose=False):
-    
-    #get keypoints and good macthes
-    ptsBs=[]
-    ptsAs=[]
-    for i in range(len(stack)-1):    
-        matched,ptsA,ptsB=sift_align_matches(stack[0], 
-                                                stack[i+1],ratio_threshold=ratio)
-        ptsAs.append(ptsA)
-        ptsBs.append(ptsB)
-
-    # make a dictionary of matching points over the whole stack 
-    kpdict=dict()
-    for i in range(len(ptsAs)):
-        for j in range(len( ptsAs[i])):
-            ptA=(ptsAs[i][j][0],ptsAs[i][j][1])
-            ptB=(ptsBs[i][j][0],ptsBs[i][j][1])
+        """
+        Matched, indices, ptsB = self._match(img, draw)
+        return Matched, self.points[indices], ptsB
+
+    def match_stack(self, imgs):
+        """
+        match the reference to every image of imgs on a thread pool
+
+        Args:
+            imgs (list of MxN array_like): 
+                images (8bit).
+
+        Returns:
+            ptsAs (list of Kx2 array_like): 
+                matched points of the reference for each image.
             
-            if ptA in kpdict:
-                kpdict[ptA].append(ptB)
-            else:
-                kpdict[ptA]=[ptB]
-    # choose only keypoints that persist in all images
-    persistent_ptsA=[]
-    persistent_ptsBs=[]
-    for i in kpdict:
-        if len(kpdict[i])==len(ptsAs):
-            persistent_ptsA.append(i)
-            persistent_ptsBs.append(kpdict[i])
-    resulting_ptsA=np.array(persistent_ptsA)
-    number_of_images_to_align=len(ptsAs)
-    number_of_persistent_matches=len(resulting_ptsA)
+            ptsBs (list of Kx2 array_like): 
+                matched points of each image.
+
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(self._match, imgs))
+        ptsAs = [self.points[indices] for Matched, indices, ptsB in results]
+        ptsBs = [ptsB for Matched, indices, ptsB in results]
+        return ptsAs, ptsBs
+
+    def track_table(self, imgs):
+        """
+        match the reference to every image of imgs (see match_stack) and 
+        arrange the matches as tracks of the reference keypoints
+
+        Args:
+            imgs (list of MxN array_like): 
+                images (8bit).
+
+        Returns:
+            tracks (KxL array_like): 
+                for each of the K reference keypoints and each of the L images
+                the row of the matched point in ptsBs[l], or -1 if unmatched.
+            
+            ptsBs (list of array_like): 
+                matched points of each image (x,y).
+
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(self._match, imgs))
+        tracks = np.full([len(self.points), len(imgs)], -1, dtype=np.int32)
+        ptsBs = []
+        for l, (Matched, indices, ptsB) in enumerate(results):
+            tracks[indices, l] = np.arange(len(indices))
+            ptsBs.append(ptsB)
+        return tracks, ptsBs
+
+
+#%% sift align matches
+def sift_align_matches(img1,img2,ratio_threshold=0.5,draw=True,matcher="bf"):
+    # matches of the SIFT keypoints of img1 to the keypoints of img2,
+    # see sift_registration for repeated matching to the same img1
+    registration=sift_registration(img1,ratio_threshold,matcher)
+    return registration.match(img2,draw=draw)
+
+#%% stack_sift_align
+def stack_sift_align_to_first(stack,ratio=0.5,verbose=False,matcher="bf",workers=None,
+                              min_frames=None,cache=None):
+    # the keypoints of the first image are detected once and matched 
+    # to the other images on a thread pool (workers), 
+    # matcher: "bf" (exact) or "flann" (approximate, faster), see sift_registration
+    # min_frames: number of the other images, in which a keypoint of the first image 
+    #             has to be found to be used, defaults to all of them
+    # cache: registration_cache, the homographies are stored and taken from it
+    #        for the same images and parameters, only the warping is repeated
     
+    if cache is not None:
+        key=cache.key("stack_sift_align_to_first",stack,ratio=ratio,matcher=matcher,
+                      min_frames=min_frames)
+        cached=cache.load(key)
+        if cached is not None:
+            print(int(cached["number_of_persistent_matches"]))
+            metadata=dict()
+            metadata["matrices"]=list(cached["matrices"])
+            for name in ["reswidth","resheight","width_shift","height_shift"]:
+                metadata[name]=cached[name][()]
+            im1s=[align_image_fast1(stack[i+1],metadata["matrices"][i],
+                                    metadata["reswidth"],metadata["resheight"]) 
+                  for i in range(len(stack)-1)]
+            img0=align_image_fast2(stack[0],metadata["reswidth"],metadata["resheight"],
+                                   metadata["width_shift"],metadata["height_shift"])
+            imlist=[img0]+im1s
+            if verbose:
+                return imlist,metadata
+            return imlist
+
+    #get keypoints and good matches, as table of reference keypoint x image
+    registration=sift_registration(stack[0],ratio,matcher,workers)
+    tracks,ptsBs=registration.track_table(stack[1:])
+    number_of_images_to_align=len(ptsBs)
+    if min_frames is None:
+        min_frames=number_of_images_to_align
+
+    # choose only keypoints that persist in enough images
+    found=tracks>=0
+    persistent=np.sum(found,axis=1)>=min_frames
+    number_of_persistent_matches=np.count_nonzero(persistent)
     print(number_of_persistent_matches)
-    #restructure points B
-    resulting_ptsBs=np.zeros([number_of_images_to_align,
-                     number_of_persistent_matches,
-                     2])    
-    for i in range(number_of_persistent_matches):
-        resulting_ptsBs[:,i,:]=persistent_ptsBs[i]
+
+    if min_frames>=number_of_images_to_align:
+        # the same reference points for all images
+        resulting_ptsA=registration.points[persistent]
+        resulting_ptsBs=np.zeros([number_of_images_to_align,
+                                  number_of_persistent_matches,
+                                  2])
+        for l in range(number_of_images_to_align):
+            resulting_ptsBs[l]=ptsBs[l][tracks[persistent,l]]
+    else:
+        # every image has its own subset of the persistent keypoints
+        resulting_ptsA=[]
+        resulting_ptsBs=[]
+        for l in range(number_of_images_to_align):
+            selected=persistent & found[:,l]
+            resulting_ptsA.append(registration.points[selected])
+            resulting_ptsBs.append(ptsBs[l][tracks[selected,l]])
     
     
     #calculate the homography matrices and apply them    
     
+    (im1s, img0, matrices, reswidth, resheight, 
+     width_shift, height_shift)=align_images(
+                                             stack[1:],stack[0], 
+                                             resulting_ptsBs[:], resulting_ptsA,verbose=True)
+    imlist=[img0]+im1s
+    metadata=dict()
+    metadata["matrices"]=matrices
+    metadata["reswidth"]=reswidth
+    metadata["resheight"]=resheight
+    metadata["width_shift"]=width_shift
+    metadata["height_shift"]=height_shift
+
+    if cache is not None:
+        cache.save(key,number_of_persistent_matches=number_of_persistent_matches,**metadata)
+    
     if not verbose:
-        im1s,img0=align_images(stack[1:],stack[0], resulting_ptsBs[:], resulting_ptsA)
-        imlist=[img0]+im1s
         return imlist
     else:
-        (im1s, img0, matrices, reswidth, resheight, 
-         width_shift, height_shift)=align_images(
-                                                 stack[1:],stack[0], 
-                                                 resulting_ptsBs[:], resulting_ptsA,verbose=True)
-        imlist=[img0]+im1s
-        metadata=dict()
-        metadata["matrices"]=matrices
-        metadata["reswidth"]=reswidth
-        metadata["resheight"]=resheight
-        metadata["width_shift"]=width_shift
-        metadata["height_shift"]=height_shift
-        
         return imlist,metadata
     
-#%% stack_align_from_matrices   
-def stack_align_from_matrices(stack,metadata):
+#%% stack_align_from_matrices
+def _warp_frame(img, matrix, size, out, i):
+    img = np.asarray(img)
+    if isinstance(out, np.ndarray) and out.dtype == img.dtype and out[i].flags.c_contiguous:
+        # written directly into the output stack
+        cv2.warpPerspective(img, matrix, size, dst=out[i], flags=cv2.INTER_CUBIC)
+        return None
+    return cv2.warpPerspective(img, matrix, size, flags=cv2.INTER_CUBIC)
+
+
+def warp_stack(imgs, matrices, reswidth, resheight, out=None, workers=None):
+    """
+    apply a homography to every image of a stack 
+    (bicubic, like align_image_fast1), on a thread pool.
+
+    Args:
+        imgs (list of MxN array_like or KxMxN array_like): 
+            stack of images.
+        
+        matrices (list of 3x3 array_like): 
+            homography of each image.
+        
+        reswidth (int): 
+            width of the output.
+        
+        resheight (int): 
+            height of the output.
+        
+        out (Kxresheightxreswidth array_like, optional): 
+            output stack, e.g. a numpy array, a np.memmap or a h5py dataset.
+            Frames with the dtype of a numpy output are warped directly into it. 
+            Defaults to None, then an array with the dtype of the images is created.
+        
+        workers (int, optional): 
+            number of threads. Defaults to None (number of cores).
+
+    Returns:
+        out (Kxresheightxreswidth array_like): 
+            warped stack.
+
+    """
+    if out is None:
+        out = np.zeros([len(imgs), resheight, reswidth], dtype=np.asarray(imgs[0]).dtype)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # the frames are processed in batches, so that only a few warped
+    # frames are kept in memory, if they have to be copied to the output
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        batch = 4 * workers
+        for start in range(0, len(imgs), batch):
+            indices = range(start, min(start + batch, len(imgs)))
+            results = pool.map(
+                lambda i: _warp_frame(imgs[i], matrices[i], (reswidth, resheight), out, i),
+                indices,
+            )
+            for i, res in zip(indices, results):
+                if res is not None:
+                    out[i] = res
+    return out
+
+
+def stack_align_from_matrices(stack,metadata,out=None,workers=None):
     """
     Aligns a stack of images using the homographic transformation calculated
     by the function stack_sift_align_to_first() with argument verbose=True
@@ -1420,10 +3831,20 @@ def stack_align_from_matrices(stack,metadata):
         
         metadata (dictionary): 
             transformational information as given by stack_sift_align_to_first.
+        
+        out (KxM'xN' array_like, optional): 
+            output stack with M'=metadata["resheight"] and N'=metadata["reswidth"],
+            e.g. a numpy array, a np.memmap or a h5py dataset. 
+            Defaults to None.
+        
+        workers (int, optional): 
+            number of threads for the warping. 
+            Defaults to None (number of cores).
 
     Returns:
-        imlist (list of MxN): 
-            list of aligned images.
+        imlist (list of M'xN' array_like): 
+            list of aligned images (views of one array with the dtype 
+            of the first image), or out itself if it is given.
 
     """
     
@@ -1432,14 +3853,36 @@ def stack_align_from_matrices(stack,metadata):
     width_shift=metadata["width_shift"]    
     height_shift=metadata["height_shift"]
     matrices=metadata["matrices"]
-    
-    im1s=[]
-    for i in range(len(stack)-1):
-        img=align_image_fast1(stack[i+1], matrices[i], reswidth, resheight)
-        im1s.append(img)
 
-    img0=align_image_fast2(stack[0], reswidth, resheight, width_shift, height_shift)
+    given=out is not None
+    if not given:
+        out=np.zeros([len(stack),resheight,reswidth],dtype=np.asarray(stack[0]).dtype)
+
+    out[0]=align_image_fast2(stack[0], reswidth, resheight, width_shift, height_shift)
+
+    # the first image is only shifted, the others are warped with their matrix
+    if isinstance(out,np.ndarray):
+        target=out[1:]
+    else:
+        target=_offset_stack(out,1)
+    warp_stack(_offset_stack(stack,1),matrices,reswidth,resheight,out=target,workers=workers)
     
-    imlist=[img0]+im1s
-    return imlist  
-    
\ No newline at end of file
+    if given:
+        return out
+    return list(out)
+
+
+class _offset_stack:
+    # frames i+offset of a stack as frames i, without copying
+    def __init__(self, imgs, offset):
+        self.imgs = imgs
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.imgs) - self.offset
+
+    def __getitem__(self, i):
+        return self.imgs[i + self.offset]
+
+    def __setitem__(self, i, value):
+        self.imgs[i + self.offset] = value
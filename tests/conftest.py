@@ -54,4 +54,22 @@ def expected_shift():
 
 @pytest.fixture()
 def stack():
-    return pytest.stack
\ No newline at end of file
+    return pytest.stack
+
+@pytest.fixture()
+def grid_tiles():
+    # 3x4 tiles cut from a random texture with 25% overlap,
+    # returns the tiles and their true positions
+    rng=np.random.default_rng(0)
+    tile=64
+    step=48
+    texture=rng.random([3*step+tile+8,4*step+tile+8])
+    texture=(texture+np.roll(texture,1,axis=0)+np.roll(texture,1,axis=1))/3
+    tiles=[]
+    positions=[]
+    for r in range(3):
+        for c in range(4):
+            pos=np.array([r*step+c%2,c*step+r])
+            positions.append(pos)
+            tiles.append(texture[pos[0]:pos[0]+tile,pos[1]:pos[1]+tile])
+    return tiles,np.array(positions)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+@author: kernke
+"""
+
+import pytest
+import numpy as np
+import h5py
+import cv2
+import multiprocessing
+
+from numpy.testing import assert_array_equal
+from microscopy_data_analysis import h5_util
+
+
+@pytest.fixture()
+def frames():
+    rng=np.random.default_rng(0)
+    return rng.integers(0,30,[6,20,24]).astype(np.uint8)
+
+
+@pytest.mark.parametrize("compression",["gzip","lzf"])
+@pytest.mark.parametrize("prefetch",[0,2])
+def test_frame_reader_writer(tmp_path,frames,compression,prefetch):
+    with h5py.File(tmp_path/"frames.h5","w") as h5:
+        # gzip chunks are (de)compressed directly, other filters via h5py
+        for name in ["imgs","copy"]:
+            h5.create_dataset(name,shape=frames.shape,dtype=np.uint8,
+                              chunks=(1,*frames.shape[1:]),compression=compression)
+        h5["imgs"][:]=frames
+
+        indices=[4,0,2,5]
+        read=list(h5_util.h5_frame_reader(h5["imgs"],indices,prefetch))
+        assert_array_equal(read,frames[indices])
+
+        with h5_util.h5_frame_writer(prefetch) as writer:
+            for i,frame in enumerate(h5_util.h5_frame_reader(h5["imgs"],prefetch=prefetch)):
+                writer.write(h5["copy"],i,frame)
+        assert_array_equal(h5["copy"][()],frames)
+
+
+def test_frame_writer_errors(tmp_path,frames):
+    with h5py.File(tmp_path/"frames.h5","w") as h5:
+        dataset=h5.create_dataset("imgs",shape=frames.shape,dtype=np.uint8,
+                                  chunks=(1,*frames.shape[1:]),compression="gzip")
+        # a failing write is raised, when the frames are stored
+        with pytest.raises(Exception):
+            with h5_util.h5_frame_writer(2) as writer:
+                writer.write(dataset,len(frames)+3,frames[0])
+        # but does not replace an exception raised while writing
+        with pytest.raises(KeyError):
+            with h5_util.h5_frame_writer(2) as writer:
+                writer.write(dataset,len(frames)+3,frames[0])
+                writer.write(dataset,0,frames[0])
+                raise KeyError("processing failed")
+        assert writer._pool is None
+
+
+@pytest.fixture()
+def line_frames(tmp_path):
+    # noisy frames with dark lines for the line detection
+    rng=np.random.default_rng(1)
+    frames=np.empty([4,64,64],np.uint8)
+    for k in range(len(frames)):
+        img=np.full((64,64),120,np.uint8)
+        for l in range(3):
+            y=int(rng.integers(0,64))
+            cv2.line(img,(0,y),(63,(y+10)%64),60,2)
+        frames[k]=np.clip(img+rng.normal(0,10,img.shape),0,255)
+    with h5py.File(tmp_path/"lines.h5","w") as h5:
+        for name in ["t0","t1"]:
+            h5_util.h5_images_dataset(h5,name+"/imgs",frames.shape)
+            h5[name+"/imgs"][:]=frames
+            h5[name+"/time"]=np.arange(len(frames),dtype=float)
+    return tmp_path/"lines.h5"
+
+
+@pytest.mark.parametrize("options",[dict(prefetch=2),dict(processes=2),dict(processes=2,prefetch=2)])
+def test_go_over_data_params(tmp_path,line_frames,options):
+    # the engines give the same check maps as the serial engine with real processing
+    params=(2,15,15,"dark",None,np.ones((5,5),np.uint8),2,None)
+    results=[]
+    for k,kwargs in enumerate([dict(),options]):
+        path=tmp_path/("checks"+str(k)+".h5")
+        h5_util.h5_go_over_data(path,line_frames,[0,30],["t0","t1"],params,**kwargs)
+        with h5py.File(path,"r") as h5:
+            results.append({name:h5[name][()] for name in ["t0/check0","t0/check1","t1/check0","t1/time"]})
+    assert np.any(results[0]["t0/check0"]!=results[0]["t0/check0"].flat[0])
+    # the workers are joined after a successful run
+    assert multiprocessing.active_children()==[]
+    for name in results[0]:
+        assert_array_equal(results[0][name],results[1][name])
+
+
+def test_go_over_data_engines(tmp_path,frames):
+    with h5py.File(tmp_path/"raw.h5","w") as h5:
+        h5_util.h5_images_dataset(h5,"t0/imgs",frames.shape)
+        h5["t0/imgs"][:]=frames
+        h5["t0/time"]=np.arange(len(frames),dtype=float)
+
+    results=[]
+    for k,options in enumerate([dict(),dict(prefetch=3),dict(processes=2,prefetch=2)]):
+        path=tmp_path/("checks"+str(k)+".h5")
+        h5_util.h5_go_over_data(path,tmp_path/"raw.h5",[0,90],["t0"],[None]*8,
+                                no_output=True,**options)
+        with h5py.File(path,"r") as h5:
+            results.append([h5["t0/check0"][()],h5["t0/check1"][()],h5["t0/time"][()]])
+    for other in results[1:]:
+        for a,b in zip(results[0],other):
+            assert_array_equal(a,b)
+    assert_array_equal(results[0][0],255)
+
+
+def test_bounded_imap():
+    from multiprocessing.pool import ThreadPool
+    drawn=[]
+    def tasks():
+        for i in range(20):
+            drawn.append(i)
+            yield i
+    with ThreadPool(2) as pool:
+        for consumed,result in enumerate(h5_util._bounded_imap(pool,lambda x:x*x,tasks(),3)):
+            assert result==consumed**2
+            # only a bounded number of tasks was submitted ahead of the consumer
+            assert len(drawn)-consumed<=4
+    assert len(drawn)==20
+
+
+def test_go_over_data_worker_error(tmp_path,line_frames):
+    # an error of a worker is raised and the workers are stopped
+    params=(2,15,15,"dark",None,"no kernel",2,None)
+    with pytest.raises(Exception):
+        h5_util.h5_go_over_data(tmp_path/"checks.h5",line_frames,[0,30],["t0"],params,processes=2)
+    assert multiprocessing.active_children()==[]
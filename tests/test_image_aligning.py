@@ -5,9 +5,15 @@ Created on Mon Aug  5 15:35:09 2024
 @author: kernke
 """
 
+import gc
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
+import numpy as np
+import cv2
+from scipy import ndimage
 
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_array_equal
 from microscopy_data_analysis import image_aligning
 
 def test_phase_correlation(
@@ -18,4 +24,438 @@ def test_phase_correlation(
     assert_allclose(res[expected_shift[0],expected_shift[1]],1.)
 
 def test_stack_shifting(stack):
-    print(image_aligning.stack_shifting(stack))
\ No newline at end of file
+    print(image_aligning.stack_shifting(stack))
+
+def test_spectrum_cache(stack):
+    spectra=image_aligning.spectrum_cache(stack)
+    assert_allclose(spectra.align(0,1),image_aligning.align(stack[0],stack[1]))
+    # every frame is transformed once for the full image and six sub-windows
+    assert spectra.transforms==2*7
+
+
+def test_align_overlap(central_pattern_img,shifted_pattern_img):
+    res=image_aligning.align(central_pattern_img,shifted_pattern_img,method="overlap")
+    assert_allclose(res,-pytest.shift)
+
+
+def test_align_dft_precise():
+    rng=np.random.default_rng(0)
+    base=ndimage.gaussian_filter(rng.random([168,174]),1)
+    shift=np.array([3.27,-5.61])
+    # subpixel shifted copy, cropped from the interior to avoid periodic images
+    shifted=np.fft.ifft2(ndimage.fourier_shift(np.fft.fft2(base),-shift)).real
+    im1=base[20:148,20:154]
+    im2=shifted[20:148,20:154]
+    res=image_aligning.align_dft_precise(im1,im2,upsample_factor=100)
+    assert_allclose(res,shift,atol=0.06)
+
+
+def test_stack_shifting_parallel(stack):
+    frames=np.concatenate([stack,stack[::-1],stack])
+    serial=image_aligning.stack_shifting(frames)
+    threaded=image_aligning.stack_shifting(frames,parallel="thread",workers=3)
+    assert_allclose(threaded,serial)
+
+
+def test_stack_shifting_process(stack):
+    frames=np.concatenate([stack,stack[::-1],stack])
+    serial=image_aligning.stack_shifting(frames)
+    processes=image_aligning.stack_shifting(frames,parallel="process",workers=2)
+    assert_array_equal(processes,serial)
+
+    rng=np.random.default_rng(0)
+    base=ndimage.gaussian_filter(rng.random([90,90]),1)
+    frames=np.array([base[o:o+64,2*o:2*o+64] for o in [0,3,7,4,10]])
+    serial=image_aligning.stack_shift_precise(frames,delta=3)
+    processes=image_aligning.stack_shift_precise(frames,delta=3,parallel="process",workers=2)
+    assert_array_equal(processes,serial)
+
+
+def test_stitching_positions_sparse(grid_tiles):
+    tiles,true_positions=grid_tiles
+    positions,neighbours,pos_pcms=image_aligning.relative_stitching_positions(tiles,[3,4])
+    edges,sparse_neighbours=image_aligning.relative_stitching_positions(tiles,[3,4],sparse=True)
+    assert len(edges)==17
+    assert sparse_neighbours==neighbours
+    dense=image_aligning.absolute_stitching_positions(positions,neighbours,[3,4],pos_pcms)
+    sparse=image_aligning.absolute_stitching_positions(edges,neighbours,[3,4])
+    assert_allclose(sparse,dense)
+    assert_allclose(sparse.reshape(-1,2),true_positions-np.min(true_positions,axis=0),atol=1)
+
+
+def test_stitching_positions_lsq(grid_tiles):
+    tiles,true_positions=grid_tiles
+    expected=true_positions-np.min(true_positions,axis=0)
+    edges,neighbours=image_aligning.relative_stitching_positions(tiles,[3,4],sparse=True)
+    res=image_aligning.absolute_stitching_positions(edges,neighbours,[3,4],conflict_sol="lsq")
+    assert_allclose(res.reshape(-1,2),expected)
+    # fractional positions are truncated like in the other modes
+    shifted=edges.copy()
+    shifted["dy"]+=0.6
+    res=image_aligning.absolute_stitching_positions(shifted,neighbours,[3,4],conflict_sol="lsq")
+    rows,cols=np.divmod(np.arange(12),4)
+    fractional=np.array(true_positions,dtype=float)
+    fractional[:,0]+=0.6*(rows+cols)
+    fractional-=np.min(fractional,axis=0)
+    assert_array_equal(res.reshape(-1,2),np.round(fractional,6).astype(int))
+    # one wrong relative position is rejected by the robust fit
+    edges["dy"][4]+=20
+    res=image_aligning.absolute_stitching_positions(edges,neighbours,[3,4],
+                                                    conflict_sol="lsq",outlier_threshold=2)
+    assert_allclose(res.reshape(-1,2),expected)
+
+
+def test_stitch_grid_blockwise(grid_tiles):
+    tiles,true_positions=grid_tiles
+    absolute_positions=(true_positions-np.min(true_positions,axis=0)).reshape(3,4,2)
+    mask=np.outer(np.hanning(64),np.hanning(64))+0.01
+    montage=image_aligning.stitch_grid(tiles,absolute_positions,[3,4],mask)
+    out=np.zeros(image_aligning.stitch_grid_shape(tiles,absolute_positions))
+    image_aligning.stitch_grid(tiles,absolute_positions,[3,4],mask,out=out,memory_budget=10000)
+    assert_allclose(out,montage)
+
+
+@pytest.mark.parametrize("number",[7,8])
+def test_flatfield_statistics(number):
+    rng=np.random.default_rng(0)
+    images=(rng.random([number,40,30])*255).astype(np.uint8)
+    immed,madnorm,mask=image_aligning.flatfield_statistics(images,memory_budget=5000)
+    assert_allclose(immed,np.median(images,axis=0))
+    mad=np.median(np.abs(images-immed),axis=0)
+    assert_allclose(madnorm,mad/np.max(mad))
+    # 256 bins cover every value of 8bit data, so the histogram median is exact
+    hist_immed,hist_madnorm,hist_mask=image_aligning.flatfield_statistics(
+        list(images),memory_budget=5000,median="histogram")
+    assert_allclose(hist_immed,immed)
+    assert_allclose(hist_madnorm,madnorm)
+
+    images_c,immed,madnorm,mask=image_aligning.optimize_images(list(images),memory_budget=5000)
+    assert_allclose(images_c,images/mask)
+
+
+def test_align_pyramid():
+    rng=np.random.default_rng(1)
+    base=ndimage.gaussian_filter(rng.random([300,300]),1.2)
+    im1=base[20:276,30:286]
+    im2=base[27:283,25:281]
+    res=image_aligning.align_pyramid(im1,im2,levels=2,refine_size=128)
+    assert_allclose(res,image_aligning.align(im1,im2))
+    assert_allclose(res,[7,-5])
+    frames=np.array([im1,im2,im1])
+    assert_allclose(image_aligning.stack_shifting(frames,levels=2),
+                    image_aligning.stack_shifting(frames))
+
+
+def test_stack_align_out(tmp_path):
+    rng=np.random.default_rng(2)
+    imgs=(rng.random([4,20,30])*255).astype(np.uint8)
+    shifts=np.array([[0,0],[2,-3],[5,1],[1,4]])
+    new=image_aligning.stack_align(imgs,shifts)
+    assert new.shape==image_aligning.stack_align_shape(imgs,shifts)==(4,25,37)
+    assert_allclose(new[1,2:22,0:30],imgs[1])
+    out=np.lib.format.open_memmap(tmp_path/"aligned.npy",mode="w+",
+                                  dtype=np.uint8,shape=new.shape)
+    image_aligning.stack_align(imgs,shifts,out=out)
+    assert_allclose(out,new)
+    kept=image_aligning.stack_align(imgs,shifts,keep_dtype=True)
+    assert kept.dtype==np.uint8
+    # the views of the crop mode are the common region of the aligned stack
+    views=image_aligning.stack_align(imgs,shifts,crop=True)
+    assert np.shares_memory(views[2],imgs)
+    assert_allclose(np.array(views),new[:,5:20,7:30])
+    # no cropping along an axis without shifts
+    cropped=image_aligning.stack_crop_shifts(imgs,np.zeros([4,2]))
+    assert cropped.shape==imgs.shape
+
+
+def test_stack_align_com_precise():
+    rng=np.random.default_rng(3)
+    imgs=ndimage.gaussian_filter(rng.random([3,40,50]),[0,2,2])
+    shifts=np.array([[0,0],[1.5,-2.],[3.,1.]])
+    out=np.zeros([3,43,53],dtype=np.uint16)
+    res=image_aligning.stack_align_com_precise(imgs,shifts,out=out,workers=2)
+    assert res is out
+    # an integer shift moves the frame without interpolation
+    assert_allclose(res[2,3:43,3:53],image_aligning.img_to_uint16(imgs[2]))
+    frames=image_aligning.stack_align_com_precise(imgs,shifts)
+    assert isinstance(frames,list)
+    assert_array_equal(frames,out)
+    # cv2 would write into a temporary copy of these outputs
+    with pytest.raises(ValueError):
+        image_aligning.stack_align_com_precise(imgs,shifts,out=np.zeros([3,43,53]))
+    with pytest.raises(ValueError):
+        image_aligning.stack_align_com_precise(imgs,shifts,out=np.zeros([3,53,43],dtype=np.uint16).transpose(0,2,1))
+
+
+def test_fine_tuning_shifts_engines():
+    rng=np.random.default_rng(4)
+    base=ndimage.gaussian_filter(rng.random([90,90]),2)
+    frames=np.array([base[10:74,10:74],base[12:76,9:73],base[11:75,13:77]])
+    original=frames.copy()
+    loop=image_aligning.fine_tuning_shifts(frames,delta=5,engine="loop")
+    fft=image_aligning.fine_tuning_shifts(frames,delta=5,workers=2)
+    assert_allclose(fft,loop)
+    # the input frames are not modified
+    assert_array_equal(frames,original)
+
+
+@pytest.mark.parametrize("matcher,query",[("flann",None),("bf",None),("bf","frame")])
+def test_sift_registration(matcher,query):
+    rng=np.random.default_rng(5)
+    base=ndimage.gaussian_filter(rng.random([260,260]),3)
+    base=((base-base.min())/np.ptp(base)*255).astype(np.uint8)
+    frames=[base[20:220,20:220],base[28:228,15:215],base[14:214,30:230]]
+    registration=image_aligning.sift_registration(frames[0],matcher=matcher,workers=2,query=query)
+    ptsAs,ptsBs=registration.match_stack(frames[1:])
+    # the (exact) matches of every worker equal those of single calls
+    for l in range(2*(matcher=="bf")):
+        Matched,ptsA,ptsB=registration.match(frames[l+1])
+        assert_array_equal(ptsA,ptsAs[l])
+        assert_array_equal(ptsB,ptsBs[l])
+    if matcher=="bf" and query is None:
+        # the reference descriptors are the queries, as in the direct matching
+        kp1,des1=cv2.SIFT_create().detectAndCompute(frames[0],None)
+        kp2,des2=cv2.SIFT_create().detectAndCompute(frames[1],None)
+        good=[m for m,n in cv2.BFMatcher().knnMatch(des1,des2,k=2) if m.distance<0.5*n.distance]
+        assert_array_equal(ptsBs[0],[kp2[m.trainIdx].pt for m in good])
+    # offsets (x,y) of the frames relative to the reference
+    for ptsA,ptsB,offset in zip(ptsAs,ptsBs,[[5,-8],[-10,6]]):
+        assert len(ptsA)>10
+        assert_allclose(np.median(ptsB-ptsA,axis=0),offset,atol=0.5)
+    tracks,ptsBs=registration.track_table(frames[1:])
+    assert tracks.shape==(len(registration.points),2)
+    for l in range(2):
+        found=tracks[:,l]>=0
+        assert_allclose(registration.points[found],ptsAs[l])
+        assert_allclose(ptsBs[l][tracks[found,l]],ptsBs[l])
+
+
+def test_align_images_bounds():
+    rng=np.random.default_rng(6)
+    ims=[rng.random([60,80]) for i in range(2)]
+    p1=rng.random([20,2])*50
+    p2=p1+[-7,4]
+    im1s,im2,matrices,reswidth,resheight,width_shift,height_shift=image_aligning.align_images(
+        ims,ims[0],[p1,p1],p2,verbose=True)
+    assert (reswidth,resheight,width_shift,height_shift)==(87,63,7,0)
+    assert_allclose(matrices[0],[[1,0,0],[0,1,4],[0,0,1]],atol=1e-6)
+    assert_allclose(im1s[0][6:61,2:78],ims[0][2:57,2:78],atol=1e-4)
+
+
+def test_stack_align_from_matrices():
+    rng=np.random.default_rng(7)
+    stack=(rng.random([5,30,40])*255).astype(np.uint8)
+    shift=np.array([[1,0,3],[0,1,2],[0,0,1]],dtype=float)
+    metadata=dict(matrices=[shift]*4,reswidth=45,resheight=33,width_shift=3,height_shift=2)
+    res=image_aligning.stack_align_from_matrices(stack,metadata,workers=2)
+    assert isinstance(res,list)
+    res=np.array(res)
+    assert res.shape==(5,33,45) and res.dtype==np.uint8
+    assert_allclose(res[:,2:32,3:43],stack)
+    out=np.zeros([5,33,45],dtype=np.float32)
+    image_aligning.stack_align_from_matrices(stack,metadata,out=out)
+    assert_allclose(out,res)
+
+
+@pytest.mark.parametrize("on_disk",[False,True])
+def test_pairwise_pcm_store(grid_tiles,tmp_path,on_disk):
+    tiles,true_positions=grid_tiles
+    store=image_aligning.pairwise_pcm_store(tmp_path/"pcms.h5" if on_disk else None,max_spectra=10)
+    # every tile is transformed once for its up to four pairs
+    drifts=image_aligning.drift_correction(tiles,[3,4],[0.25,0.25],store=store)[0]
+    assert store.transforms==12
+    assert_allclose(store.drifts,drifts)
+    # the stitching with the drifts of drift_correction computes no transforms
+    edges,neighbours=image_aligning.relative_stitching_positions(tiles,[3,4],sparse=True,store=store)
+    assert store.transforms==12
+    for edge in edges:
+        assert (edge["dy"],edge["dx"])==tuple(true_positions[edge["j"]]-true_positions[edge["i"]])
+    again,neighbours=image_aligning.relative_stitching_positions(tiles,[3,4],sparse=True,store=store)
+    assert store.transforms==12
+    assert_allclose(again.tolist(),edges.tolist())
+
+    # the maxima are those of the unmasked phase correlation in the (shifted) window
+    rows,cols=np.arange(-3,4),np.arange(40,56)
+    peak=store.peak(0,1,0,None,None,rows+1,cols-2)
+    expected=image_aligning._pcm_peak(image_aligning.phase_correlation(tiles[0],tiles[1]),rows+1,cols-2)
+    assert peak.dtype==image_aligning.pcm_peak_dtype
+    for name in ["dy","dx","score"]:
+        assert peak[name]==expected[name]
+    assert_allclose(peak["neighbourhood"],expected["neighbourhood"])
+    store.close()
+    if on_disk:
+        with image_aligning.pairwise_pcm_store(tmp_path/"pcms.h5") as reopened:
+            again,neighbours=image_aligning.relative_stitching_positions(tiles,[3,4],sparse=True,drifts=drifts,store=reopened)
+            assert reopened.transforms==0
+        assert_allclose(again.tolist(),edges.tolist())
+
+
+def test_pairwise_pcm_store_bound(grid_tiles):
+    tiles,true_positions=grid_tiles
+    store=image_aligning.pairwise_pcm_store(max_bytes=1)
+    edges,neighbours=image_aligning.relative_stitching_positions(tiles,[3,4],sparse=True,store=store)
+    # only the most recent band is kept
+    assert len(store._bands)==1
+    expected,neighbours=image_aligning.relative_stitching_positions(tiles,[3,4],sparse=True,store=image_aligning.pairwise_pcm_store())
+    assert_allclose(edges.tolist(),expected.tolist())
+
+
+def test_registration_cache(grid_tiles,tmp_path,stack):
+    cache=image_aligning.registration_cache(tmp_path)
+    shifts=image_aligning.stack_shifting(stack,cache=cache)
+    assert_allclose(image_aligning.stack_shifting(stack,cache=cache),shifts)
+    assert len(list(tmp_path.glob("*.npz")))==1
+    # other parameters are another entry
+    image_aligning.stack_shifting(stack,method="overlap",cache=cache)
+    assert len(list(tmp_path.glob("*.npz")))==2
+
+    tiles,true_positions=grid_tiles
+    edges,neighbours=image_aligning.relative_stitching_positions(tiles,[3,4],sparse=True,cache=cache)
+    positions,neighbours,pos_pcms=image_aligning.relative_stitching_positions(tiles,[3,4],cache=cache)
+    expected=image_aligning.relative_stitching_positions(tiles,[3,4])
+    assert_allclose(positions,expected[0])
+    assert_allclose(pos_pcms,expected[2])
+
+    # the least recently used entries are removed first
+    small=image_aligning.registration_cache(tmp_path,max_bytes=1)
+    small.save(small.key("test",[stack[0]]),shifts=shifts)
+    assert [file.name for file in tmp_path.glob("*.npz")]==[small.key("test",[stack[0]])+".npz"]
+    assert list(tmp_path.glob("*.tmp"))==[]
+
+
+def test_registration_cache_truncated(tmp_path,stack):
+    cache=image_aligning.registration_cache(tmp_path)
+    key=cache.key("test",[stack[0]])
+    cache.save(key,shifts=np.arange(1000))
+    file=tmp_path/(key+".npz")
+    data=file.read_bytes()
+    for truncated in [data[:len(data)//2],data[:10],b""]:
+        file.write_bytes(truncated)
+        # an unreadable entry is a cache miss and is removed
+        assert cache.load(key) is None
+        assert not file.exists()
+    cache.save(key,shifts=np.arange(1000))
+    assert_array_equal(cache.load(key)["shifts"],np.arange(1000))
+
+
+def test_contrast_correction():
+    rng=np.random.default_rng(8)
+    images=(rng.gamma(4,300,[6,40,50])*(1+np.arange(6))[:,None,None]).astype(np.uint16)
+    brightness=image_aligning.contrast_brightness(images,memory_budget=40*50*24*4)
+    for image,value in zip(images,brightness):
+        vals,bins=np.histogram(image,100)
+        maxpos=np.argmax(vals[5:])+5
+        assert value==(bins[maxpos]+bins[maxpos+1])/2
+    corrected=image_aligning.contrast_correction(images)
+    lazy=image_aligning.contrast_correction(images,lazy=True)
+    assert_allclose(lazy[3],corrected[3])
+    floats=images.astype(float)
+    assert image_aligning.contrast_correction(floats,inplace=True) is floats
+    assert_allclose(floats,corrected)
+
+
+def test_contrast_brightness_budget(monkeypatch):
+    rng=np.random.default_rng(9)
+    images=rng.integers(0,2**16,[9,20,30]).astype(np.uint16)
+    expected=image_aligning.contrast_brightness(images)
+    # the temporaries over all 65536 values of 16 bit data count towards the budget
+    per_image=image_aligning._histogram_mode_bytes(20*30,np.uint16)
+    assert per_image>65536*8
+    batches=[]
+    histogram=image_aligning._histogram_mode_brightness
+    monkeypatch.setattr(image_aligning,"_histogram_mode_brightness",lambda batch:batches.append(len(batch)) or histogram(batch))
+    brightness=image_aligning.contrast_brightness(images,memory_budget=4*per_image)
+    assert batches==[4,4,1]
+    assert_array_equal(brightness,expected)
+
+
+def test_drift_tracker(stack):
+    frames=np.concatenate([stack,stack[::-1],stack])
+    tracker=image_aligning.drift_tracker()
+    shifts=np.array(list(tracker.track(frames)))
+    assert_allclose(shifts,image_aligning.stack_shifting(frames))
+    # only the previous frame and the keyframe are kept
+    assert len(tracker._frames)<=2
+    # frames 2 and 4 equal the first frame, as keyframes they are anchored to it
+    tracker=image_aligning.drift_tracker(keyframe_interval=2)
+    shifts=np.array([tracker.update(frame) for frame in stack[[0,1,0,1,0]]])
+    assert_allclose(shifts[[2,4]],0)
+
+
+def test_correlation_plan():
+    rng=np.random.default_rng(0)
+    a=ndimage.gaussian_filter(rng.random([48,51]),1.5)
+    b=np.roll(a,(5,-7),axis=(0,1))
+    # reference: complex fft2 of the previous implementation
+    R=np.fft.fft2(a)*np.conjugate(np.fft.fft2(b))
+    R/=np.absolute(R)
+    assert_allclose(image_aligning.phase_correlation(a,b),np.fft.ifft2(R).real,atol=1e-12)
+
+    plan=image_aligning._plan(a.shape)
+    assert plan is image_aligning._plan(a.shape)
+    G_a,G_b=plan.spectrum(a),plan.spectrum(b)
+    assert G_a.shape==(48,26)
+    assert_allclose(plan.full_cross_power(G_a,G_b),R,atol=1e-12)
+
+    # apodization and band-pass filter keep the peak at the shift
+    pcm=image_aligning.phase_correlation(a,b,window="hann",bandpass=(0.01,0.25),workers=2)
+    assert_allclose(image_aligning.max_from_2d(pcm)[0],[-5%48,7])
+
+    masks=image_aligning._stitching_masks(a.shape,[0.25,0.25],0.1)
+    tile=image_aligning._masked_tile(a,("up","edgeright"),masks)
+    assert_allclose(tile,a*masks["up"]*masks["edgeright"])
+    assert ("up","edgeright") in masks
+
+
+def test_correlation_plan_cache(monkeypatch):
+    monkeypatch.setattr(image_aligning,"_plans_max_bytes",2**20)
+    image_aligning.clear_correlation_plans()
+    small=image_aligning._plan((32,32))
+    image_aligning._plan((48,48),window="hann")
+    assert len(image_aligning._plans)==2
+    # plans beyond the byte limit are removed, least recently used first
+    large=image_aligning._plan((300,300),window="hann")
+    assert large.nbytes>2**19
+    image_aligning._plan((32,32))
+    larger=image_aligning._plan((350,350),window="hann")
+    assert list(image_aligning._plans.values())==[small,larger]
+    # a plan exceeding the limit alone is not kept
+    image_aligning._plan((400,400),window="hann")
+    assert list(image_aligning._plans.values())==[small,larger]
+    image_aligning.clear_correlation_plans()
+    assert len(image_aligning._plans)==0
+    assert image_aligning._plan((32,32)) is not small
+
+    # the workspaces count towards the limit and are freed with their threads
+    image_aligning.clear_correlation_plans()
+    plan=image_aligning._plan((200,200))
+    a=np.random.default_rng(0).random([200,200])
+    G=plan.spectrum(a)
+    before=plan.nbytes
+    with ThreadPoolExecutor(2) as pool:
+        list(pool.map(lambda i:plan.pcm(G,G),range(4)))
+        assert plan.nbytes>before
+    del pool
+    gc.collect()
+    assert plan.nbytes==before
+    plan.pcm(G,G)
+    assert plan.nbytes==before+200*101*24
+    image_aligning._plan((300,300),window="hann").pcm(*[image_aligning._plan((300,300),window="hann").spectrum(np.ones([300,300]))]*2)
+    assert sum(p.nbytes for p in image_aligning._plans.values())<=2**20
+
+
+def test_single_precision(stack):
+    spectra=image_aligning.spectrum_cache(stack,precision="single")
+    assert spectra.spectrum(0).dtype==np.complex64
+    assert spectra.phase_correlation(0,1).dtype==np.float32
+    assert_allclose(image_aligning.stack_shifting(stack,precision="single"),
+                    image_aligning.stack_shifting(stack))
+
+    rng=np.random.default_rng(1)
+    img=(ndimage.gaussian_filter(rng.random([80,90]),2)*4000).astype(np.uint16)
+    im1,im2=img[:64,:70],img[6:70,9:79]
+    double=image_aligning.align_com_precise(im1,im2,delta=3)
+    single=image_aligning.align_com_precise(im1,im2,delta=3,precision="single")
+    assert_allclose(single,double,atol=1e-3)
+    with pytest.raises(ValueError):
+        image_aligning.phase_correlation(im1,im2,precision="half")